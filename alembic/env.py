@@ -1,3 +1,4 @@
+import os
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -8,6 +9,7 @@ from alembic import context
 # 導入您的 Base 和 models
 from database import Base
 import models
+from online_migrations import checkpoints
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -18,12 +20,24 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# 與應用程式使用相同的 SIDEP_DATABASE_URL；未設定時使用 alembic.ini 的 sqlalchemy.url
+if os.environ.get("SIDEP_DATABASE_URL"):
+    config.set_main_option("sqlalchemy.url", os.environ["SIDEP_DATABASE_URL"].replace("%", "%%"))
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 # from myapp import mymodel
 target_metadata = Base.metadata
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # 線上遷移的進度檢查點由 online_migrations.py 在執行時建立，不屬於應用程式的 metadata，
+    # 沒有排除的話 autogenerate 會把它當成被刪除的表
+    if type_ == "table" and name == checkpoints.name:
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -48,6 +62,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -69,7 +84,7 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata, include_object=include_object
         )
 
         with context.begin_transaction():
@@ -0,0 +1,82 @@
+"""Add foreign-key/query-shape indexes and per-owner unique holiday dates
+
+Revision ID: a7c9e1f3b5d8
+Revises: f1b3d5e7a902
+Create Date: 2026-10-19 17:21:08.407126
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index_concurrently, drop_index_concurrently, online_block
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c9e1f3b5d8'
+down_revision: Union[str, Sequence[str], None] = 'f1b3d5e7a902'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# holidays / unavailable_dates 由 create_all 建立，date 欄位上是未命名的 UNIQUE
+# PostgreSQL 自動命名為 <table>_date_key，SQLite 則必須重建表格才能移除
+DATE_TABLES = {
+    'holidays': 'description',
+    'unavailable_dates': 'reason',
+}
+
+
+def _date_table(name: str, note_column: str, unique_date: bool) -> sa.Table:
+    return sa.Table(
+        name,
+        sa.MetaData(),
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('owner_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('date', sa.DateTime(), nullable=False, unique=unique_date),
+        sa.Column(note_column, sa.String(), nullable=True),
+        sa.Index(f'ix_{name}_id', 'id'),
+        *([] if unique_date else [sa.UniqueConstraint('owner_id', 'date', name=f'uq_{name}_owner_id_date')]),
+        *([sa.Index(f'ix_{name}_owner_id', 'owner_id')] if unique_date else []),
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    for name, note_column in DATE_TABLES.items():
+        if op.get_bind().dialect.name == 'postgresql':
+            op.execute(f'ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {name}_date_key')
+            op.create_unique_constraint(f'uq_{name}_owner_id_date', name, ['owner_id', 'date'])
+            # (owner_id, date) 唯一索引的前導欄位已涵蓋 owner_id
+            op.drop_index(f'ix_{name}_owner_id', table_name=name, if_exists=True)
+        else:
+            with op.batch_alter_table(name, recreate='always', copy_from=_date_table(name, note_column, unique_date=False)):
+                pass
+
+    op.create_index('ix_business_hours_owner_id_day_of_week', 'business_hours', ['owner_id', 'day_of_week'], unique=False)
+    op.drop_index('ix_business_hours_owner_id', table_name='business_hours', if_exists=True)
+
+    # bookings 是大表，在交易外以 CONCURRENTLY 建立索引
+    with online_block():
+        create_index_concurrently('ix_bookings_user_id_start_at', 'bookings', ['user_id', 'start_at'])
+        create_index_concurrently('ix_bookings_service_id', 'bookings', ['service_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with online_block():
+        drop_index_concurrently('ix_bookings_service_id', 'bookings')
+        drop_index_concurrently('ix_bookings_user_id_start_at', 'bookings')
+
+    op.create_index('ix_business_hours_owner_id', 'business_hours', ['owner_id'], unique=False)
+    op.drop_index('ix_business_hours_owner_id_day_of_week', table_name='business_hours')
+
+    # 若不同店家有相同日期，恢復全域唯一會失敗，需要先手動處理重複的日期
+    for name, note_column in DATE_TABLES.items():
+        if op.get_bind().dialect.name == 'postgresql':
+            op.create_index(f'ix_{name}_owner_id', name, ['owner_id'], unique=False)
+            op.drop_constraint(f'uq_{name}_owner_id_date', name, type_='unique')
+            op.create_unique_constraint(f'{name}_date_key', name, ['date'])
+        else:
+            with op.batch_alter_table(name, recreate='always', copy_from=_date_table(name, note_column, unique_date=True)):
+                pass
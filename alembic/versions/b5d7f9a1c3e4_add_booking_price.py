@@ -0,0 +1,74 @@
+"""Record the charged price on bookings
+
+Revision ID: b5d7f9a1c3e4
+Revises: a4c6e8f0b2d3
+Create Date: 2026-10-20 11:05:52.604118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import add_column_if_missing, online_block, run_batched
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5d7f9a1c3e4'
+down_revision: Union[str, Sequence[str], None] = 'a4c6e8f0b2d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+services = sa.table(
+    "services",
+    sa.column("id", sa.Integer),
+    sa.column("price", sa.Float),
+)
+
+
+def _booking_table(name):
+    return sa.table(
+        name,
+        sa.column("id", sa.Integer),
+        sa.column("service_id", sa.Integer),
+        sa.column("price", sa.Float),
+    )
+
+
+def _backfill(table):
+    # 既有的預約沒有紀錄當時的價格，以目前的服務價格回填 (與原本客戶統計使用的金額相同)
+    def fetch_batch(conn, last_id, limit):
+        return conn.execute(
+            sa.select(table.c.id, services.c.price)
+            .select_from(table.join(services, services.c.id == table.c.service_id))
+            .where(table.c.price.is_(None), table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(limit)
+        ).all()
+
+    def apply_batch(conn, rows):
+        prices = {row.id: row.price for row in rows}
+        if prices:
+            conn.execute(sa.update(table).where(table.c.id.in_(list(prices))).values(price=sa.case(prices, value=table.c.id)))
+        return len(prices)
+
+    return fetch_batch, apply_batch
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    add_column_if_missing('bookings', sa.Column('price', sa.Float(), nullable=True))
+    add_column_if_missing('bookings_archive', sa.Column('price', sa.Float(), nullable=True))
+
+    with online_block() as conn:
+        for name in ("bookings", "bookings_archive"):
+            fetch_batch, apply_batch = _backfill(_booking_table(name))
+            run_batched(conn, f"b5d7f9a1c3e4_{name}_price", fetch_batch, apply_batch, batch_size=BATCH_SIZE)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('bookings_archive', 'price')
+    op.drop_column('bookings', 'price')
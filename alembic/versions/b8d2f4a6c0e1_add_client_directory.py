@@ -0,0 +1,89 @@
+"""Add the per-owner client directory and bookings.client_id
+
+Revision ID: b8d2f4a6c0e1
+Revises: a7c9e1f3b5d8
+Create Date: 2026-10-19 19:02:44.118305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index_concurrently, drop_index_concurrently, online_block
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8d2f4a6c0e1'
+down_revision: Union[str, Sequence[str], None] = 'a7c9e1f3b5d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# 客戶列表的排序欄位；可為 NULL 的欄位在 PostgreSQL 上需要 NULLS FIRST 才與查詢的順序一致
+SORT_COLUMNS = ('name', 'visit_count', 'lifetime_spend')
+NULLABLE_SORT_COLUMNS = ('last_visit_at', 'next_visit_at')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('clients',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('email', sa.String(), nullable=True),
+        sa.Column('phone', sa.String(), nullable=True),
+        sa.Column('email_normalized', sa.String(), nullable=True),
+        sa.Column('phone_normalized', sa.String(), nullable=True),
+        sa.Column('booking_count', sa.Integer(), nullable=False),
+        sa.Column('visit_count', sa.Integer(), nullable=False),
+        sa.Column('lifetime_spend', sa.Float(), nullable=False),
+        sa.Column('last_visit_at', sa.DateTime(), nullable=True),
+        sa.Column('next_visit_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('owner_id', 'user_id', name='uq_clients_owner_id_user_id'),
+        sa.UniqueConstraint('owner_id', 'email_normalized', name='uq_clients_owner_id_email_normalized')
+    )
+    op.create_index(op.f('ix_clients_id'), 'clients', ['id'], unique=False)
+    op.create_index(op.f('ix_clients_user_id'), 'clients', ['user_id'], unique=False)
+    op.create_index('ix_clients_owner_id_phone_normalized', 'clients', ['owner_id', 'phone_normalized'], unique=False)
+    for column in SORT_COLUMNS:
+        op.create_index(f'ix_clients_owner_id_{column}', 'clients', ['owner_id', column, 'id'], unique=False)
+    for column in NULLABLE_SORT_COLUMNS:
+        if op.get_bind().dialect.name == 'postgresql':
+            op.create_index(f'ix_clients_owner_id_{column}', 'clients', ['owner_id', sa.text(f'{column} ASC NULLS FIRST'), 'id'], unique=False)
+        else:
+            op.create_index(f'ix_clients_owner_id_{column}', 'clients', ['owner_id', column, 'id'], unique=False)
+
+    # 新增可為 NULL 的欄位不需要改寫資料；既有預約由 python clients.py 回填
+    with op.batch_alter_table('bookings') as batch_op:
+        batch_op.add_column(sa.Column('client_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_bookings_client_id_clients', 'clients', ['client_id'], ['id'])
+    op.add_column('bookings_archive', sa.Column('client_id', sa.Integer(), nullable=True))
+
+    with online_block():
+        create_index_concurrently('ix_bookings_client_id_start_at', 'bookings', ['client_id', 'start_at'])
+        create_index_concurrently('ix_bookings_archive_client_id', 'bookings_archive', ['client_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with online_block():
+        drop_index_concurrently('ix_bookings_archive_client_id', 'bookings_archive')
+        drop_index_concurrently('ix_bookings_client_id_start_at', 'bookings')
+
+    op.drop_column('bookings_archive', 'client_id')
+    with op.batch_alter_table('bookings') as batch_op:
+        batch_op.drop_constraint('fk_bookings_client_id_clients', type_='foreignkey')
+        batch_op.drop_column('client_id')
+
+    for column in SORT_COLUMNS + NULLABLE_SORT_COLUMNS:
+        op.drop_index(f'ix_clients_owner_id_{column}', table_name='clients')
+    op.drop_index('ix_clients_owner_id_phone_normalized', table_name='clients')
+    op.drop_index(op.f('ix_clients_user_id'), table_name='clients')
+    op.drop_index(op.f('ix_clients_id'), table_name='clients')
+    op.drop_table('clients')
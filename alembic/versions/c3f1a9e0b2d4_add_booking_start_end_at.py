@@ -0,0 +1,101 @@
+"""Add typed start_at/end_at to bookings
+
+Revision ID: c3f1a9e0b2d4
+Revises: 46d35d66eb7a
+Create Date: 2026-10-19 10:12:40.118204
+
+"""
+from datetime import datetime, timedelta
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import add_column_if_missing, create_index_concurrently, drop_index_concurrently, online_block, run_batched
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f1a9e0b2d4'
+down_revision: Union[str, Sequence[str], None] = '46d35d66eb7a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+bookings = sa.table(
+    "bookings",
+    sa.column("id", sa.Integer),
+    sa.column("service_id", sa.Integer),
+    sa.column("date", sa.DateTime),
+    sa.column("time", sa.String),
+    sa.column("start_at", sa.DateTime),
+    sa.column("end_at", sa.DateTime),
+)
+services = sa.table(
+    "services",
+    sa.column("id", sa.Integer),
+    sa.column("max_duration", sa.Integer),
+)
+
+
+def _parse_time(value):
+    for fmt in ("%H:%M", "%H:%M:%S"):
+        try:
+            return datetime.strptime(value.strip(), fmt).time()
+        except (AttributeError, ValueError):
+            continue
+    return None
+
+
+def _fetch_batch(conn, last_id, limit):
+    # 只處理 start_at 仍為 NULL 的資料
+    return conn.execute(
+        sa.select(bookings.c.id, bookings.c.date, bookings.c.time, services.c.max_duration)
+        .select_from(bookings.outerjoin(services, services.c.id == bookings.c.service_id))
+        .where(bookings.c.start_at.is_(None), bookings.c.id > last_id)
+        .order_by(bookings.c.id)
+        .limit(limit)
+    ).all()
+
+
+def _apply_batch(conn, rows):
+    start_values, end_values = {}, {}
+    for row in rows:
+        parsed_time = _parse_time(row.time)
+        if row.date is None or parsed_time is None:
+            # 無法解析的舊資料保留 NULL，讀取時會退回使用 date/time
+            continue
+        start_at = datetime.combine(row.date.date(), parsed_time)
+        start_values[row.id] = start_at
+        end_values[row.id] = start_at + timedelta(minutes=row.max_duration or 0)
+
+    if not start_values:
+        return 0
+    # 每批只用一個 UPDATE 完成
+    conn.execute(
+        sa.update(bookings)
+        .where(bookings.c.id.in_(list(start_values)))
+        .values(
+            start_at=sa.case(start_values, value=bookings.c.id),
+            end_at=sa.case(end_values, value=bookings.c.id),
+        )
+    )
+    return len(start_values)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    add_column_if_missing('bookings', sa.Column('start_at', sa.DateTime(), nullable=True))
+    add_column_if_missing('bookings', sa.Column('end_at', sa.DateTime(), nullable=True))
+
+    with online_block() as conn:
+        run_batched(conn, "c3f1a9e0b2d4_booking_start_end_at", _fetch_batch, _apply_batch, batch_size=BATCH_SIZE)
+        create_index_concurrently('ix_bookings_owner_id_start_at', 'bookings', ['owner_id', 'start_at', 'end_at'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with online_block():
+        drop_index_concurrently('ix_bookings_owner_id_start_at', 'bookings')
+    op.drop_column('bookings', 'end_at')
+    op.drop_column('bookings', 'start_at')
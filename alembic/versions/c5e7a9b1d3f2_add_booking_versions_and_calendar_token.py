@@ -0,0 +1,38 @@
+"""Add per-owner booking versions and the calendar feed token
+
+Revision ID: c5e7a9b1d3f2
+Revises: b8d2f4a6c0e1
+Create Date: 2026-10-19 20:11:37.540912
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5e7a9b1d3f2'
+down_revision: Union[str, Sequence[str], None] = 'b8d2f4a6c0e1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 沒有版本列的店家視為版本 0，第一次寫入預約時建立
+    op.create_table('booking_versions',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('owner_id')
+    )
+    op.add_column('users', sa.Column('calendar_token', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('calendar_token')
+    op.drop_table('booking_versions')
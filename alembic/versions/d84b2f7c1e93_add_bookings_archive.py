@@ -0,0 +1,63 @@
+"""Add bookings_archive for old completed/cancelled bookings
+
+Revision ID: d84b2f7c1e93
+Revises: c3f1a9e0b2d4
+Create Date: 2026-10-19 13:40:05.502917
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd84b2f7c1e93'
+down_revision: Union[str, Sequence[str], None] = 'c3f1a9e0b2d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # PostgreSQL 上為依 start_at 每月分區的表，月分區由 archive.py 在搬移時建立
+    op.create_table(
+        'bookings_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('start_at', sa.DateTime(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('booking_reference_id', sa.String(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('service_id', sa.Integer(), nullable=True),
+        sa.Column('date', sa.DateTime(), nullable=True),
+        sa.Column('time', sa.String(), nullable=True),
+        sa.Column('end_at', sa.DateTime(), nullable=True),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('notes', sa.String(), nullable=True),
+        sa.Column('customer_name', sa.String(), nullable=True),
+        sa.Column('customer_email', sa.String(), nullable=True),
+        sa.Column('customer_phone', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('archived_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=True),
+        sa.PrimaryKeyConstraint('id', 'start_at'),
+        postgresql_partition_by='RANGE (start_at)',
+    )
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE TABLE IF NOT EXISTS bookings_archive_default PARTITION OF bookings_archive DEFAULT')
+    op.create_index('ix_bookings_archive_owner_id_start_at', 'bookings_archive', ['owner_id', 'start_at'], unique=False)
+    op.create_index(op.f('ix_bookings_archive_user_id'), 'bookings_archive', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # 先把封存資料搬回 bookings，避免降版時遺失
+    op.execute(
+        'INSERT INTO bookings (id, owner_id, booking_reference_id, user_id, service_id, date, time, start_at, end_at, '
+        'status, notes, customer_name, customer_email, customer_phone, created_at, updated_at) '
+        'SELECT id, owner_id, booking_reference_id, user_id, service_id, date, time, start_at, end_at, '
+        'status, notes, customer_name, customer_email, customer_phone, created_at, updated_at FROM bookings_archive'
+    )
+    op.drop_index(op.f('ix_bookings_archive_user_id'), table_name='bookings_archive')
+    op.drop_index('ix_bookings_archive_owner_id_start_at', table_name='bookings_archive')
+    op.drop_table('bookings_archive')
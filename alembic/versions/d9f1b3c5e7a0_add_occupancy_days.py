@@ -0,0 +1,35 @@
+"""Add per-owner per-day occupancy bitmaps
+
+Revision ID: d9f1b3c5e7a0
+Revises: c5e7a9b1d3f2
+Create Date: 2026-10-19 21:02:14.308126
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd9f1b3c5e7a0'
+down_revision: Union[str, Sequence[str], None] = 'c5e7a9b1d3f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 不需要回填：沒有列的日期在第一次使用時由 occupancy.py 從 bookings 計算
+    op.create_table('occupancy_days',
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('booked', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('owner_id', 'day')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('occupancy_days')
@@ -0,0 +1,46 @@
+"""Add the append-only booking status history
+
+Revision ID: e2a4c6e8f0b1
+Revises: d9f1b3c5e7a0
+Create Date: 2026-10-19 21:48:52.671043
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2a4c6e8f0b1'
+down_revision: Union[str, Sequence[str], None] = 'd9f1b3c5e7a0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 既有預約沒有歷史紀錄，從升級之後的變更開始記錄
+    op.create_table('booking_events',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_id', sa.String(length=32), nullable=False),
+        sa.Column('booking_id', sa.Integer(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('event_type', sa.String(), nullable=False),
+        sa.Column('from_status', sa.String(), nullable=True),
+        sa.Column('to_status', sa.String(), nullable=True),
+        sa.Column('actor_id', sa.Integer(), nullable=True),
+        sa.Column('source', sa.String(), nullable=False),
+        sa.Column('occurred_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('event_id')
+    )
+    op.create_index('ix_booking_events_booking_id_occurred_at', 'booking_events', ['booking_id', 'occurred_at'], unique=False)
+    op.create_index('ix_booking_events_owner_id_occurred_at', 'booking_events', ['owner_id', 'occurred_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_booking_events_owner_id_occurred_at', table_name='booking_events')
+    op.drop_index('ix_booking_events_booking_id_occurred_at', table_name='booking_events')
+    op.drop_table('booking_events')
@@ -0,0 +1,65 @@
+"""Add booking_series and bookings.series_id
+
+Revision ID: e5a7c2d9f481
+Revises: d84b2f7c1e93
+Create Date: 2026-10-19 15:12:41.220371
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a7c2d9f481'
+down_revision: Union[str, Sequence[str], None] = 'd84b2f7c1e93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'booking_series',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('service_id', sa.Integer(), nullable=True),
+        sa.Column('start_date', sa.DateTime(), nullable=False),
+        sa.Column('time', sa.String(), nullable=False),
+        sa.Column('interval_weeks', sa.Integer(), nullable=False),
+        sa.Column('occurrences', sa.Integer(), nullable=True),
+        sa.Column('end_date', sa.DateTime(), nullable=True),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('notes', sa.String(), nullable=True),
+        sa.Column('customer_name', sa.String(), nullable=True),
+        sa.Column('customer_email', sa.String(), nullable=True),
+        sa.Column('customer_phone', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['service_id'], ['services.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_booking_series_id'), 'booking_series', ['id'], unique=False)
+    op.create_index(op.f('ix_booking_series_owner_id'), 'booking_series', ['owner_id'], unique=False)
+    # 新欄位皆可為 NULL，既有資料不需要回填
+    with op.batch_alter_table('bookings') as batch_op:
+        batch_op.add_column(sa.Column('series_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_bookings_series_id'), ['series_id'], unique=False)
+        batch_op.create_foreign_key('fk_bookings_series_id_booking_series', 'booking_series', ['series_id'], ['id'])
+    op.add_column('bookings_archive', sa.Column('series_id', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('bookings_archive', 'series_id')
+    with op.batch_alter_table('bookings') as batch_op:
+        batch_op.drop_constraint('fk_bookings_series_id_booking_series', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_bookings_series_id'))
+        batch_op.drop_column('series_id')
+    op.drop_index(op.f('ix_booking_series_owner_id'), table_name='booking_series')
+    op.drop_index(op.f('ix_booking_series_id'), table_name='booking_series')
+    op.drop_table('booking_series')
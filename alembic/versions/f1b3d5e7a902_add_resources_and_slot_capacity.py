@@ -0,0 +1,88 @@
+"""Add resources, service_resources and per-slot resource capacity counters
+
+Revision ID: f1b3d5e7a902
+Revises: e5a7c2d9f481
+Create Date: 2026-10-19 16:04:27.913554
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1b3d5e7a902'
+down_revision: Union[str, Sequence[str], None] = 'e5a7c2d9f481'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'resources',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=True),
+        sa.Column('capacity', sa.Integer(), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['owner_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_resources_id'), 'resources', ['id'], unique=False)
+    op.create_index(op.f('ix_resources_owner_id'), 'resources', ['owner_id'], unique=False)
+    op.create_table(
+        'service_resources',
+        sa.Column('service_id', sa.Integer(), nullable=False),
+        sa.Column('resource_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['resource_id'], ['resources.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['service_id'], ['services.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('service_id', 'resource_id')
+    )
+    op.create_index(op.f('ix_service_resources_resource_id'), 'service_resources', ['resource_id'], unique=False)
+    op.create_table(
+        'resource_slots',
+        sa.Column('resource_id', sa.Integer(), nullable=False),
+        sa.Column('slot_start', sa.DateTime(), nullable=False),
+        sa.Column('owner_id', sa.Integer(), nullable=False),
+        sa.Column('booked', sa.Integer(), nullable=False),
+        sa.Column('capacity', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['resource_id'], ['resources.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('resource_id', 'slot_start')
+    )
+    op.create_index(op.f('ix_resource_slots_owner_id'), 'resource_slots', ['owner_id'], unique=False)
+    # 既有的預約與營業時間都沒有資源，新欄位為 NULL，不需要回填計數
+    with op.batch_alter_table('business_hours') as batch_op:
+        batch_op.add_column(sa.Column('resource_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_business_hours_resource_id'), ['resource_id'], unique=False)
+        batch_op.create_foreign_key('fk_business_hours_resource_id_resources', 'resources', ['resource_id'], ['id'], ondelete='CASCADE')
+    with op.batch_alter_table('bookings') as batch_op:
+        batch_op.add_column(sa.Column('resource_id', sa.Integer(), nullable=True))
+        batch_op.create_index('ix_bookings_resource_id_start_at', ['resource_id', 'start_at'], unique=False)
+        batch_op.create_foreign_key('fk_bookings_resource_id_resources', 'resources', ['resource_id'], ['id'])
+    op.add_column('bookings_archive', sa.Column('resource_id', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('bookings_archive', 'resource_id')
+    with op.batch_alter_table('bookings') as batch_op:
+        batch_op.drop_constraint('fk_bookings_resource_id_resources', type_='foreignkey')
+        batch_op.drop_index('ix_bookings_resource_id_start_at')
+        batch_op.drop_column('resource_id')
+    # 資源專屬的營業時間在降版後沒有意義
+    op.execute('DELETE FROM business_hours WHERE resource_id IS NOT NULL')
+    with op.batch_alter_table('business_hours') as batch_op:
+        batch_op.drop_constraint('fk_business_hours_resource_id_resources', type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_business_hours_resource_id'))
+        batch_op.drop_column('resource_id')
+    op.drop_index(op.f('ix_resource_slots_owner_id'), table_name='resource_slots')
+    op.drop_table('resource_slots')
+    op.drop_index(op.f('ix_service_resources_resource_id'), table_name='service_resources')
+    op.drop_table('service_resources')
+    op.drop_index(op.f('ix_resources_owner_id'), table_name='resources')
+    op.drop_index(op.f('ix_resources_id'), table_name='resources')
+    op.drop_table('resources')
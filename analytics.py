@@ -0,0 +1,293 @@
+import argparse
+import logging
+import time as timer
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import BigInteger, Integer, case, cast, func, select, union_all
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# 店家的營運分析：一次把需要的欄位讀成陣列 (服務、狀態代碼、開始與結束的 epoch 秒)，以 NumPy 向量運算彙總
+# 包含已封存的預約；結果依 (店家, 預約版本號, 期間) 快取，任何預約或營業設定的寫入都會讓快取過期
+STATUS_CODES = {"pending": 0, "confirmed": 1, "completed": 2, "cancelled": 3, "no_show": 4}
+OTHER_STATUS = len(STATUS_CODES)
+STATUS_COUNT = OTHER_STATUS + 1
+CANCELLED = STATUS_CODES["cancelled"]
+DEFAULT_DAYS = 365
+MAX_DAYS = 366 * 5
+FETCH_SIZE = 50000
+ANALYTICS_MAX_ENTRIES = 256
+DAY_SECONDS = 24 * 3600
+# 1970-01-01 是星期四，(epoch 日數 + 3) % 7 得到星期一為 0 的星期
+EPOCH_WEEKDAY_OFFSET = 3
+
+
+def _epoch(db: Session, column):
+    # 時間欄位是店家當地時間 (沒有時區)，換成 epoch 秒只是為了在陣列中計算
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return cast(func.extract("epoch", column), BigInteger)
+    if dialect == "sqlite":
+        return cast(func.strftime("%s", column), Integer)
+    raise NotImplementedError(f"Booking analytics is not supported on {dialect}")
+
+
+def _columns_query(db: Session, owner_id: int, start: datetime, end: datetime):
+    parts = []
+    for model in (models.Booking, models.BookingArchive):
+        parts.append(select(
+            func.coalesce(model.service_id, 0),
+            case(STATUS_CODES, value=model.status, else_=OTHER_STATUS),
+            _epoch(db, model.start_at),
+            _epoch(db, func.coalesce(model.end_at, model.start_at)),
+        ).where(model.owner_id == owner_id, model.start_at >= start, model.start_at < end))
+    return union_all(*parts)
+
+
+def load_columns(db: Session, owner_id: int, start: datetime, end: datetime) -> np.ndarray:
+    # 回傳 (n, 4) 的 int64 陣列：service_id、狀態代碼、開始、結束；每批 FETCH_SIZE 列直接轉成陣列
+    result = db.execute(_columns_query(db, owner_id, start, end).execution_options(yield_per=FETCH_SIZE))
+    chunks = [np.array([tuple(row) for row in partition], dtype=np.int64) for partition in result.partitions()]
+    if not chunks:
+        return np.empty((0, 4), dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def _open_minutes(business_hours) -> np.ndarray:
+    # (7, 24)：每個星期、每個小時的營業分鐘數；沒有設定營業時間的星期整天營業 (與 occupancy.py 相同)
+    minutes = np.ones((7, 24 * 60), dtype=bool)
+    configured = set()
+    for day_of_week, open_time, close_time, is_closed in business_hours:
+        weekday = (day_of_week - 1) % 7
+        if weekday not in configured:
+            minutes[weekday] = False
+            configured.add(weekday)
+        if is_closed:
+            continue
+        low = open_time.hour * 60 + open_time.minute
+        high = close_time.hour * 60 + close_time.minute if close_time != time.min else 24 * 60
+        minutes[weekday, low:high] = True
+    return minutes.reshape(7, 24, 60).sum(axis=2)
+
+
+def compute(columns: np.ndarray, start: date, end: date, business_hours, closed_dates, parallel: int, service_names: Dict[int, str]) -> dict:
+    service_ids, statuses, starts, ends = columns.T if len(columns) else (np.empty(0, np.int64),) * 4
+
+    # 熱圖與使用率不計已取消的預約 (no-show 仍佔用了時段)
+    active = statuses != CANCELLED
+    active_starts, active_ends = starts[active], ends[active]
+    start_cells = ((active_starts // DAY_SECONDS + EPOCH_WEEKDAY_OFFSET) % 7) * 24 + (active_starts % DAY_SECONDS) // 3600
+    booking_heatmap = np.bincount(start_cells, minlength=7 * 24).reshape(7, 24)
+
+    # 每筆預約依小時切段，第 k 次迴圈同時處理所有預約的第 k 個小時
+    booked = np.zeros(7 * 24)
+    first_hours = active_starts // 3600
+    spans = np.maximum(active_ends - 1, active_starts) // 3600 - first_hours + 1
+    for offset in range(int(spans.max()) if len(spans) else 0):
+        hours = first_hours + offset
+        overlap = np.minimum(active_ends, (hours + 1) * 3600) - np.maximum(active_starts, hours * 3600)
+        inside = overlap > 0
+        cells = ((hours[inside] // 24 + EPOCH_WEEKDAY_OFFSET) % 7) * 24 + hours[inside] % 24
+        booked += np.bincount(cells, weights=overlap[inside] / 60, minlength=7 * 24)
+    booked = booked.reshape(7, 24)
+
+    # 期間內每個星期的營業天數 (扣除公休日與不可預約日) × 每小時營業分鐘數 × 可同時服務的數量
+    day_numbers = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D")).astype(np.int64)
+    closed = np.array([np.datetime64(day, "D") for day in closed_dates], dtype="datetime64[D]").astype(np.int64)
+    open_days = day_numbers[~np.isin(day_numbers, closed)]
+    open_day_counts = np.bincount((open_days + EPOCH_WEEKDAY_OFFSET) % 7, minlength=7)
+    capacity = open_day_counts[:, None] * _open_minutes(business_hours) * parallel
+    utilization = np.divide(booked, capacity, out=np.full(booked.shape, np.nan), where=capacity > 0)
+    total_capacity = capacity.sum()
+
+    # 每個服務各狀態的筆數：服務 id 先編成連續的索引，再以一次 bincount 計算
+    services, index = np.unique(service_ids, return_inverse=True)
+    counts = np.bincount(index * STATUS_COUNT + statuses, minlength=len(services) * STATUS_COUNT).reshape(len(services), STATUS_COUNT)
+    service_rows = []
+    for service_id, row in zip(services.tolist(), counts.tolist()):
+        total = sum(row)
+        completed, cancelled, no_show = row[STATUS_CODES["completed"]], row[CANCELLED], row[STATUS_CODES["no_show"]]
+        service_rows.append({
+            "service_id": service_id,
+            "name": service_names.get(service_id),
+            "bookings": total,
+            "completed": completed,
+            "cancelled": cancelled,
+            "no_show": no_show,
+            "cancellation_rate": cancelled / total if total else None,
+            # 只以已到預約時間 (完成或未到) 的預約為分母
+            "no_show_rate": no_show / (completed + no_show) if completed + no_show else None,
+        })
+
+    return {
+        "start": start,
+        "end": end,
+        "total_bookings": int(len(columns)),
+        "booking_heatmap": booking_heatmap.tolist(),
+        "booked_minutes": booked.round(1).tolist(),
+        "capacity_minutes": capacity.astype(float).tolist(),
+        "utilization": [[None if np.isnan(value) else round(float(value), 4) for value in row] for row in utilization],
+        "overall_utilization": round(float(booked.sum() / total_capacity), 4) if total_capacity else None,
+        "services": service_rows,
+    }
+
+
+def compute_rows(columns, start: date, end: date, business_hours, closed_dates, parallel: int, service_names: Dict[int, str]) -> dict:
+    # 逐筆計算的版本，只用於基準測試的比較與驗證結果
+    booking_heatmap = [[0] * 24 for _ in range(7)]
+    booked = [[0.0] * 24 for _ in range(7)]
+    per_service: Dict[int, List[int]] = {}
+    for service_id, status_code, start_at, end_at in columns:
+        per_service.setdefault(service_id, [0] * STATUS_COUNT)[status_code] += 1
+        if status_code == CANCELLED:
+            continue
+        moment = datetime.utcfromtimestamp(start_at)
+        booking_heatmap[moment.weekday()][moment.hour] += 1
+        cursor = start_at
+        while cursor < end_at:
+            hour_end = min(end_at, (cursor // 3600 + 1) * 3600)
+            moment = datetime.utcfromtimestamp(cursor)
+            booked[moment.weekday()][moment.hour] += (hour_end - cursor) / 60
+            cursor = hour_end
+    result = compute(np.empty((0, 4), dtype=np.int64), start, end, business_hours, closed_dates, parallel, service_names)
+    capacity = result["capacity_minutes"]
+    result.update(
+        total_bookings=sum(sum(row) for row in per_service.values()),
+        booking_heatmap=booking_heatmap,
+        booked_minutes=[[round(value, 1) for value in row] for row in booked],
+        utilization=[[round(booked[day][hour] / capacity[day][hour], 4) if capacity[day][hour] else None for hour in range(24)] for day in range(7)],
+        overall_utilization=round(sum(map(sum, booked)) / sum(map(sum, capacity)), 4) if sum(map(sum, capacity)) else None,
+        services=[
+            {
+                "service_id": service_id, "name": service_names.get(service_id), "bookings": sum(row),
+                "completed": row[STATUS_CODES["completed"]], "cancelled": row[CANCELLED], "no_show": row[STATUS_CODES["no_show"]],
+                "cancellation_rate": row[CANCELLED] / sum(row),
+                "no_show_rate": row[STATUS_CODES["no_show"]] / (row[STATUS_CODES["completed"]] + row[STATUS_CODES["no_show"]]) if row[STATUS_CODES["completed"]] + row[STATUS_CODES["no_show"]] else None,
+            }
+            for service_id, row in sorted(per_service.items())
+        ],
+    )
+    return result
+
+
+def _settings(db: Session, owner_id: int, start: date, end: date):
+    business_hours = db.query(
+        models.BusinessHour.day_of_week, models.BusinessHour.open_time, models.BusinessHour.close_time, models.BusinessHour.is_closed
+    ).filter(models.BusinessHour.owner_id == owner_id, models.BusinessHour.resource_id.is_(None)).all()
+    low, high = datetime.combine(start, time.min), datetime.combine(end, time.min)
+    holidays = select(models.Holiday.date).where(models.Holiday.owner_id == owner_id, models.Holiday.date >= low, models.Holiday.date < high)
+    unavailable = select(models.UnavailableDate.date).where(models.UnavailableDate.owner_id == owner_id, models.UnavailableDate.date >= low, models.UnavailableDate.date < high)
+    closed_dates = {value.date() if isinstance(value, datetime) else value for value in db.execute(union_all(holidays, unavailable)).scalars()}
+    service_names = dict(db.query(models.Service.id, models.Service.name).filter(models.Service.owner_id == owner_id).all())
+    return business_hours, closed_dates, service_names
+
+
+def parallel_capacity(db: Session, owner_id: int) -> int:
+    # 同一時段可同時服務的數量：啟用中資源的容量總和，沒有設定資源時為 1
+    total = db.query(func.coalesce(func.sum(models.Resource.capacity), 0)).filter(
+        models.Resource.owner_id == owner_id, models.Resource.is_active == True
+    ).scalar()
+    return max(1, int(total or 0))
+
+
+def owner_analytics(db: Session, owner_id: int, start: date, end: date, parallel: Optional[int] = None) -> dict:
+    parallel = parallel_capacity(db, owner_id) if parallel is None else parallel
+    business_hours, closed_dates, service_names = _settings(db, owner_id, start, end)
+    columns = load_columns(db, owner_id, datetime.combine(start, time.min), datetime.combine(end, time.min))
+    return compute(columns, start, end, business_hours, closed_dates, parallel, service_names)
+
+
+class AnalyticsCache:
+    def __init__(self, max_entries: int = ANALYTICS_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._results: "OrderedDict[Tuple, dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, db: Session, owner_id: int, version: int, start: date, end: date) -> dict:
+        # 資源容量的變更不會遞增預約版本號，因此也列入 key
+        parallel = parallel_capacity(db, owner_id)
+        key = (owner_id, version, start, end, parallel)
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = owner_analytics(db, owner_id, start, end, parallel)
+        # 同一個店家的舊版本不會再被使用
+        for stale in [existing for existing in self._results if existing[0] == owner_id and existing[1] != version]:
+            del self._results[stale]
+        self._results[key] = result
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        return result
+
+
+analytics_cache = AnalyticsCache()
+
+
+def default_range(start: Optional[date], end: Optional[date]) -> Tuple[date, date]:
+    # 預設為到今天 (含) 為止的一年；end 不含
+    end = end or date.today() + timedelta(days=1)
+    start = start or end - timedelta(days=DEFAULT_DAYS)
+    return start, end
+
+
+def _benchmark(db: Session, owner_id: Optional[int], start: date, end: date, repeat: int):
+    if owner_id is None:
+        owner_id = db.query(models.Booking.owner_id).group_by(models.Booking.owner_id).order_by(func.count().desc()).limit(1).scalar()
+    parallel = parallel_capacity(db, owner_id)
+    business_hours, closed_dates, service_names = _settings(db, owner_id, start, end)
+
+    began = timer.perf_counter()
+    columns = load_columns(db, owner_id, datetime.combine(start, time.min), datetime.combine(end, time.min))
+    loaded = timer.perf_counter() - began
+    print(f"owner {owner_id}: {len(columns)} bookings from {start} to {end}")
+    print(f"load columns      {loaded:8.3f}s")
+
+    timings = []
+    for _ in range(repeat):
+        began = timer.perf_counter()
+        vectorized = compute(columns, start, end, business_hours, closed_dates, parallel, service_names)
+        timings.append(timer.perf_counter() - began)
+    print(f"numpy aggregate   {min(timings):8.3f}s (best of {repeat})")
+
+    rows = columns.tolist()
+    began = timer.perf_counter()
+    row_by_row = compute_rows(rows, start, end, business_hours, closed_dates, parallel, service_names)
+    print(f"row-by-row python {timer.perf_counter() - began:8.3f}s")
+    print("results match" if vectorized == row_by_row else "RESULTS DIFFER")
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Benchmark the owner analytics aggregation (generate data with python synthetic_data.py --tenants 1 --bookings 1000000)")
+    parser.add_argument("--owner-id", type=int, default=None, help="defaults to the owner with the most bookings")
+    parser.add_argument("--start", type=date.fromisoformat, default=None)
+    parser.add_argument("--end", type=date.fromisoformat, default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        start, end = args.start, args.end
+        if start is None and end is None:
+            # 合成資料的期間不一定包含今天，預設涵蓋所有預約
+            start, end = (value.date() for value in db.query(func.min(models.Booking.start_at), func.max(models.Booking.start_at)).one())
+            end += timedelta(days=1)
+        start, end = default_range(start, end)
+        _benchmark(db, args.owner_id, start, end, args.repeat)
+    finally:
+        db.close()
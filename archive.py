@@ -0,0 +1,98 @@
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# 超過這個天數、且已完成、已取消或客人未到的預約會從 bookings 搬到 bookings_archive
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVABLE_STATUSES = ("completed", "cancelled", "no_show")
+ARCHIVE_BATCH_SIZE = 1000
+
+bookings_table = models.Booking.__table__
+archive_table = models.BookingArchive.__table__
+# 兩張表共有的欄位，日後 bookings 新增欄位時只搬移封存表也有的欄位
+ARCHIVED_COLUMNS = [column.name for column in bookings_table.columns if column.name in archive_table.columns]
+
+
+def _month_start(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _next_month(value: date) -> date:
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def ensure_default_partition(db: Session):
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    db.execute(text(f"CREATE TABLE IF NOT EXISTS {archive_table.name}_default PARTITION OF {archive_table.name} DEFAULT"))
+
+
+def ensure_monthly_partitions(db: Session, start: datetime, end: datetime):
+    # 只有 PostgreSQL 使用分區，其他資料庫的封存表就是一般的表
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    month = _month_start(start)
+    while month <= end.date():
+        following = _next_month(month)
+        partition = f"{archive_table.name}_y{month.year}m{month.month:02d}"
+        db.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {archive_table.name} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+        ))
+        month = following
+
+
+def archive_old_bookings(db: Session, cutoff: Optional[datetime] = None, batch_size: int = ARCHIVE_BATCH_SIZE, max_batches: Optional[int] = None) -> int:
+    # 分批搬移：每批在同一個交易中 INSERT ... SELECT 再 DELETE，然後提交
+    if cutoff is None:
+        cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    moved = 0
+    batches = 0
+    ensure_default_partition(db)
+    while max_batches is None or batches < max_batches:
+        rows = db.execute(
+            select(models.Booking.id, models.Booking.start_at)
+            .where(models.Booking.start_at < cutoff, models.Booking.status.in_(ARCHIVABLE_STATUSES))
+            .order_by(models.Booking.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        ids = [row.id for row in rows]
+        ensure_monthly_partitions(db, min(row.start_at for row in rows), max(row.start_at for row in rows))
+        source_columns = [bookings_table.c[name] for name in ARCHIVED_COLUMNS]
+        db.execute(
+            insert(archive_table).from_select(ARCHIVED_COLUMNS, select(*source_columns).where(bookings_table.c.id.in_(ids)))
+        )
+        db.execute(delete(bookings_table).where(bookings_table.c.id.in_(ids)))
+        db.commit()
+        moved += len(ids)
+        batches += 1
+        logger.info("Archived %d bookings (%d total)", len(ids), moved)
+    return moved
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Move old completed/cancelled bookings into bookings_archive")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        total = archive_old_bookings(db, datetime.utcnow() - timedelta(days=args.days), args.batch_size)
+        print(f"Archived {total} bookings")
+    finally:
+        db.close()
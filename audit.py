@@ -0,0 +1,299 @@
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+import metrics
+import models
+
+logger = logging.getLogger(__name__)
+
+# 預約狀態機：pending → confirmed → completed，結束前都可以取消；completed、cancelled 與 no_show 不能再變更
+# 結束時間已過仍為 pending 的預約由排程直接標記為 completed，因此 completed 仍可以改為 no_show (客人未到)
+BOOKING_STATUS_TRANSITIONS = {
+    "pending": {"confirmed", "cancelled", "completed", "no_show"},
+    "confirmed": {"completed", "cancelled", "no_show"},
+    "completed": {"no_show"},
+    "cancelled": set(),
+    "no_show": set(),
+}
+INITIAL_BOOKING_STATUSES = ("pending", "confirmed")
+
+# 狀態變更紀錄先附加到本機的 spool 檔 (程序當掉時不會遺失)，再放進記憶體緩衝區由背景執行緒批次寫入資料庫
+# 每筆紀錄有唯一的 event_id，重送 (例如重啟後從 spool 檔恢復) 時重複的紀錄會被忽略
+AUDIT_DIR = os.environ.get("SIDEP_AUDIT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit_spool"))
+AUDIT_BUFFER_SIZE = int(os.environ.get("SIDEP_AUDIT_BUFFER_SIZE", "10000"))
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_SECONDS = float(os.environ.get("SIDEP_AUDIT_FLUSH_SECONDS", "1.0"))
+# 預設只寫入作業系統 (程序當掉不會遺失)；設為 1 時每次附加都 fsync (主機斷電也不會遺失)
+AUDIT_FSYNC = os.environ.get("SIDEP_AUDIT_FSYNC", "0") == "1"
+
+audit_events_total = metrics.registry.counter(
+    "sidep_audit_events_total",
+    "Booking audit events by result; recorded (spooled and buffered), written (inserted in a batch) or overflow (buffer full, written by the caller)",
+    ("result",),
+)
+audit_flush_failures_total = metrics.registry.counter("sidep_audit_flush_failures_total", "Failed audit batch writes; the batch is retried from the buffer or the spool")
+audit_buffered = metrics.registry.gauge("sidep_audit_buffered", "Audit events waiting to be written")
+
+
+def transition_allowed(old_status: Optional[str], new_status: str) -> bool:
+    # 不在狀態機中的舊資料可以改成任何已知的狀態
+    if new_status not in BOOKING_STATUS_TRANSITIONS:
+        return False
+    if old_status == new_status:
+        return True
+    return new_status in BOOKING_STATUS_TRANSITIONS.get(old_status, BOOKING_STATUS_TRANSITIONS.keys())
+
+
+def actor(user: Optional[models.User]) -> dict:
+    if user is None:
+        return {"actor_id": None, "source": "public"}
+    return {"actor_id": user.id, "source": "admin" if user.role == "admin" else "customer"}
+
+
+SYSTEM_ACTOR = {"actor_id": None, "source": "system"}
+
+
+def booking_event(booking, event_type: str, from_status: Optional[str], to_status: Optional[str], actor_id: Optional[int], source: str) -> dict:
+    # booking 可以是 ORM 物件或含 id、owner_id 的查詢結果列
+    return {
+        "event_id": uuid.uuid4().hex,
+        "booking_id": booking.id,
+        "owner_id": booking.owner_id,
+        "event_type": event_type,
+        "from_status": from_status,
+        "to_status": to_status,
+        "actor_id": actor_id,
+        "source": source,
+        "occurred_at": datetime.utcnow().isoformat(),
+    }
+
+
+def _row(entry: dict) -> dict:
+    return {**entry, "occurred_at": datetime.fromisoformat(entry["occurred_at"])}
+
+
+def _insert_ignoring_duplicates(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Audit insert is not supported on {dialect}")
+    return insert(models.BookingEvent.__table__).on_conflict_do_nothing(index_elements=["event_id"])
+
+
+class AuditLog:
+    def __init__(self, spool_dir: str = AUDIT_DIR, buffer_size: int = AUDIT_BUFFER_SIZE, batch_size: int = AUDIT_BATCH_SIZE,
+                 flush_seconds: float = AUDIT_FLUSH_SECONDS, fsync: bool = AUDIT_FSYNC):
+        self.spool_dir = spool_dir
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.fsync = fsync
+        self._session_factory: Optional[Callable[[], Session]] = None
+        # _lock 保護緩衝區與目前的 spool 檔；_flush_lock 讓同一時間只有一個批次在寫入
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer: List[dict] = []
+        self._spool = None
+        self._sequence = 0
+        self._sealed: List[str] = []
+        # 記憶體中的紀錄曾因資料庫無法寫入而被丟棄 (仍在 spool 檔中)，下次寫入成功後從 spool 檔重送
+        self._spilled = False
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def start(self, session_factory: Callable[[], Session]):
+        self._session_factory = session_factory
+        os.makedirs(self.spool_dir, exist_ok=True)
+        # 先重送已結束的程序 (當掉或未正常關閉) 留下的 spool 檔；其他執行中的 worker 的檔案有檔案鎖，會被略過
+        self._replay(self._orphaned_segments())
+        with self._lock:
+            self._open_segment()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="booking-audit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+        with self._lock:
+            if not self._buffer and not self._sealed and self._spool is not None:
+                # 所有紀錄都已寫入，目前的 spool 檔可以刪除
+                path = self._spool.name
+                self._spool.close()
+                self._spool = None
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def record(self, entries: Iterable[dict]):
+        # 必須在預約的交易 commit 之後呼叫，只記錄真的發生的狀態變更
+        entries = list(entries)
+        if not entries:
+            return
+        if self._thread is None:
+            # 沒有啟動背景執行緒時 (例如單獨執行的腳本) 直接同步寫入
+            self._write(entries)
+            return
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with self._lock:
+            self._spool.write(lines)
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._buffer.extend(entries)
+            buffered = len(self._buffer)
+        audit_events_total.inc(len(entries), result="recorded")
+        if buffered >= self.buffer_size:
+            # 緩衝區已滿：由呼叫者同步寫入，不丟棄紀錄也不讓緩衝區無限成長
+            audit_events_total.inc(len(entries), result="overflow")
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Audit flush failed while the buffer is full; events remain in the spool")
+        elif buffered >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        # 封存目前的 spool 檔並取出緩衝區中的紀錄 (兩者對應相同的紀錄)，寫入成功後才刪除封存的檔案
+        with self._flush_lock:
+            with self._lock:
+                entries, self._buffer = self._buffer, []
+                if entries:
+                    self._seal_segment()
+                sealed = list(self._sealed)
+                spilled = self._spilled
+            if not entries and not spilled:
+                return 0
+            try:
+                # 封存的檔案包含所有尚未寫入的紀錄 (也包含這次取出的紀錄)
+                written = self._replay(sealed) if spilled else self._write(entries)
+            except Exception:
+                audit_flush_failures_total.inc()
+                with self._lock:
+                    if len(self._buffer) + len(entries) <= self.buffer_size:
+                        self._buffer[:0] = entries
+                    else:
+                        # 資料庫長時間無法寫入：記憶體只保留上限內的紀錄，其餘留在 spool 檔中之後重送
+                        self._spilled = True
+                    audit_buffered.set(len(self._buffer))
+                raise
+            with self._lock:
+                self._sealed = [path for path in self._sealed if path not in sealed]
+                if spilled:
+                    self._spilled = False
+                audit_buffered.set(len(self._buffer))
+            for path in sealed:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            return written
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Audit flush failed; retrying in %ss", self.flush_seconds)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Audit flush failed during shutdown; events remain in the spool")
+
+    def _write(self, entries: List[dict]) -> int:
+        if not entries:
+            return 0
+        if self._session_factory is None:
+            from database import SessionLocal
+            self._session_factory = SessionLocal
+        import sharding
+        db = self._session_factory()
+        try:
+            # 紀錄寫入店家所在的分片；搬移中的店家稍後重試 (留在緩衝區與 spool 檔)，切換後寫入新的分片
+            by_shard = {}
+            for entry in entries:
+                shard_name, state = sharding.directory.placement(db, entry["owner_id"])
+                if state == sharding.MOVING:
+                    raise RuntimeError(f"Owner {entry['owner_id']} is being moved to another shard")
+                by_shard.setdefault(shard_name, []).append(entry)
+            for shard_name, shard_entries in by_shard.items():
+                sharding.use_shard(db, shard_name)
+                for offset in range(0, len(shard_entries), self.batch_size):
+                    db.execute(_insert_ignoring_duplicates(db), [_row(entry) for entry in shard_entries[offset:offset + self.batch_size]])
+            db.commit()
+        finally:
+            db.close()
+        audit_events_total.inc(len(entries), result="written")
+        return len(entries)
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.spool_dir, f"{os.getpid()}-{self._sequence}.open.jsonl")
+        spool = open(path, "a", encoding="utf-8")
+        # 持有檔案鎖表示這個檔案還在使用中，其他 worker 啟動時不會重送它
+        fcntl.flock(spool.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._spool = spool
+
+    def _seal_segment(self):
+        path = self._spool.name
+        sealed = path.replace(".open.jsonl", ".sealed.jsonl")
+        self._spool.close()
+        os.rename(path, sealed)
+        self._sealed.append(sealed)
+        self._open_segment()
+
+    def _orphaned_segments(self) -> List[str]:
+        orphaned = []
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "*.jsonl"))):
+            with open(path, "a") as handle:
+                try:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            orphaned.append(path)
+        return orphaned
+
+    def _replay(self, paths: List[str]) -> int:
+        replayed = 0
+        for path in paths:
+            try:
+                with open(path, encoding="utf-8") as handle:
+                    lines = handle.readlines()
+            except FileNotFoundError:
+                continue
+            entries = []
+            for line in lines:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # 程序當掉時最後一行可能只寫了一半，這筆紀錄的交易結果無法確認
+                    logger.warning("Skipping a truncated audit entry in %s", path)
+            replayed += self._write(entries)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        if replayed:
+            logger.info("Replayed %d audit events from the spool", replayed)
+        return replayed
+
+
+audit_log = AuditLog()
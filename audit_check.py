@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+from typing import List
+
+# 預約狀態紀錄寫入失敗時 (資料庫或 spool 暫時無法寫入)，GET /bookings/{id}/history 仍回傳已經寫入的紀錄，不會變成 500；
+# 恢復後緩衝區中的紀錄會再寫入。在暫存的 SQLite 上以 TestClient 執行；有錯誤時以非 0 結束，可放進 CI
+#   python audit_check.py
+
+
+class FlushFailure(Exception):
+    pass
+
+
+def run(workdir: str) -> List[str]:
+    # 必須在匯入 main 之前設定；背景執行緒不會在檢查期間自行寫入緩衝區
+    os.environ["SIDEP_DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "audit_check.db")
+    os.environ["SIDEP_AUDIT_DIR"] = os.path.join(workdir, "audit")
+    os.environ["SIDEP_AUDIT_FLUSH_SECONDS"] = "3600"
+    os.environ["SIDEP_SCHEDULER_ENABLED"] = "0"
+    from fastapi.testclient import TestClient
+
+    import main
+    from audit import audit_log
+
+    errors = []
+    with TestClient(main.app, raise_server_exceptions=False) as client:
+        client.post("/auth/register", json={"email": "audit-check@example.com", "name": "Owner", "password": "secret1", "role": "admin"}).raise_for_status()
+        token = client.post("/auth/login", json={"email": "audit-check@example.com", "password": "secret1"}).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        slug = client.get("/users/me", headers=headers).json()["public_slug"]
+        service_id = client.post("/services/", json={"name": "Cut", "price": 100, "min_duration": 30, "max_duration": 60}, headers=headers).json()["id"]
+        booking = client.post("/bookings/", json={
+            "service_id": service_id, "date": str(date.today() + timedelta(days=3)), "time": "10:00", "public_slug": slug,
+            "customer_name": "Client", "customer_email": "client@example.com", "customer_phone": "0900000000",
+        })
+        booking.raise_for_status()
+        booking_id = booking.json()["id"]
+        history_url = f"/bookings/{booking_id}/history"
+
+        # 建立預約的紀錄在這次讀取時寫入
+        written = client.get(history_url, headers=headers).json()
+        client.put(f"/bookings/{booking_id}/status", params={"status": "confirmed"}, headers=headers).raise_for_status()
+
+        def failing_write(entries):
+            raise FlushFailure("audit storage is unavailable")
+
+        audit_log._write = failing_write
+        try:
+            response = client.get(history_url, headers=headers)
+        finally:
+            del audit_log._write
+        if response.status_code != 200:
+            errors.append(f"GET {history_url} returned {response.status_code} while the audit flush failed")
+        elif response.json() != written:
+            errors.append(f"expected the {len(written)} events already written while the flush failed, got {len(response.json())}")
+        if len(audit_log) != 1:
+            errors.append(f"{len(audit_log)} events buffered after the failed flush, expected the status change to stay buffered")
+
+        recovered = client.get(history_url, headers=headers).json()
+        if [event["to_status"] for event in recovered][-1:] != ["confirmed"]:
+            errors.append("the buffered status change was not written after the flush recovered")
+        print(f"history while failing: {response.status_code}, {len(written)} events; after recovery: {len(recovered)} events")
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that booking history stays readable while audit flushes fail")
+    parser.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        errors = run(workdir)
+    for error in errors:
+        print(f"FAIL: {error}")
+    print("passed" if not errors else f"{len(errors)} failed")
+    sys.exit(1 if errors else 0)
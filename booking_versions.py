@@ -0,0 +1,38 @@
+from datetime import datetime
+from typing import Iterable
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+# 每個店家的預約版本號：建立、修改、取消、刪除預約 (以及修改服務名稱、營業時間與公休日) 時遞增
+# 版本號與寫入在同一個交易中提交，讀取端只要比對版本號就知道快取是否過期，不需要查詢 bookings
+# 遞增時會鎖住該店家的版本列直到提交，應盡量在交易的最後才呼叫
+
+
+def _increment(db: Session, owner_id: int, now: datetime) -> int:
+    result = db.execute(
+        update(models.BookingVersion)
+        .where(models.BookingVersion.owner_id == owner_id)
+        .values(version=models.BookingVersion.version + 1, changed_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def bump(db: Session, owner_ids: Iterable[int]):
+    now = datetime.utcnow()
+    for owner_id in sorted(set(owner_ids)):
+        if _increment(db, owner_id, now):
+            continue
+        # 第一次寫入的店家還沒有版本列
+        try:
+            with db.begin_nested():
+                db.add(models.BookingVersion(owner_id=owner_id, version=1, changed_at=now))
+                db.flush()
+        except IntegrityError:
+            # 並行的交易剛建立了版本列
+            _increment(db, owner_id, now)
+
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, load_only
+
+import models
+
+# iCalendar 訂閱 (RFC 5545)：Google / Apple 行事曆每隔幾分鐘輪詢一次
+# 輸出的內容只取決於店家的預約版本號，版本號不變時直接回傳 304 或快取的內容
+FEED_PAST_DAYS = 90
+FEED_MAX_ENTRIES = 1000
+FETCH_BATCH_SIZE = 500
+PRODID = "-//sidep//booking calendar//ZH"
+FEED_STATUSES = {"pending": "TENTATIVE", "confirmed": "CONFIRMED", "completed": "CONFIRMED"}
+
+
+def _escape(value: Optional[str]) -> str:
+    return (value or "").replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\r\n", "\\n").replace("\n", "\\n")
+
+
+def _fold(line: str) -> str:
+    # 每行最多 75 個位元組，續行以空白開頭；不可切在 UTF-8 多位元組字元中間
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts = []
+    current = b""
+    limit = 75
+    for char in line:
+        piece = char.encode()
+        if len(current) + len(piece) > limit:
+            parts.append(current.decode())
+            current = b""
+            limit = 74
+        current += piece
+    parts.append(current.decode())
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _format_local(value: datetime) -> str:
+    # 預約時間是店家當地時間，以 floating time 輸出
+    return value.strftime("%Y%m%dT%H%M%S")
+
+
+def _format_utc(value: datetime) -> str:
+    return value.strftime("%Y%m%dT%H%M%SZ")
+
+
+def render_event(booking: models.Booking, service_name: Optional[str], client_name: Optional[str]) -> str:
+    summary = f"{service_name} - {client_name}" if client_name else (service_name or "Booking")
+    description = "\n".join(part for part in (booking.booking_reference_id, booking.customer_phone, booking.notes) if part)
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:booking-{booking.id}@sidep",
+        f"DTSTAMP:{_format_utc(booking.updated_at or booking.created_at or datetime.utcnow())}",
+        f"DTSTART:{_format_local(booking.start_at)}",
+        f"DTEND:{_format_local(booking.end_at or booking.start_at)}",
+        f"SUMMARY:{_escape(summary)}",
+        f"STATUS:{FEED_STATUSES.get(booking.status, 'CONFIRMED')}",
+    ]
+    if description:
+        lines.append(f"DESCRIPTION:{_escape(description)}")
+    lines.append("END:VEVENT")
+    return "".join(_fold(line) for line in lines)
+
+
+class _Feed:
+    __slots__ = ("version", "body", "events")
+
+    def __init__(self):
+        self.version = -1
+        self.body = b""
+        # booking id -> ((updated_at, service_name), 已輸出的 VEVENT)
+        self.events: Dict[int, Tuple[tuple, str]] = {}
+
+
+class CalendarFeedCache:
+    # 每個店家保存最後一次產生的內容與各預約的 VEVENT；版本號改變時只重新產生有變動的預約
+    def __init__(self, max_entries: int = FEED_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._feeds: "OrderedDict[int, _Feed]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._feeds)
+
+    def get(self, db: Session, owner: models.User, version: int) -> bytes:
+        feed = self._feeds.get(owner.id)
+        if feed is not None and feed.version == version:
+            self._feeds.move_to_end(owner.id)
+            self.hits += 1
+            return feed.body
+        self.misses += 1
+        if feed is None:
+            feed = self._feeds[owner.id] = _Feed()
+            while len(self._feeds) > self.max_entries:
+                self._feeds.popitem(last=False)
+        self._rebuild(db, owner, feed)
+        feed.version = version
+        return feed.body
+
+    def _rebuild(self, db: Session, owner: models.User, feed: _Feed):
+        # 先只取出 id、更新時間與服務，和快取比對後才載入有變動的預約
+        since = datetime.now() - timedelta(days=FEED_PAST_DAYS)
+        rows = db.query(models.Booking.id, models.Booking.updated_at, models.Booking.service_id).filter(
+            models.Booking.owner_id == owner.id,
+            models.Booking.start_at >= since,
+            models.Booking.status.in_(tuple(FEED_STATUSES)),
+        ).order_by(models.Booking.start_at, models.Booking.id).all()
+        service_names = dict(db.query(models.Service.id, models.Service.name).filter(models.Service.owner_id == owner.id).all())
+        keys = {booking_id: (updated_at, service_names.get(service_id)) for booking_id, updated_at, service_id in rows}
+        changed = [booking_id for booking_id, key in keys.items() if feed.events.get(booking_id, (None,))[0] != key]
+
+        unchanged = keys.keys() - set(changed)
+        events = {booking_id: feed.events[booking_id] for booking_id in unchanged}
+        for offset in range(0, len(changed), FETCH_BATCH_SIZE):
+            batch = db.query(models.Booking).options(load_only(
+                models.Booking.id, models.Booking.user_id, models.Booking.service_id, models.Booking.booking_reference_id,
+                models.Booking.start_at, models.Booking.end_at, models.Booking.status, models.Booking.notes,
+                models.Booking.customer_name, models.Booking.customer_phone, models.Booking.created_at, models.Booking.updated_at,
+            )).filter(models.Booking.id.in_(changed[offset:offset + FETCH_BATCH_SIZE])).all()
+            user_ids = {booking.user_id for booking in batch if booking.user_id}
+            user_names = dict(db.query(models.User.id, models.User.name).filter(models.User.id.in_(user_ids)).all()) if user_ids else {}
+            for booking in batch:
+                client_name = user_names.get(booking.user_id) if booking.user_id else booking.customer_name
+                events[booking.id] = (keys[booking.id], render_event(booking, service_names.get(booking.service_id), client_name))
+
+        feed.events = events
+        chunks: List[str] = [
+            "BEGIN:VCALENDAR\r\n",
+            "VERSION:2.0\r\n",
+            _fold(f"PRODID:{PRODID}"),
+            "CALSCALE:GREGORIAN\r\n",
+            "METHOD:PUBLISH\r\n",
+            _fold(f"X-WR-CALNAME:{_escape(owner.name)}"),
+        ]
+        chunks.extend(events[booking_id][1] for booking_id, _, _ in rows)
+        chunks.append("END:VCALENDAR\r\n")
+        feed.body = "".join(chunks).encode()
+
+
+def feed_etag(owner_id: int, version: int) -> str:
+    # 輸出的時間範圍會隨日期移動，不同 worker 產生的內容可能有些微差異，因此使用弱 ETag
+    return f'W/"{owner_id}-{version}"'
+
+
+def not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], etag: str, last_modified: Optional[datetime]) -> bool:
+    # 有 If-None-Match 時忽略 If-Modified-Since (RFC 9110 13.2.2)
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    return last_modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+
+def http_date(value: datetime) -> str:
+    # changed_at 以 UTC 儲存
+    return format_datetime(value.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+calendar_feed_cache = CalendarFeedCache()
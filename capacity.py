@@ -0,0 +1,229 @@
+import argparse
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# 每個資源的時間以 15 分鐘為一格，每格一筆計數 (booked / capacity)
+SLOT_MINUTES = 15
+SLOT_DELTA = timedelta(minutes=SLOT_MINUTES)
+# 不佔用資源的預約狀態
+RELEASED_STATUSES = ("cancelled",)
+
+slots_table = models.ResourceSlot.__table__
+
+
+class _SlotsFull(Exception):
+    pass
+
+
+def _floor_slot(value: datetime) -> datetime:
+    return value.replace(minute=value.minute - value.minute % SLOT_MINUTES, second=0, microsecond=0)
+
+
+def slot_starts(start_at: datetime, end_at: datetime) -> List[datetime]:
+    # 預約所覆蓋的每一格 (開始時間向下取整、結束時間向上取整)
+    slots = []
+    current = _floor_slot(start_at)
+    while current < end_at:
+        slots.append(current)
+        current += SLOT_DELTA
+    return slots
+
+
+def _insert_missing_slots(db: Session):
+    # 尚未有人預約過的格子先以 booked=0 建立，已存在的略過
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Resource slot upsert is not supported on {dialect}")
+    return insert(slots_table).on_conflict_do_nothing(index_elements=["resource_id", "slot_start"])
+
+
+def service_uses_resources(db: Session, service_id: int) -> bool:
+    # 尚未設定資源的服務維持原本「同一時段只能有一筆預約」的規則
+    return db.execute(
+        select(models.service_resources.c.resource_id).where(models.service_resources.c.service_id == service_id).limit(1)
+    ).first() is not None
+
+
+def _working_resource_ids(db: Session, resource_ids: List[int], start_at: datetime, end_at: datetime) -> List[int]:
+    # 資源有自己的營業時間時，預約必須落在當天的營業時間內；沒有設定的資源沿用店家的營業時間
+    if not resource_ids:
+        return []
+    hours = db.query(models.BusinessHour).filter(
+        models.BusinessHour.resource_id.in_(resource_ids),
+        models.BusinessHour.day_of_week == start_at.isoweekday(),
+    ).all()
+    by_resource = {hour.resource_id: hour for hour in hours}
+    working = []
+    for resource_id in resource_ids:
+        hour = by_resource.get(resource_id)
+        if hour is not None and (hour.is_closed or start_at.time() < hour.open_time or end_at.time() > hour.close_time or end_at.date() != start_at.date()):
+            continue
+        working.append(resource_id)
+    return working
+
+
+def candidate_resources(db: Session, service_id: int, start_at: datetime, end_at: datetime, resource_id: Optional[int] = None) -> List[models.Resource]:
+    query = db.query(models.Resource).join(
+        models.service_resources, models.service_resources.c.resource_id == models.Resource.id
+    ).filter(
+        models.service_resources.c.service_id == service_id,
+        models.Resource.is_active == True,
+    )
+    if resource_id is not None:
+        query = query.filter(models.Resource.id == resource_id)
+    resources = query.order_by(models.Resource.id).all()
+    working = set(_working_resource_ids(db, [resource.id for resource in resources], start_at, end_at))
+    return [resource for resource in resources if resource.id in working]
+
+
+def reserve(db: Session, resource: models.Resource, start_at: datetime, end_at: datetime) -> bool:
+    # 在 savepoint 中對每一格做 booked = booked + 1 (僅限 booked < capacity)，只要有一格已滿就整批復原
+    # PostgreSQL 上 UPDATE 會鎖住這些列，並行的預約會依序重新檢查 booked < capacity
+    slots = slot_starts(start_at, end_at)
+    try:
+        with db.begin_nested():
+            db.execute(_insert_missing_slots(db), [
+                {"resource_id": resource.id, "owner_id": resource.owner_id, "slot_start": slot, "booked": 0, "capacity": resource.capacity}
+                for slot in slots
+            ])
+            result = db.execute(
+                update(models.ResourceSlot)
+                .where(
+                    models.ResourceSlot.resource_id == resource.id,
+                    models.ResourceSlot.slot_start.in_(slots),
+                    models.ResourceSlot.booked < models.ResourceSlot.capacity,
+                )
+                .values(booked=models.ResourceSlot.booked + 1)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != len(slots):
+                raise _SlotsFull()
+    except _SlotsFull:
+        return False
+    return True
+
+
+def reserve_any(db: Session, service_id: int, start_at: datetime, end_at: datetime, resource_id: Optional[int] = None) -> Optional[int]:
+    # 依序嘗試可提供此服務的資源，回傳成功預留的資源 id，全部已滿時回傳 None
+    for resource in candidate_resources(db, service_id, start_at, end_at, resource_id):
+        if reserve(db, resource, start_at, end_at):
+            return resource.id
+    return None
+
+
+def release(db: Session, resource_id: Optional[int], start_at: Optional[datetime], end_at: Optional[datetime]):
+    if resource_id is None or start_at is None or end_at is None:
+        return
+    db.execute(
+        update(models.ResourceSlot)
+        .where(
+            models.ResourceSlot.resource_id == resource_id,
+            models.ResourceSlot.slot_start.in_(slot_starts(start_at, end_at)),
+            models.ResourceSlot.booked > 0,
+        )
+        .values(booked=models.ResourceSlot.booked - 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def free_resource_ids(db: Session, service_id: int, start_at: datetime, end_at: datetime) -> List[int]:
+    # 「這個時段還有沒有空位」：以 (resource_id, slot_start) 主鍵範圍讀取計數，不需要掃描當天的預約
+    full_slot = (
+        select(models.ResourceSlot.resource_id)
+        .where(
+            models.ResourceSlot.resource_id == models.Resource.id,
+            models.ResourceSlot.slot_start >= _floor_slot(start_at),
+            models.ResourceSlot.slot_start < end_at,
+            models.ResourceSlot.booked >= models.ResourceSlot.capacity,
+        )
+        .exists()
+    )
+    resource_ids = db.execute(
+        select(models.Resource.id)
+        .join(models.service_resources, models.service_resources.c.resource_id == models.Resource.id)
+        .where(
+            models.service_resources.c.service_id == service_id,
+            models.Resource.is_active == True,
+            ~full_slot,
+        )
+        .order_by(models.Resource.id)
+    ).scalars().all()
+    return _working_resource_ids(db, resource_ids, start_at, end_at)
+
+
+def set_capacity(db: Session, resource: models.Resource):
+    # 資源容量變更時同步更新已存在的格子
+    db.execute(
+        update(models.ResourceSlot)
+        .where(models.ResourceSlot.resource_id == resource.id)
+        .values(capacity=resource.capacity)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _occupying_bookings(db: Session, owner_id: Optional[int]) -> Iterable:
+    query = db.query(models.Booking.resource_id, models.Booking.start_at, models.Booking.end_at).filter(
+        models.Booking.resource_id.isnot(None),
+        models.Booking.start_at.isnot(None),
+        models.Booking.status.notin_(RELEASED_STATUSES),
+    )
+    if owner_id is not None:
+        query = query.filter(models.Booking.owner_id == owner_id)
+    return query.yield_per(1000)
+
+
+def rebuild(db: Session, owner_id: Optional[int] = None) -> int:
+    # 計數有誤 (例如手動修改資料) 時從 bookings 重新計算
+    counts = Counter()
+    for resource_id, start_at, end_at in _occupying_bookings(db, owner_id):
+        for slot in slot_starts(start_at, end_at):
+            counts[(resource_id, slot)] += 1
+
+    resources = db.query(models.Resource)
+    if owner_id is not None:
+        resources = resources.filter(models.Resource.owner_id == owner_id)
+    resources = {resource.id: resource for resource in resources}
+
+    statement = delete(models.ResourceSlot)
+    if owner_id is not None:
+        statement = statement.where(models.ResourceSlot.owner_id == owner_id)
+    db.execute(statement)
+    rows = [
+        {"resource_id": resource_id, "owner_id": resources[resource_id].owner_id, "slot_start": slot, "booked": booked, "capacity": resources[resource_id].capacity}
+        for (resource_id, slot), booked in counts.items()
+        if resource_id in resources
+    ]
+    if rows:
+        db.execute(slots_table.insert(), rows)
+    db.commit()
+    logger.info("Rebuilt %d resource slots", len(rows))
+    return len(rows)
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Rebuild per-slot resource capacity counters from bookings")
+    parser.add_argument("--owner-id", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        total = rebuild(db, args.owner_id)
+        print(f"Rebuilt {total} resource slots")
+    finally:
+        db.close()
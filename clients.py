@@ -0,0 +1,325 @@
+import argparse
+import logging
+import re
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from sqlalchemy import case, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+CANCELLED_STATUSES = ("cancelled",)
+UPCOMING_STATUSES = ("pending", "confirmed")
+BACKFILL_BATCH_SIZE = 1000
+
+
+class BookingState(NamedTuple):
+    # 預約對客戶統計有影響的欄位；寫入前後各取一次，差異就是統計的增減
+    client_id: Optional[int]
+    status: Optional[str]
+    start_at: Optional[datetime]
+    price: float
+
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    email = (email or "").strip().lower()
+    return email or None
+
+
+def normalize_phone(phone: Optional[str]) -> Optional[str]:
+    # 只保留數字 (與開頭的 +)，"0912-345-678" 與 "0912 345 678" 視為同一支電話
+    phone = (phone or "").strip()
+    digits = re.sub(r"\D", "", phone)
+    if not digits:
+        return None
+    return ("+" if phone.startswith("+") else "") + digits
+
+
+def _pick_client(candidates: List[models.Client], user_id: Optional[int], email_key: Optional[str], phone_key: Optional[str]) -> Optional[models.Client]:
+    # 依 user_id、email、電話的優先順序比對
+    for matches in (
+        lambda client: user_id is not None and client.user_id == user_id,
+        lambda client: email_key is not None and client.email_normalized == email_key,
+        lambda client: phone_key is not None and client.phone_normalized == phone_key,
+    ):
+        for client in candidates:
+            if matches(client):
+                return client
+    return None
+
+
+def _find_candidates(db: Session, owner_id: int, user_id: Optional[int], email_key: Optional[str], phone_key: Optional[str]) -> List[models.Client]:
+    conditions = []
+    if user_id is not None:
+        conditions.append(models.Client.user_id == user_id)
+    if email_key is not None:
+        conditions.append(models.Client.email_normalized == email_key)
+    if phone_key is not None:
+        conditions.append(models.Client.phone_normalized == phone_key)
+    if not conditions:
+        return []
+    return db.query(models.Client).filter(models.Client.owner_id == owner_id, or_(*conditions)).order_by(models.Client.id).all()
+
+
+def resolve_client(db: Session, owner_id: int, user_id: Optional[int] = None, name: Optional[str] = None, email: Optional[str] = None, phone: Optional[str] = None) -> Optional[models.Client]:
+    # 找出 (或建立) 這筆預約在店家客戶名錄中的客戶；沒有任何可辨識的資料時回傳 None
+    if user_id is not None:
+        user = db.get(models.User, user_id)
+        if user is not None:
+            name, email, phone = user.name, user.email, user.phone_number or phone
+    email_key, phone_key = normalize_email(email), normalize_phone(phone)
+    if user_id is None and email_key is None and phone_key is None:
+        return None
+
+    candidates = _find_candidates(db, owner_id, user_id, email_key, phone_key)
+    client = _pick_client(candidates, user_id, email_key, phone_key)
+    if client is None:
+        client = models.Client(
+            owner_id=owner_id,
+            user_id=user_id,
+            name=name or email or phone,
+            email=email,
+            phone=phone,
+            email_normalized=email_key,
+            phone_normalized=phone_key,
+            booking_count=0,
+            visit_count=0,
+            lifetime_spend=0,
+        )
+        try:
+            with db.begin_nested():
+                db.add(client)
+                db.flush()
+        except IntegrityError:
+            # 並行的請求剛建立了同一位客戶
+            client = _pick_client(_find_candidates(db, owner_id, user_id, email_key, phone_key), user_id, email_key, phone_key)
+            if client is None:
+                raise
+        return client
+
+    # 匿名客戶之後註冊成會員、或補上了 email / 電話時合併到同一筆；已被其他客戶使用的值不覆寫
+    others = [candidate for candidate in candidates if candidate is not client]
+    if user_id is not None and client.user_id is None and not any(other.user_id == user_id for other in others):
+        client.user_id = user_id
+    if email_key is not None and client.email_normalized is None and not any(other.email_normalized == email_key for other in others):
+        client.email, client.email_normalized = email, email_key
+    if phone_key is not None and client.phone_normalized is None:
+        client.phone, client.phone_normalized = phone, phone_key
+    return client
+
+
+def resolve_booking_client(db: Session, owner_id: int, booking) -> Optional[int]:
+    # booking 可以是 Booking、BookingCreate 或 BookingSeriesCreate
+    client = resolve_client(db, owner_id, booking.user_id, booking.customer_name, booking.customer_email, booking.customer_phone)
+    return client.id if client is not None else None
+
+
+def service_prices(db: Session, service_ids: Iterable[int]) -> Dict[int, float]:
+    service_ids = {service_id for service_id in service_ids if service_id is not None}
+    if not service_ids:
+        return {}
+    return dict(db.query(models.Service.id, models.Service.price).filter(models.Service.id.in_(service_ids)).all())
+
+
+def snapshot(db: Session, bookings, overrides: Optional[Dict[int, dict]] = None) -> Dict[int, BookingState]:
+    # bookings 可以是 ORM 物件或查詢結果的列 (需有 id、client_id、status、start_at、service_id、price)
+    # 金額使用預約時記錄的價格，服務之後調價不會讓寫入前後的差異對不上；只有尚未回填價格的舊預約才查詢目前的服務價格
+    bookings = list(bookings)
+    prices = service_prices(db, (booking.service_id for booking in bookings if booking.price is None))
+    states = {}
+    for booking in bookings:
+        values = {"client_id": booking.client_id, "status": booking.status, "start_at": booking.start_at}
+        values.update((overrides or {}).get(booking.id, {}))
+        price = booking.price if booking.price is not None else prices.get(booking.service_id)
+        states[booking.id] = BookingState(price=price or 0.0, **values)
+    return states
+
+
+class _ClientDelta:
+    __slots__ = ("booking_count", "visit_count", "lifetime_spend", "latest_visit", "lost_visit", "upcoming_changed")
+
+    def __init__(self):
+        self.booking_count = 0
+        self.visit_count = 0
+        self.lifetime_spend = 0.0
+        self.latest_visit: Optional[datetime] = None
+        self.lost_visit = False
+        self.upcoming_changed = False
+
+
+def _next_visit_subquery(client_id: int, now: datetime):
+    # 以 (client_id, start_at) 索引找出最近一筆尚未開始的預約
+    return (
+        select(func.min(models.Booking.start_at))
+        .where(
+            models.Booking.client_id == client_id,
+            models.Booking.status.in_(UPCOMING_STATUSES),
+            models.Booking.start_at >= now,
+        )
+        .scalar_subquery()
+    )
+
+
+def _last_visit(db: Session, client_id: int) -> Optional[datetime]:
+    values = [
+        db.query(func.max(model.start_at)).filter(model.client_id == client_id, model.status == "completed").scalar()
+        for model in (models.Booking, models.BookingArchive)
+    ]
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+def apply_changes(db: Session, before: Dict[int, BookingState], after: Dict[int, BookingState], now: Optional[datetime] = None):
+    # 依預約寫入前後的差異更新客戶統計：計數與金額以 UPDATE ... SET x = x + :delta 原子地增減，
+    # 下一次預約 (以及極少見的「已完成」被撤銷時的最後到訪) 以索引查詢重算，每位客戶只有一個 UPDATE
+    now = now or datetime.now()
+    deltas: Dict[int, _ClientDelta] = defaultdict(_ClientDelta)
+    for booking_id in before.keys() | after.keys():
+        old, new = before.get(booking_id), after.get(booking_id)
+        if old == new:
+            continue
+        for state, sign in ((old, -1), (new, 1)):
+            if state is None or state.client_id is None:
+                continue
+            delta = deltas[state.client_id]
+            if state.status not in CANCELLED_STATUSES:
+                delta.booking_count += sign
+            if state.status == "completed":
+                delta.visit_count += sign
+                delta.lifetime_spend += sign * state.price
+                if sign < 0:
+                    delta.lost_visit = True
+                elif state.start_at is not None and (delta.latest_visit is None or state.start_at > delta.latest_visit):
+                    delta.latest_visit = state.start_at
+            if state.status in UPCOMING_STATUSES:
+                delta.upcoming_changed = True
+    if not deltas:
+        return
+
+    # 下一次預約與最後到訪從 bookings 重算，必須先送出尚未 flush 的變更
+    db.flush()
+    for client_id, delta in deltas.items():
+        values = {}
+        if delta.booking_count:
+            values["booking_count"] = models.Client.booking_count + delta.booking_count
+        if delta.visit_count:
+            values["visit_count"] = models.Client.visit_count + delta.visit_count
+        if delta.lifetime_spend:
+            values["lifetime_spend"] = models.Client.lifetime_spend + delta.lifetime_spend
+        if delta.lost_visit:
+            values["last_visit_at"] = _last_visit(db, client_id)
+        elif delta.latest_visit is not None:
+            values["last_visit_at"] = case(
+                (or_(models.Client.last_visit_at.is_(None), models.Client.last_visit_at < delta.latest_visit), delta.latest_visit),
+                else_=models.Client.last_visit_at,
+            )
+        if delta.upcoming_changed:
+            values["next_visit_at"] = _next_visit_subquery(client_id, now)
+        if values:
+            values["updated_at"] = datetime.utcnow()
+            db.execute(update(models.Client).where(models.Client.id == client_id).values(**values).execution_options(synchronize_session=False))
+
+
+def _assign_missing_client_ids(db: Session, model, owner_id: Optional[int], batch_size: int) -> int:
+    # 依 id 分批處理尚未對應到客戶的預約；無法辨識客戶的匿名預約維持 NULL
+    key_columns = [model.id, model.start_at] if model is models.BookingArchive else [model.id]
+    assigned = 0
+    last_id = 0
+    while True:
+        query = db.query(*key_columns, model.owner_id, model.user_id, model.customer_name, model.customer_email, model.customer_phone).filter(
+            model.client_id.is_(None), model.id > last_id
+        )
+        if owner_id is not None:
+            query = query.filter(model.owner_id == owner_id)
+        rows = query.order_by(model.id).limit(batch_size).all()
+        if not rows:
+            return assigned
+        changes = []
+        for row in rows:
+            client = resolve_client(db, row.owner_id, row.user_id, row.customer_name, row.customer_email, row.customer_phone)
+            if client is not None:
+                changes.append({**{column.key: getattr(row, column.key) for column in key_columns}, "client_id": client.id})
+        if changes:
+            db.execute(update(model), changes)
+        db.commit()
+        assigned += len(changes)
+        last_id = rows[-1].id
+
+
+def _aggregate_stats(db: Session, model, owner_id: Optional[int]) -> dict:
+    completed = model.status == "completed"
+    query = db.query(
+        model.client_id,
+        func.sum(case((model.status.notin_(CANCELLED_STATUSES), 1), else_=0)),
+        func.sum(case((completed, 1), else_=0)),
+        func.sum(case((completed, func.coalesce(model.price, models.Service.price, 0)), else_=0)),
+        func.max(case((completed, model.start_at))),
+    ).outerjoin(models.Service, models.Service.id == model.service_id).filter(model.client_id.isnot(None))
+    if owner_id is not None:
+        query = query.filter(model.owner_id == owner_id)
+    return {client_id: (bookings or 0, visits or 0, spend or 0.0, last_visit) for client_id, bookings, visits, spend, last_visit in query.group_by(model.client_id)}
+
+
+def recompute_stats(db: Session, owner_id: Optional[int] = None, now: Optional[datetime] = None) -> int:
+    # 從 bookings 與封存表重新計算所有客戶的統計，用於回填或修正
+    now = now or datetime.now()
+    current = _aggregate_stats(db, models.Booking, owner_id)
+    archived = _aggregate_stats(db, models.BookingArchive, owner_id)
+    next_visits = db.query(models.Booking.client_id, func.min(models.Booking.start_at)).filter(
+        models.Booking.client_id.isnot(None),
+        models.Booking.status.in_(UPCOMING_STATUSES),
+        models.Booking.start_at >= now,
+    )
+    if owner_id is not None:
+        next_visits = next_visits.filter(models.Booking.owner_id == owner_id)
+    next_visits = dict(next_visits.group_by(models.Booking.client_id).all())
+
+    client_ids = db.query(models.Client.id)
+    if owner_id is not None:
+        client_ids = client_ids.filter(models.Client.owner_id == owner_id)
+    rows = []
+    for (client_id,) in client_ids:
+        bookings, visits, spend, last_visit = current.get(client_id, (0, 0, 0.0, None))
+        archived_bookings, archived_visits, archived_spend, archived_last_visit = archived.get(client_id, (0, 0, 0.0, None))
+        last_visits = [value for value in (last_visit, archived_last_visit) if value is not None]
+        rows.append({
+            "id": client_id,
+            "booking_count": bookings + archived_bookings,
+            "visit_count": visits + archived_visits,
+            "lifetime_spend": float(spend) + float(archived_spend),
+            "last_visit_at": max(last_visits) if last_visits else None,
+            "next_visit_at": next_visits.get(client_id),
+        })
+    if rows:
+        db.execute(update(models.Client), rows)
+    db.commit()
+    return len(rows)
+
+
+def rebuild(db: Session, owner_id: Optional[int] = None, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    assigned = _assign_missing_client_ids(db, models.Booking, owner_id, batch_size)
+    assigned += _assign_missing_client_ids(db, models.BookingArchive, owner_id, batch_size)
+    total = recompute_stats(db, owner_id)
+    logger.info("Assigned %d bookings to clients, recomputed %d clients", assigned, total)
+    return total
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Backfill the per-owner client directory and recompute client stats from bookings")
+    parser.add_argument("--owner-id", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        total = rebuild(db, args.owner_id)
+        print(f"Rebuilt {total} clients")
+    finally:
+        db.close()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Callable, List, Tuple
+
+import httpx
+
+# 以單一 uvicorn worker 同時送出管理員的寫入與公開頁面的預約，檢查沒有請求因為等待資料庫 (SQLite 的寫入鎖) 而失敗或逾時
+# 預設使用暫存的 SQLite 檔案；有錯誤時以非 0 結束，可放進 CI
+#   python concurrency_check.py --bookings 10 --admin-writes 8
+# 單一請求在沒有競爭時遠低於這個時間；等待寫入鎖卡住 event loop 時會接近 busy timeout (5 秒) 的倍數
+MAX_SECONDS = 5.0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(database_url: str, port: int, workdir: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "SIDEP_DATABASE_URL": database_url,
+        "SIDEP_SCHEDULER_ENABLED": "0",
+        "SIDEP_AUDIT_DIR": os.path.join(workdir, "audit"),
+        "SIDEP_MEDIA_DIR": os.path.join(workdir, "media"),
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+
+def _admin(client: httpx.Client, email: str) -> dict:
+    client.post("/auth/register", json={"email": email, "name": "Owner", "password": "secret1", "role": "admin"}).raise_for_status()
+    token = client.post("/auth/login", json={"email": email, "password": "secret1"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+def setup(base_url: str) -> Tuple[dict, int, str]:
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        headers = _admin(client, "concurrency-check@example.com")
+        service_id = client.post("/services/", json={"name": "Cut", "price": 100, "min_duration": 30, "max_duration": 60}, headers=headers).json()["id"]
+        slug = client.get("/users/me", headers=headers).json()["public_slug"]
+    return headers, service_id, slug
+
+
+def run_check(base_url: str, headers: dict, service_id: int, slug: str, bookings: int, admin_writes: int, first_day: date) -> List[Tuple[str, int, float]]:
+    day = first_day
+
+    def public_booking(index: int) -> Callable[[httpx.Client], httpx.Response]:
+        # 不同的時段，全部都應該成功
+        payload = {
+            "service_id": service_id, "date": str(day + timedelta(days=index // 8)), "time": f"{9 + index % 8:02d}:00", "public_slug": slug,
+            "customer_name": f"Customer {index}", "customer_email": f"customer{index}@example.com", "customer_phone": "0900000000",
+        }
+        return lambda client: client.post("/bookings/", json=payload)
+
+    def admin_write(index: int) -> Callable[[httpx.Client], httpx.Response]:
+        return lambda client: client.patch(f"/services/{service_id}/status", json={"is_active": True}, headers=headers)
+
+    calls = [("POST /bookings/", public_booking(index)) for index in range(bookings)]
+    calls += [("PATCH /services/{id}/status", admin_write(index)) for index in range(admin_writes)]
+    # 上傳在接收檔案前後各有一段交易
+    image = b"\x89PNG\r\n\x1a\n" + os.urandom(64)
+    calls += [("PUT /services/{id}/image", lambda client: client.put(
+        f"/services/{service_id}/image", content=image, headers={**headers, "Content-Type": "image/png"}
+    ))] * max(admin_writes // 4, 1)
+    calls += [("POST /auth/login", lambda client: client.post("/auth/login", json={"email": "concurrency-check@example.com", "password": "secret1"}))] * max(admin_writes // 2, 1)
+
+    def timed(call):
+        name, request = call
+        with httpx.Client(base_url=base_url, timeout=60) as client:
+            started = time.monotonic()
+            response = request(client)
+            return name, response.status_code, time.monotonic() - started
+
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        return list(pool.map(timed, calls))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mix concurrent admin writes with public booking creation on one worker")
+    parser.add_argument("--url", default=None, help="database URL, defaults to a temporary SQLite file")
+    parser.add_argument("--bookings", type=int, default=10)
+    parser.add_argument("--admin-writes", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=MAX_SECONDS, help="slowest acceptable response; raise it for larger --bookings")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = args.url or "sqlite:///" + os.path.join(workdir, "concurrency.db")
+        port = _free_port()
+        server = _start_server(database_url, port, workdir)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            headers, service_id, slug = setup(base_url)
+            results = []
+            for round_index in range(args.rounds):
+                first_day = date.today() + timedelta(days=7 + round_index * (args.bookings // 8 + 1))
+                results += run_check(base_url, headers, service_id, slug, args.bookings, args.admin_writes, first_day)
+        finally:
+            server.terminate()
+            server.wait(10)
+
+    failed = [(name, code, seconds) for name, code, seconds in results if code >= 500 or seconds > args.max_seconds]
+    for name, code, seconds in failed:
+        print(f"FAIL {name} [{code}] {seconds:.2f}s")
+    statuses = Counter(code for _, code, _ in results)
+    print(f"{len(results)} requests, statuses {dict(sorted(statuses.items()))}, slowest {max(seconds for _, _, seconds in results):.2f}s")
+    print(f"{len(results) - len(failed)} passed, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# 每個訂閱者最多暫存的事件數，慢速的客戶端會丟掉最舊的事件
+SUBSCRIBER_QUEUE_SIZE = 100
+NOTIFY_CHANNEL = "booking_events"
+
+Listener = Callable[[int, dict], None]
+
+
+class InMemoryBridge:
+    # 程序內的橋接器：單一 worker 部署或測試時使用
+    # 多個 BookingEventBroker 可以共用同一個實例，用來模擬多個 worker
+    def __init__(self):
+        self._listeners: List[Listener] = []
+        self._lock = threading.Lock()
+
+    def start(self, listener: Listener):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def stop(self, listener: Optional[Listener] = None):
+        with self._lock:
+            if listener is None:
+                self._listeners.clear()
+            elif listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def publish(self, owner_id: int, event: dict):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(owner_id, event)
+
+
+class PostgresNotifyBridge:
+    # 跨程序的橋接器：透過 PostgreSQL LISTEN/NOTIFY 把事件廣播給所有 worker
+    # 發佈者自己也會收到 NOTIFY，所以本地訂閱者一律由監聽執行緒派送
+    def __init__(self, engine, channel: str = NOTIFY_CHANNEL, poll_timeout: float = 5.0):
+        self.engine = engine
+        self.channel = channel
+        self.poll_timeout = poll_timeout
+        self._listener: Optional[Listener] = None
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, listener: Listener):
+        self._listener = listener
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._listen, name="booking-events-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, listener: Optional[Listener] = None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_timeout + 1)
+            self._thread = None
+
+    def publish(self, owner_id: int, event: dict):
+        payload = json.dumps({"owner_id": owner_id, "event": event}, default=str)
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": payload})
+            conn.commit()
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            raw_conn = None
+            try:
+                raw_conn = self.engine.raw_connection()
+                dbapi_conn = raw_conn.dbapi_connection
+                dbapi_conn.autocommit = True
+                with dbapi_conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                while not self._stopping.is_set():
+                    readable, _, _ = select.select([dbapi_conn], [], [], self.poll_timeout)
+                    if not readable:
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        notify = dbapi_conn.notifies.pop(0)
+                        message = json.loads(notify.payload)
+                        self._listener(message["owner_id"], message["event"])
+            except Exception:
+                logger.exception("Booking event listener failed, reconnecting")
+                self._stopping.wait(self.poll_timeout)
+            finally:
+                if raw_conn is not None:
+                    # LISTEN 狀態不能回到連線池，直接丟棄這條連線
+                    raw_conn.invalidate()
+
+
+class BookingEventBroker:
+    # 程序內的發佈/訂閱：每個 owner 對應一組訂閱者佇列
+    def __init__(self, bridge=None):
+        self.bridge = bridge or InMemoryBridge()
+        self._subscribers: Dict[int, Set[asyncio.Queue]] = defaultdict(set)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop, bridge=None):
+        self._loop = loop
+        if bridge is not None:
+            self.bridge = bridge
+        self.bridge.start(self._on_bridge_event)
+
+    def stop(self):
+        self.bridge.stop(self._on_bridge_event)
+        self._loop = None
+
+    def publish(self, owner_id: int, event: dict):
+        try:
+            self.bridge.publish(owner_id, event)
+        except Exception:
+            # 推播失敗不應影響已經提交的寫入，前端仍可重新查詢
+            logger.exception("Failed to publish booking event for owner %s", owner_id)
+
+    @asynccontextmanager
+    async def subscription(self, owner_id: int):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[owner_id].add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(owner_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[owner_id]
+
+    def subscriber_count(self, owner_id: Optional[int] = None) -> int:
+        if owner_id is not None:
+            return len(self._subscribers.get(owner_id, ()))
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def _on_bridge_event(self, owner_id: int, event: dict):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._deliver(owner_id, event)
+        else:
+            loop.call_soon_threadsafe(self._deliver, owner_id, event)
+
+    def _deliver(self, owner_id: int, event: dict):
+        for queue in list(self._subscribers.get(owner_id, ())):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+
+booking_broker = BookingEventBroker()
@@ -0,0 +1,259 @@
+import argparse
+import logging
+import os
+import re
+import sys
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+
+# 逐一呼叫各個端點，記錄每個請求實際送出的 SQL，再以 EXPLAIN 檢查是否對大表做全表掃描
+# 應在有正式規模資料的資料庫上執行 (例如先用 synthetic_data.py 產生資料)；有退化時以非 0 結束，可放進 CI
+#   python explain_check.py --url postgresql+psycopg://...
+
+logger = logging.getLogger(__name__)
+
+# 列數達到這個數量的表才視為大表
+LARGE_TABLE_ROWS = 10000
+# 已知且可接受的全表掃描：(端點, 表格) -> 原因
+ALLOWED_SCANS: Dict[Tuple[str, str], str] = {}
+# 列表端點的查詢數量上限：客戶名稱、服務名稱等以 IN 或 join 一次取得，查詢數量不應隨回傳的筆數增加
+# (每筆預約各查一次客戶時，7 天的範圍就會送出上百個查詢)
+QUERY_BUDGETS: Dict[str, int] = {
+    "GET /bookings/": 4,
+    "GET /bookings/?fields": 4,
+    "GET /bookings/?fields=serviceName": 3,
+    "GET /bookings/my": 3,
+    "GET /admin/clients/": 4,
+    "GET /admin/bootstrap": 8,
+    "GET /admin/resources/": 3,
+    "GET /public/bookings_by_slug/{slug}": 3,
+}
+
+_ALIAS_PATTERN = re.compile(r'(?:FROM|JOIN)\s+"?(\w+)"?\s+AS\s+"?(\w+)"?', re.IGNORECASE)
+_SQLITE_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+@dataclass
+class QueryPlan:
+    statement: str
+    scanned: List[str]
+    plan: str
+
+
+@dataclass
+class EndpointReport:
+    name: str
+    status_code: Optional[int] = None
+    queries: List[QueryPlan] = field(default_factory=list)
+    regressions: List[Tuple[str, str]] = field(default_factory=list)
+    # 請求本身失敗或沒有查詢資料庫時沒有可檢查的計畫，也列為失敗
+    error: Optional[str] = None
+
+    @property
+    def failed(self) -> bool:
+        return bool(self.regressions or self.error)
+
+
+@contextmanager
+def capture_statements(engine):
+    statements: List[Tuple[str, object]] = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    sa.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def _postgres_seq_scans(node: dict) -> List[str]:
+    scanned = [node["Relation Name"]] if node.get("Node Type") == "Seq Scan" else []
+    for child in node.get("Plans", []):
+        scanned.extend(_postgres_seq_scans(child))
+    return scanned
+
+
+def explain(conn, statement: str, parameters) -> QueryPlan:
+    if conn.dialect.name == "postgresql":
+        rows = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+        root = rows[0]["Plan"] if isinstance(rows, list) else rows
+        return QueryPlan(statement, _postgres_seq_scans(root), repr(root))
+
+    # SQLite 的 EXPLAIN QUERY PLAN 只列出別名 (users_1)，從 SQL 中還原實際的表名
+    aliases = {alias: table for table, alias in _ALIAS_PATTERN.findall(statement)}
+    details = [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+    scanned = []
+    for detail in details:
+        match = _SQLITE_SCAN.match(detail)
+        if match:
+            scanned.append(aliases.get(match.group(1), match.group(1)))
+    return QueryPlan(statement, scanned, "\n".join(details))
+
+
+def large_tables(conn, metadata: sa.MetaData, min_rows: int) -> Dict[str, int]:
+    inspector = sa.inspect(conn)
+    sizes = {}
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        count = conn.execute(sa.select(sa.func.count()).select_from(table)).scalar()
+        if count >= min_rows:
+            sizes[table.name] = count
+    return sizes
+
+
+def _prepare_explain_connection(conn):
+    # 關閉 seq scan 後若計畫中仍有 Seq Scan，代表沒有任何索引可以使用，而不是規劃器認為全表掃描比較便宜
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("SET enable_seqscan = off")
+
+
+def _fixtures(db, models) -> dict:
+    # 選出預約最多的店家與客戶，讓檢查跑在最大的資料量上
+    owner_id = db.query(models.Booking.owner_id).group_by(models.Booking.owner_id).order_by(sa.func.count().desc()).limit(1).scalar()
+    customer_id = db.query(models.Booking.user_id).filter(models.Booking.user_id.isnot(None)).group_by(models.Booking.user_id).order_by(sa.func.count().desc()).limit(1).scalar()
+    if owner_id is None or customer_id is None:
+        raise SystemExit("The database has no bookings; generate data first (python synthetic_data.py)")
+    owner = db.get(models.User, owner_id)
+    latest = db.query(sa.func.max(models.Booking.start_at)).filter(models.Booking.owner_id == owner_id).scalar()
+    service_id = db.query(models.Service.id).filter(models.Service.owner_id == owner_id).order_by(models.Service.id).limit(1).scalar()
+    return {
+        "owner_id": owner_id,
+        "customer_id": customer_id,
+        "slug": owner.public_slug,
+        "service_id": service_id,
+        "start": (latest - timedelta(days=7)).isoformat(),
+        "end": latest.isoformat(),
+    }
+
+
+def endpoint_requests(fixtures: dict) -> List[Tuple[str, str, str, dict]]:
+    # (名稱, 身分, 路徑, query 參數)
+    window = {"start": fixtures["start"], "end": fixtures["end"]}
+    return [
+        ("GET /services/", "admin", "/services/", {}),
+        ("GET /services/{id}", "admin", f"/services/{fixtures['service_id']}", {}),
+        ("GET /bookings/", "admin", "/bookings/", window),
+        ("GET /bookings/?fields", "admin", "/bookings/", {**window, "fields": "id,status,clientName"}),
+        ("GET /bookings/?fields=serviceName", "admin", "/bookings/", {**window, "fields": "serviceName"}),
+        ("GET /bookings/my", "customer", "/bookings/my", {}),
+        ("GET /admin/clients/", "admin", "/admin/clients/", {}),
+        ("GET /admin/clients/?sort=-last_visit_at", "admin", "/admin/clients/", {"sort": "-last_visit_at"}),
+        ("GET /admin/clients/?sort=next_visit_at", "admin", "/admin/clients/", {"sort": "next_visit_at"}),
+        ("GET /admin/settings/", "admin", "/admin/settings/", {}),
+        ("GET /admin/bootstrap", "admin", "/admin/bootstrap", {}),
+        ("GET /admin/resources/", "admin", "/admin/resources/", {}),
+        ("GET /public/profile/{slug}", None, f"/public/profile/{fixtures['slug']}", {}),
+        ("GET /public/bookings_by_slug/{slug}", None, f"/public/bookings_by_slug/{fixtures['slug']}", window),
+        ("GET /public/availability/{slug}", None, f"/public/availability/{fixtures['slug']}", {"service_id": fixtures["service_id"], "start_at": fixtures["start"]}),
+    ]
+
+
+def foreign_key_reports(conn, metadata: sa.MetaData, large: Dict[str, int]) -> List[EndpointReport]:
+    # 刪除父表資料 (例如刪除服務) 時，資料庫會以外鍵欄位查詢子表；外鍵欄位沒有索引就會掃描整張子表
+    reports = []
+    for table in metadata.sorted_tables:
+        if table.name not in large:
+            continue
+        for column in table.columns:
+            if not column.foreign_keys:
+                continue
+            report = EndpointReport(f"FK {table.name}.{column.name}")
+            statement = str(sa.select(sa.literal_column("1")).select_from(table).where(column == sa.bindparam("value")).compile(conn))
+            parameters = {"value": 1} if conn.dialect.paramstyle in ("named", "pyformat") else (1,)
+            plan = explain(conn, statement, parameters)
+            report.queries.append(plan)
+            report.regressions.extend((table_name, statement) for table_name in plan.scanned if table_name in large)
+            reports.append(report)
+    return reports
+
+
+def run_checks(engine, min_rows: int = LARGE_TABLE_ROWS) -> List[EndpointReport]:
+    from fastapi.testclient import TestClient
+
+    import main
+    import models
+    from database import Base, SessionLocal
+
+    with engine.connect() as conn:
+        large = large_tables(conn, Base.metadata, min_rows)
+    logger.info("Large tables: %s", ", ".join(f"{name} ({rows})" for name, rows in sorted(large.items())) or "none")
+
+    db = SessionLocal()
+    try:
+        fixtures = _fixtures(db, models)
+    finally:
+        db.close()
+    tokens = {
+        "admin": main.create_access_token({"sub": str(fixtures["owner_id"])}),
+        "customer": main.create_access_token({"sub": str(fixtures["customer_id"])}),
+    }
+
+    # 不進入 with 區塊，不會觸發 startup (建表、排程器)；端點的例外以 500 回應記錄為失敗，不中斷其他端點的檢查
+    client = TestClient(main.app, raise_server_exceptions=False)
+    reports = []
+    with engine.connect() as explain_conn:
+        _prepare_explain_connection(explain_conn)
+        for name, identity, path, params in endpoint_requests(fixtures):
+            headers = {"Authorization": f"Bearer {tokens[identity]}"} if identity else {}
+            report = EndpointReport(name)
+            with capture_statements(engine) as statements:
+                report.status_code = client.get(path, params=params, headers=headers).status_code
+            if not 200 <= report.status_code < 300:
+                report.error = f"HTTP {report.status_code}"
+            elif not statements:
+                report.error = "no queries captured"
+            elif len(statements) > QUERY_BUDGETS.get(name, len(statements)):
+                report.error = f"{len(statements)} queries, more than the budget of {QUERY_BUDGETS[name]}"
+            for statement, parameters in statements:
+                plan = explain(explain_conn, statement, parameters)
+                report.queries.append(plan)
+                for table_name in plan.scanned:
+                    if table_name in large and (name, table_name) not in ALLOWED_SCANS:
+                        report.regressions.append((table_name, statement))
+            reports.append(report)
+        reports.extend(foreign_key_reports(explain_conn, Base.metadata, large))
+    return reports
+
+
+def _print_report(reports: List[EndpointReport], verbose: bool):
+    for report in reports:
+        state = "FAIL" if report.failed else "ok"
+        status_text = f" [{report.status_code}]" if report.status_code is not None else ""
+        print(f"{state:<4} {report.name}{status_text}: {len(report.queries)} queries")
+        if report.error:
+            print(f"     {report.error}")
+        for table_name, statement in report.regressions:
+            print(f"     sequential scan on {table_name}: {' '.join(statement.split())[:200]}")
+        if verbose:
+            for plan in report.queries:
+                print(f"     -- {' '.join(plan.statement.split())[:160]}")
+                print("        " + plan.plan.replace("\n", "\n        "))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail when endpoint queries fall back to sequential scans on large tables")
+    parser.add_argument("--url", default=None, help="database URL, defaults to the application's database")
+    parser.add_argument("--min-rows", type=int, default=LARGE_TABLE_ROWS)
+    parser.add_argument("--verbose", action="store_true", help="print every captured query plan")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-5.5s [%(name)s] %(message)s")
+    os.environ.setdefault("SIDEP_SCHEDULER_ENABLED", "0")
+
+    if args.url:
+        # database (engine、read_engine、SessionLocal) 與 sharding 在匯入時依 SIDEP_DATABASE_URL 建立，必須在匯入之前設定
+        os.environ["SIDEP_DATABASE_URL"] = args.url
+    import database
+
+    reports = run_checks(database.engine, args.min_rows)
+    _print_report(reports, args.verbose)
+    failed = [report for report in reports if report.failed]
+    print(f"{len(reports) - len(failed)} passed, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal, run_in_transaction
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_MAX_ENTRIES = 10000
+# 其他 worker 仍在執行同一個 key 的請求時，等待它完成的時間上限與輪詢間隔
+IDEMPOTENCY_WAIT_SECONDS = 30
+IDEMPOTENCY_POLL_SECONDS = 0.2
+# 執行中的紀錄超過這個時間仍沒有結果，視為該 worker 已中止，由下一個請求接手
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = 5 * 60
+
+CLAIMED, PENDING, DONE = "claimed", "pending", "done"
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "future", "expires_at")
+
+    def __init__(self, fingerprint: str, future: asyncio.Future, expires_at: float):
+        self.fingerprint = fingerprint
+        self.future = future
+        self.expires_at = expires_at
+
+
+def request_fingerprint(payload: Any) -> str:
+    # 同一個 Idempotency-Key 只能搭配相同的請求內容
+    if isinstance(payload, BaseModel):
+        payload = payload.model_dump_json()
+    return hashlib.sha256(str(payload).encode()).hexdigest()
+
+
+def _key_hash(scope: Hashable, idempotency_key: str) -> str:
+    return hashlib.sha256(f"{scope!r}\0{idempotency_key}".encode()).hexdigest()
+
+
+def _insert_ignoring_duplicates(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Idempotency keys are not supported on {dialect}")
+    return insert(models.IdempotencyKey.__table__).on_conflict_do_nothing(index_elements=["key_hash"])
+
+
+def _mismatch():
+    return HTTPException(
+        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        detail=f"{IDEMPOTENCY_HEADER} has already been used with a different request payload",
+    )
+
+
+class IdempotencyStore:
+    # 依 (端點, 使用者/owner, Idempotency-Key) 保存第一次執行的結果，超過 TTL 後淘汰
+    # 結果保存在資料庫 (idempotency_keys)，重試的請求送到其他 worker 也會得到相同的結果；
+    # 記憶體中另外保留最近的結果，同一個 worker 中同一個 key 的並行請求直接等待第一個請求，不必輪詢資料庫
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL_SECONDS, max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+                 wait_seconds: float = IDEMPOTENCY_WAIT_SECONDS, pending_timeout: float = IDEMPOTENCY_PENDING_TIMEOUT_SECONDS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        self.pending_timeout = pending_timeout
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now: float):
+        # 依插入順序淘汰已過期的結果；超過上限時淘汰最舊的已完成結果，執行中的請求略過不淘汰
+        for key, entry in list(self._entries.items()):
+            if entry.expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            if entry.future.done():
+                del self._entries[key]
+
+    def _claim(self, key_hash: str, fingerprint: str) -> Tuple[str, Optional[str]]:
+        # 新增執行中的紀錄 (CLAIMED)；已有紀錄時回傳 (PENDING, None) 或 (DONE, 已保存的回應)
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            table = models.IdempotencyKey.__table__
+            db.execute(delete(table).where(table.c.key_hash == key_hash, table.c.expires_at <= now))
+            values = {"key_hash": key_hash, "fingerprint": fingerprint, "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}
+            if db.execute(_insert_ignoring_duplicates(db).values(**values)).rowcount:
+                db.commit()
+                return CLAIMED, None
+            row = db.execute(select(table.c.fingerprint, table.c.response, table.c.created_at).where(table.c.key_hash == key_hash)).first()
+            if row is None:
+                # 剛好被執行失敗的請求刪除
+                db.rollback()
+                return PENDING, None
+            if row.fingerprint != fingerprint:
+                db.rollback()
+                raise _mismatch()
+            if row.response is not None:
+                db.rollback()
+                return DONE, row.response
+            if row.created_at <= now - timedelta(seconds=self.pending_timeout):
+                taken = db.execute(update(table).where(
+                    table.c.key_hash == key_hash, table.c.response.is_(None), table.c.created_at == row.created_at
+                ).values(created_at=now)).rowcount
+                db.commit()
+                return (CLAIMED, None) if taken else (PENDING, None)
+            db.rollback()
+            return PENDING, None
+        finally:
+            db.close()
+
+    def _complete(self, key_hash: str, response: str):
+        db = SessionLocal()
+        try:
+            table = models.IdempotencyKey.__table__
+            db.execute(update(table).where(table.c.key_hash == key_hash).values(
+                response=response, expires_at=datetime.utcnow() + timedelta(seconds=self.ttl)
+            ))
+            db.commit()
+        finally:
+            db.close()
+
+    def _release(self, key_hash: str):
+        db = SessionLocal()
+        try:
+            table = models.IdempotencyKey.__table__
+            db.execute(delete(table).where(table.c.key_hash == key_hash, table.c.response.is_(None)))
+            db.commit()
+        finally:
+            db.close()
+
+    async def _run_once(self, key_hash: str, fingerprint: str, func: Callable[[], Any]):
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            state, response = await run_in_threadpool(self._claim, key_hash, fingerprint)
+            if state == CLAIMED:
+                break
+            if state == DONE:
+                # 其他 worker 已完成：回傳它保存的回應 (FastAPI 依 response_model 輸出，與第一次相同)
+                self.hits += 1
+                return json.loads(response)
+            if time.monotonic() >= deadline:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"A request with this {IDEMPOTENCY_HEADER} is still in progress",
+                    headers={"Retry-After": str(max(int(self.wait_seconds), 1))},
+                )
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+        self.misses += 1
+        try:
+            result = await run_in_threadpool(func)
+        except BaseException:
+            # 失敗的請求不保留結果，客戶端可以用同一個 key 重試
+            await asyncio.shield(run_in_threadpool(self._release, key_hash))
+            raise
+        try:
+            await asyncio.shield(run_in_threadpool(self._complete, key_hash, json.dumps(jsonable_encoder(result))))
+        except Exception:
+            # 資源已經建立：仍回傳結果；重試的請求在 pending_timeout 之前收到 409
+            logger.exception("Failed to store the idempotent response")
+        return result
+
+    async def run(self, scope: Hashable, idempotency_key: Optional[str], payload: Any, func: Callable[[], Any], db: Optional[Session] = None):
+        # func 是同步函式，在 threadpool 中執行；傳入 db 時 func 的交易也在同一個執行緒中結束 (database.run_in_transaction)
+        if db is not None:
+            func = functools.partial(run_in_transaction, db, func)
+        if not idempotency_key:
+            return await run_in_threadpool(func)
+
+        now = time.monotonic()
+        self._evict(now)
+        key = (scope, idempotency_key)
+        fingerprint = request_fingerprint(payload)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                raise _mismatch()
+            self.hits += 1
+            return await asyncio.shield(entry.future)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = _Entry(fingerprint, future, now + self.ttl)
+        self._entries[key] = entry
+        try:
+            result = await self._run_once(_key_hash(scope, idempotency_key), fingerprint, func)
+        except BaseException as exc:
+            self._entries.pop(key, None)
+            if isinstance(exc, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(exc)
+                future.exception()
+            raise
+        future.set_result(result)
+        entry.expires_at = time.monotonic() + self.ttl
+        return result
+
+
+idempotency_store = IdempotencyStore()
@@ -1,8 +1,19 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
 import random
+import secrets
 import string
 import uuid
-from fastapi import FastAPI, Depends, HTTPException, status, APIRouter
-from sqlalchemy.orm import Session, joinedload
+from fastapi import FastAPI, Depends, HTTPException, status, APIRouter, Request, Header, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from sqlalchemy import and_, insert, or_, select, union_all, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, load_only, selectinload
 from passlib.context import CryptContext
 from typing import List, Optional
 from datetime import date, datetime, time, timedelta
@@ -12,8 +23,20 @@ from fastapi import Security
 from fastapi.security.http import HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 
-from database import engine, Base, get_db
+from audit import audit_log
+from calendar_feed import calendar_feed_cache
+from database import engine, read_engine, Base, SessionLocal, get_db
+from events import booking_broker, InMemoryBridge, PostgresNotifyBridge
+from idempotency import idempotency_store, IDEMPOTENCY_HEADER
+from analytics import analytics_cache
+from occupancy import occupancy_cache
+from profiling import ProfilingMiddleware, PROFILE_DIR
+from scheduler import Scheduler, PostgresAdvisoryLock, FileLock
+from singleflight import coalesce
 import models, schemas
+import analytics, archive, audit, booking_versions, calendar_feed, capacity, clients, database, maintenance, media, metrics, occupancy, sharding, tenancy
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="Sidep App Backend API",
@@ -48,7 +71,68 @@ app.add_middleware(
 # 創建所有資料庫表格
 @app.on_event("startup")
 async def startup_event():
-    Base.metadata.create_all(bind=engine)
+    # 每個分片都有完整的 schema (主資料庫以外的分片只使用店家資料的表)
+    for shard in sharding.shards.values():
+        Base.metadata.create_all(bind=shard.engine)
+    # 多 worker 部署時透過 PostgreSQL LISTEN/NOTIFY 在程序之間轉送預約事件
+    bridge = PostgresNotifyBridge(engine) if engine.dialect.name == "postgresql" else InMemoryBridge()
+    booking_broker.start(asyncio.get_running_loop(), bridge)
+    # 預約狀態變更紀錄的背景寫入執行緒 (每個 worker 一個)，啟動時先重送上次未寫入的紀錄
+    audit_log.start(SessionLocal)
+    # serve.py 啟動多個 worker 時設定 SIDEP_METRICS_DIR，/metrics 回傳所有 worker 合併後的值
+    if METRICS_DIR:
+        metrics.registry.start_snapshots(METRICS_DIR, METRICS_SNAPSHOT_SECONDS)
+    if SCHEDULER_ENABLED:
+        # 多個 worker 之間只有取得 advisory lock (或檔案鎖) 的 leader 會執行維護工作
+        scheduler.election = PostgresAdvisoryLock(engine) if engine.dialect.name == "postgresql" else FileLock()
+        _register_maintenance_jobs()
+        scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    booking_broker.stop()
+    audit_log.stop()
+    metrics.registry.stop_snapshots()
+    # 處理中的請求都已完成，歸還並關閉連線池中的連線
+    for shard in sharding.shards.values():
+        shard.engine.dispose()
+
+# 應用程式內的排程器，可用 SIDEP_SCHEDULER_ENABLED=0 停用 (例如執行一次性的腳本時)
+SCHEDULER_ENABLED = os.environ.get("SIDEP_SCHEDULER_ENABLED", "1") != "0"
+scheduler = Scheduler()
+
+def _with_session(job):
+    def run():
+        # 工作在 commit 之後仍會讀取物件 (例如發佈事件)，不需要重新載入
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            return job(db)
+        finally:
+            db.close()
+    return run
+
+def _on_each_shard(job):
+    # 店家資料的維護工作在每個分片各執行一次
+    def run(db):
+        # 處理筆數為各分片的合計 (排程器的 processed 指標)
+        return sum(job(db) or 0 for _ in sharding.each_shard(db))
+    return run
+
+def _register_maintenance_jobs():
+    scheduler.every("purge_blacklisted_tokens", 15 * 60, _with_session(
+        lambda db: maintenance.purge_expired_blacklisted_tokens(db, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    ))
+    scheduler.every("purge_idempotency_keys", 60 * 60, _with_session(maintenance.purge_expired_idempotency_keys))
+    scheduler.every("complete_past_bookings", 5 * 60, _with_session(_on_each_shard(
+        lambda db: maintenance.complete_past_bookings(db, on_completed=lambda booking: booking_broker.publish(booking.owner_id, _booking_event("booking.updated", booking)))
+    )))
+    scheduler.cron("archive_old_bookings", "30 3 * * *", _with_session(_on_each_shard(
+        lambda db: archive.archive_old_bookings(db, max_batches=50)
+    )))
+    scheduler.every("purge_past_resource_slots", 60 * 60, _with_session(_on_each_shard(maintenance.purge_past_resource_slots)))
+    scheduler.every("purge_past_occupancy_days", 60 * 60, _with_session(_on_each_shard(maintenance.purge_past_occupancy_days)))
+    scheduler.cron("purge_unreferenced_media", "15 4 * * *", _with_session(media.purge_unreferenced_media))
 
 # JWT 相關配置
 SECRET_KEY = "nail-beautiful-and-secret-key-for-your-fastapi-app-TTTEEEDDD" # 請替換為一個複雜且保密的字串
@@ -87,17 +171,21 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Security(bearer
     except JWTError:
         raise credentials_exception
 
-    # 檢查 token 是否在黑名單中
-    blacklisted_token = db.query(models.BlacklistedToken).filter(models.BlacklistedToken.token == token).first()
-    if blacklisted_token:
+    # 檢查 token 是否在黑名單中 (每個請求都會執行，使用 tenancy.py 預先建立的語句)
+    if tenancy.token_blacklisted(db, token):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been blacklisted")
 
-    user = db.query(models.User).filter(models.User.id == int(user_id)).first()
+    user = tenancy.user_by_id(db, int(user_id))
     if user is None:
         raise credentials_exception
+    if user.role == "admin":
+        # 之後的店家資料查詢送到店家所在的分片
+        sharding.use_tenant(db, user.id)
+    # 在這個 threadpool 執行緒中結束認證的交易 (以及 SQLite 的寫入鎖)，端點的交易另外開始
+    database.end_transaction(db)
     return user
 
-async def get_optional_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Security(optional_bearer_scheme), db: Session = Depends(get_db)) -> Optional[models.User]:
+def get_optional_current_user(credentials: Optional[HTTPAuthorizationCredentials] = Security(optional_bearer_scheme), db: Session = Depends(get_db)) -> Optional[models.User]:
     if credentials is None:
         return None
     token = credentials.credentials
@@ -109,11 +197,13 @@ async def get_optional_current_user(credentials: Optional[HTTPAuthorizationCrede
     except JWTError:
         return None
 
-    blacklisted_token = db.query(models.BlacklistedToken).filter(models.BlacklistedToken.token == token).first()
-    if blacklisted_token:
+    if tenancy.token_blacklisted(db, token):
         return None
 
-    user = db.query(models.User).filter(models.User.id == int(user_id)).first()
+    user = tenancy.user_by_id(db, int(user_id))
+    if user is not None and user.role == "admin":
+        sharding.use_tenant(db, user.id)
+    database.end_transaction(db)
     return user
 
 def get_current_admin_user(current_user: models.User = Depends(get_current_user)):
@@ -121,6 +211,128 @@ def get_current_admin_user(current_user: models.User = Depends(get_current_user)
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
     return current_user
 
+def get_tenant(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)) -> tenancy.Tenant:
+    # 管理員自己的資料範圍：透過 tenant 的查詢都自動加上 owner_id 條件
+    return tenancy.Tenant(db, current_user.id, current_user)
+
+# 按需 profiling：SIDEP_PROFILING_ENABLED=1 時才加入 middleware，停用時請求不會經過任何 profiling 程式碼
+# 管理員帶 X-Profile: 1 (或 sample / cprofile) 標頭，或依 SIDEP_PROFILE_SAMPLE_RATE 抽樣，結果 id 放在 X-Profile-Id 回應標頭
+PROFILING_ENABLED = os.environ.get("SIDEP_PROFILING_ENABLED", "0") == "1"
+
+def _is_admin_request(headers: dict) -> bool:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    db = SessionLocal(bind=read_engine)
+    try:
+        user = get_current_user(HTTPAuthorizationCredentials(scheme=scheme, credentials=token), db)
+    except HTTPException:
+        return False
+    finally:
+        db.close()
+    return user.role == "admin"
+
+if PROFILING_ENABLED:
+    app.add_middleware(
+        ProfilingMiddleware,
+        directory=os.environ.get("SIDEP_PROFILE_DIR", PROFILE_DIR),
+        sample_rate=float(os.environ.get("SIDEP_PROFILE_SAMPLE_RATE", "0")),
+        default_mode=os.environ.get("SIDEP_PROFILE_MODE", "sample"),
+        authorize=_is_admin_request,
+    )
+
+# Prometheus 指標：路由延遲與狀態碼由 middleware 記錄，其餘在抓取 /metrics 時讀取目前狀態
+app.add_middleware(metrics.MetricsMiddleware)
+METRICS_DIR = os.environ.get("SIDEP_METRICS_DIR")
+METRICS_SNAPSHOT_SECONDS = float(os.environ.get("SIDEP_METRICS_SNAPSHOT_SECONDS", "1"))
+
+db_pool_connections = metrics.registry.gauge("sidep_db_pool_connections", "Database connections held by the pool", ("state",))
+db_pool_size = metrics.registry.gauge("sidep_db_pool_size", "Configured database pool size")
+sse_subscribers = metrics.registry.gauge("sidep_sse_subscribers", "Open booking event streams")
+scheduler_is_leader = metrics.registry.gauge("sidep_scheduler_is_leader", "1 when this worker runs the leader-only scheduled jobs")
+scheduler_job_runs_total = metrics.registry.counter("sidep_scheduler_job_runs_total", "Scheduled job runs", ("job",))
+scheduler_job_failures_total = metrics.registry.counter("sidep_scheduler_job_failures_total", "Scheduled job failures", ("job",))
+scheduler_job_last_duration = metrics.registry.gauge("sidep_scheduler_job_last_duration_seconds", "Duration of the last run of each scheduled job", ("job",), merge="max")
+scheduler_job_lag = metrics.registry.gauge("sidep_scheduler_job_lag_seconds", "How late the last run of each scheduled job started", ("job",), merge="max")
+scheduler_job_processed_total = metrics.registry.counter("sidep_scheduler_job_processed_total", "Rows processed by scheduled jobs", ("job",))
+
+@metrics.registry.collector
+def _collect_runtime_metrics():
+    pool = engine.pool
+    # SQLite 的 SingletonThreadPool 等連線池沒有這些統計
+    if hasattr(pool, "checkedout"):
+        db_pool_size.set(pool.size())
+        db_pool_connections.set(pool.checkedout(), state="checked_out")
+        db_pool_connections.set(pool.checkedin(), state="idle")
+        db_pool_connections.set(max(pool.overflow(), 0), state="overflow")
+    metrics.cache_requests_total.set_total(idempotency_store.hits, cache="idempotency", result="hit")
+    metrics.cache_requests_total.set_total(idempotency_store.misses, cache="idempotency", result="miss")
+    metrics.cache_entries.set(len(idempotency_store), cache="idempotency")
+    metrics.cache_requests_total.set_total(calendar_feed_cache.hits, cache="calendar_feed", result="hit")
+    metrics.cache_requests_total.set_total(calendar_feed_cache.misses, cache="calendar_feed", result="miss")
+    metrics.cache_entries.set(len(calendar_feed_cache), cache="calendar_feed")
+    metrics.cache_requests_total.set_total(occupancy_cache.hits, cache="occupancy", result="hit")
+    metrics.cache_requests_total.set_total(occupancy_cache.misses, cache="occupancy", result="miss")
+    metrics.cache_entries.set(len(occupancy_cache), cache="occupancy")
+    metrics.cache_requests_total.set_total(analytics_cache.hits, cache="analytics", result="hit")
+    metrics.cache_requests_total.set_total(analytics_cache.misses, cache="analytics", result="miss")
+    metrics.cache_entries.set(len(analytics_cache), cache="analytics")
+    sse_subscribers.set(booking_broker.subscriber_count())
+    scheduler_is_leader.set(1 if scheduler.is_leader else 0)
+    for job in list(scheduler.jobs.values()):
+        scheduler_job_runs_total.set_total(job.runs, job=job.name)
+        scheduler_job_failures_total.set_total(job.failures, job=job.name)
+        scheduler_job_processed_total.set_total(job.processed, job=job.name)
+        if job.last_duration is not None:
+            scheduler_job_last_duration.set(job.last_duration, job=job.name)
+        if job.last_lag is not None:
+            scheduler_job_lag.set(job.last_lag, job=job.name)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
+# 稀疏欄位 (?fields=id,name)：只查詢並回傳指定的欄位
+FIELDS_QUERY = Query(None, description="Comma-separated list of fields to return, e.g. id,name")
+
+def _parse_fields(fields: Optional[str], allowed) -> Optional[List[str]]:
+    if not fields:
+        return None
+    requested = list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def _sparse_response(items: List[dict]) -> JSONResponse:
+    # 欄位已經過篩選，不再經過完整的 response_model 驗證
+    return JSONResponse(content=jsonable_encoder(items))
+
+def _column_projection(query, model, fields: List[str]):
+    rows = query.with_entities(*[getattr(model, field) for field in fields]).all()
+    return [dict(row._mapping) for row in rows]
+
+SERVICE_FIELDS = ("id", "name", "description", "price", "min_duration", "max_duration", "is_active", "category", "image_url")
+CLIENT_FIELDS = ("id", "user_id", "name", "email", "phone", "booking_count", "visit_count", "lifetime_spend", "last_visit_at", "next_visit_at", "created_at")
+# 預約回應欄位對應到需要載入的資料表欄位
+BOOKING_FIELD_COLUMNS = {
+    "id": ("id",),
+    "booking_reference_id": ("booking_reference_id",),
+    "user_id": ("user_id",),
+    "service_id": ("service_id",),
+    "date": ("start_at", "date"),
+    "time": ("start_at", "time"),
+    "start_at": ("start_at",),
+    "end_at": ("end_at",),
+    "resource_id": ("resource_id",),
+    "status": ("status",),
+    "notes": ("notes",),
+    "created_at": ("created_at",),
+    "updated_at": ("updated_at",),
+    "clientName": ("user_id", "customer_name"),
+    "serviceName": (),
+}
+
 # 認證路由
 auth_router = APIRouter(prefix="/auth", tags=["Auth"])
 
@@ -130,8 +342,7 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-@auth_router.post("/register", response_model=schemas.UserResponse)
-async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+def _register_user(user: schemas.UserCreate, db: Session) -> schemas.UserResponse:
     db_user = db.query(models.User).filter(models.User.email == user.email).first()
     if db_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
@@ -150,12 +361,20 @@ async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db))
 
     db_user = models.User(email=user.email, name=user.name, phone_number=user.phone_number, role=user.role, password=hashed_password, public_slug=public_slug)
     db.add(db_user)
+    if user.role == "admin":
+        # 店家的預設營業時間在註冊時建立，讀取營業設定時不需要寫入
+        db.flush()
+        db.add_all(_default_business_hours(db_user.id))
     db.commit()
     db.refresh(db_user)
-    return db_user
+    return schemas.UserResponse.model_validate(db_user)
+
+@auth_router.post("/register", response_model=schemas.UserResponse)
+async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db), idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    return await idempotency_store.run(("register", user.email), idempotency_key, user, lambda: _register_user(user, db), db)
 
 @auth_router.post("/login")
-async def login_for_access_token(user_data: schemas.UserLogin, db: Session = Depends(get_db)):
+def login_for_access_token(user_data: schemas.UserLogin, db: Session = Depends(get_db)):
     db_user = db.query(models.User).filter(models.User.email == user_data.email).first()
     if not db_user or not verify_password(user_data.password, db_user.password):
         raise HTTPException(
@@ -170,7 +389,7 @@ async def login_for_access_token(user_data: schemas.UserLogin, db: Session = Dep
     return {"access_token": access_token, "token_type": "bearer", "user_id": db_user.id, "user_role": db_user.role}
 
 @auth_router.post("/logout", status_code=status.HTTP_200_OK)
-async def logout_user(credentials: HTTPBearer = Depends(bearer_scheme), db: Session = Depends(get_db)):
+def logout_user(credentials: HTTPBearer = Depends(bearer_scheme), db: Session = Depends(get_db)):
     token = credentials.credentials
     blacklisted_token = models.BlacklistedToken(token=token)
     db.add(blacklisted_token)
@@ -183,19 +402,21 @@ app.include_router(auth_router)
 service_router = APIRouter(prefix="/services", tags=["Services"])
 
 @service_router.get("/", response_model=List[schemas.ServiceResponse])
-async def get_all_services(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    services = db.query(models.Service).filter(models.Service.owner_id == current_user.id).all()
-    return services
+def get_all_services(ids: Optional[List[int]] = Query(None), fields: Optional[str] = FIELDS_QUERY, tenant: tenancy.Tenant = Depends(get_tenant)):
+    selected_fields = _parse_fields(fields, SERVICE_FIELDS)
+    if selected_fields:
+        query = tenant.query(models.Service)
+        if ids:
+            query = query.filter(models.Service.id.in_(ids))
+        return _sparse_response(_column_projection(query, models.Service, selected_fields))
+    # 詳細頁可以用 ids 一次取得多筆服務，避免逐筆呼叫 GET /services/{service_id}
+    return tenant.all(models.Service, ids)
 
 @service_router.get("/{service_id}", response_model=schemas.ServiceResponse)
-async def get_service(service_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    service = db.query(models.Service).filter(models.Service.id == service_id, models.Service.owner_id == current_user.id).first()
-    if service is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Service not found")
-    return service
+def get_service(service_id: int, tenant: tenancy.Tenant = Depends(get_tenant)):
+    return tenant.get_or_404(models.Service, service_id, "Service not found")
 
-@service_router.post("/", response_model=schemas.ServiceResponse, status_code=status.HTTP_201_CREATED)
-async def create_service(service: schemas.ServiceCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
+def _create_service(service: schemas.ServiceCreate, db: Session, current_user: models.User) -> schemas.ServiceResponse:
     db_service = models.Service(
         owner_id=current_user.id,
         name=service.name,
@@ -210,27 +431,58 @@ async def create_service(service: schemas.ServiceCreate, db: Session = Depends(g
     db.add(db_service)
     db.commit()
     db.refresh(db_service)
-    return db_service
+    return schemas.ServiceResponse.model_validate(db_service)
+
+@service_router.post("/", response_model=schemas.ServiceResponse, status_code=status.HTTP_201_CREATED)
+async def create_service(service: schemas.ServiceCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user), idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)):
+    return await idempotency_store.run(("create_service", current_user.id), idempotency_key, service, lambda: _create_service(service, db, current_user), db)
 
 @service_router.put("/{service_id}", response_model=schemas.ServiceResponse)
-async def update_service(service_id: int, service: schemas.ServiceCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_service = db.query(models.Service).filter(models.Service.id == service_id, models.Service.owner_id == current_user.id).first()
-    if db_service is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Service not found")
+def update_service(service_id: int, service: schemas.ServiceCreate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_service = tenant.get_or_404(models.Service, service_id, "Service not found")
     
     update_data = service.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(db_service, key, value)
+    # 服務名稱會出現在行事曆訂閱中
+    booking_versions.bump(db, [tenant.owner_id])
     
     db.commit()
     db.refresh(db_service)
     return db_service
 
+# 圖片上傳：請求本體直接是圖片內容 (Content-Type: image/png 等)，邊接收邊寫入，不需要 multipart 解析
+MEDIA_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {content_type: {"schema": {"type": "string", "format": "binary"}} for content_type in media.IMAGE_TYPES},
+    }
+}
+
+async def _upload_media(request: Request) -> str:
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > media.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f"File exceeds {media.MAX_UPLOAD_BYTES} bytes")
+    # 接收檔案可能需要數秒，期間不持有交易 (以及 SQLite 的寫入鎖)；前後的資料庫操作各自在 threadpool 中完成
+    return await media.store_upload(request.stream(), request.headers.get("content-type", ""))
+
+def _set_service_image(db: Session, tenant: tenancy.Tenant, service_id: int, image_url: str) -> schemas.ServiceResponse:
+    db_service = tenant.get_or_404(models.Service, service_id, "Service not found")
+    db_service.image_url = image_url
+    db.commit()
+    db.refresh(db_service)
+    return schemas.ServiceResponse.model_validate(db_service)
+
+@service_router.put("/{service_id}/image", response_model=schemas.ServiceResponse, openapi_extra=MEDIA_UPLOAD_OPENAPI)
+async def upload_service_image(service_id: int, request: Request, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    # 先確認服務存在，再接收檔案
+    await run_in_threadpool(database.run_in_transaction, db, lambda: tenant.get_or_404(models.Service, service_id, "Service not found"))
+    image_url = media.media_url(await _upload_media(request))
+    return await run_in_threadpool(database.run_in_transaction, db, lambda: _set_service_image(db, tenant, service_id, image_url))
+
 @service_router.patch("/{service_id}/status", response_model=schemas.ServiceResponse)
-async def update_service_status(service_id: int, status_update: schemas.ServiceStatusUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_service = db.query(models.Service).filter(models.Service.id == service_id, models.Service.owner_id == current_user.id).first()
-    if db_service is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Service not found")
+def update_service_status(service_id: int, status_update: schemas.ServiceStatusUpdate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_service = tenant.get_or_404(models.Service, service_id, "Service not found")
     
     db_service.is_active = status_update.is_active
     db.commit()
@@ -238,21 +490,19 @@ async def update_service_status(service_id: int, status_update: schemas.ServiceS
     return db_service
 
 @service_router.delete("/{service_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_service(service_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_service = db.query(models.Service).filter(models.Service.id == service_id, models.Service.owner_id == current_user.id).first()
-    if db_service is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Service not found")
+def delete_service(service_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_service = tenant.get_or_404(models.Service, service_id, "Service not found")
     
     db.delete(db_service)
     db.commit()
     return
 
 @service_router.post("/bulk-action", status_code=status.HTTP_200_OK)
-async def bulk_service_action(request: schemas.BulkServiceActionRequest, db: Session = Depends(get_db), current_user: schemas.UserResponse = Depends(get_current_admin_user)):
+def bulk_service_action(request: schemas.BulkServiceActionRequest, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
     if request.action not in ["activate", "deactivate", "delete"]:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid action specified")
 
-    services_to_update = db.query(models.Service).filter(models.Service.id.in_(request.service_ids), models.Service.owner_id == current_user.id).all()
+    services_to_update = tenant.all(models.Service, request.service_ids) if request.service_ids else []
 
     if not services_to_update:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No services found for the given IDs")
@@ -273,12 +523,157 @@ app.include_router(service_router)
 # 預約路由
 booking_router = APIRouter(prefix="/bookings", tags=["Bookings"])
 
-@booking_router.post("/", response_model=schemas.BookingResponse, status_code=status.HTTP_201_CREATED)
-async def create_booking(
-    booking: schemas.BookingCreate,
-    db: Session = Depends(get_db),
-    current_user: Optional[models.User] = Depends(get_optional_current_user)
-):
+SSE_HEARTBEAT_SECONDS = 15
+
+def _booking_event(event_type: str, booking: models.Booking) -> dict:
+    # 必須在 commit 之前 (刪除時) 或 refresh 之後建立，避免讀到已過期的屬性
+    return {
+        "type": event_type,
+        "booking_id": booking.id,
+        "booking_reference_id": booking.booking_reference_id,
+        "service_id": booking.service_id,
+        "user_id": booking.user_id,
+        "date": booking.date.isoformat() if booking.date else None,
+        "time": booking.time,
+        "start_at": booking.start_at.isoformat() if booking.start_at else None,
+        "end_at": booking.end_at.isoformat() if booking.end_at else None,
+        "status": booking.status,
+        "series_id": booking.series_id,
+        "resource_id": booking.resource_id,
+    }
+
+def _parse_booking_time(value: str) -> time:
+    for fmt in ("%H:%M", "%H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt).time()
+        except ValueError:
+            continue
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid booking time, expected HH:MM")
+
+def _booking_window(booking_date: date, booking_time: str, duration_minutes: int):
+    # 預約的開始與結束時間，結束時間以服務的最長時長計算
+    start_at = datetime.combine(booking_date, _parse_booking_time(booking_time))
+    return start_at, start_at + timedelta(minutes=duration_minutes)
+
+def _reserve_booking_slot(db: Session, service: models.Service, owner_id: int, start_at: datetime, end_at: datetime, resource_id: Optional[int] = None) -> Optional[int]:
+    # 服務設定了資源時以每格計數預留一個資源，否則維持同一時段只能有一筆預約的規則
+    if capacity.service_uses_resources(db, service.id):
+        reserved = capacity.reserve_any(db, service.id, start_at, end_at, resource_id)
+        if reserved is None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="No resource is available for the selected time slot")
+        return reserved
+    if resource_id is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This service has no resources to choose from")
+    if occupancy.conflicting(db, owner_id, [(start_at, end_at)]):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The selected time slot is already booked")
+    return None
+
+def _reserve_moved_booking(db: Session, booking: models.Booking, start_at: datetime, end_at: datetime) -> Optional[int]:
+    # 改期時先釋放原本的格子，優先保留同一個資源；沒有空位時回傳 None
+    capacity.release(db, booking.resource_id, booking.start_at, booking.end_at)
+    return capacity.reserve_any(db, booking.service_id, start_at, end_at, booking.resource_id) or capacity.reserve_any(db, booking.service_id, start_at, end_at)
+
+def _check_initial_status(status_value: Optional[str]):
+    if status_value not in audit.INITIAL_BOOKING_STATUSES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A new booking must be one of: {', '.join(audit.INITIAL_BOOKING_STATUSES)}")
+
+def _check_status_transition(old_status: Optional[str], new_status: str):
+    # 狀態機定義在 audit.py；未知的狀態回傳 400，不允許的變更回傳 409
+    if new_status not in audit.BOOKING_STATUS_TRANSITIONS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown booking status: {new_status}")
+    if not audit.transition_allowed(old_status, new_status):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Cannot change a {old_status} booking to {new_status}")
+
+def _sync_booking_capacity(db: Session, booking: models.Booking, old_status: Optional[str]):
+    # 取消時釋放資源的格子，從取消恢復時重新預留
+    if booking.resource_id is None:
+        return
+    was_active = old_status not in capacity.RELEASED_STATUSES
+    is_active = booking.status not in capacity.RELEASED_STATUSES
+    if was_active and not is_active:
+        capacity.release(db, booking.resource_id, booking.start_at, booking.end_at)
+    elif is_active and not was_active:
+        resource = db.get(models.Resource, booking.resource_id)
+        if resource is None or not capacity.reserve(db, resource, booking.start_at, booking.end_at):
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="The booking's resource is no longer available for this time slot")
+
+def _sync_booking_occupancy(db: Session, booking: models.Booking, old_status: Optional[str]):
+    # 取消時重新計算當天的位元圖 (同一格可能還有其他資源的預約)，從取消恢復時直接加上
+    was_active = old_status not in occupancy.RELEASED_STATUSES
+    is_active = booking.status not in occupancy.RELEASED_STATUSES
+    if was_active and not is_active:
+        occupancy.refresh(db, booking.owner_id, occupancy.affected_days([(booking.start_at, booking.end_at)]))
+    elif is_active and not was_active:
+        occupancy.occupy(db, booking.owner_id, [(booking.start_at, booking.end_at)])
+
+def _booking_response(booking: models.Booking, client_name: Optional[str], service_name: Optional[str]) -> schemas.BookingResponse:
+    # 舊資料尚未回填 start_at 時，退回使用原本的 date/time 欄位
+    if booking.start_at is not None:
+        booking_date, booking_time = booking.start_at.date(), booking.start_at.strftime("%H:%M")
+    else:
+        booking_date, booking_time = booking.date, booking.time
+    return schemas.BookingResponse(
+        id=booking.id,
+        booking_reference_id=booking.booking_reference_id,
+        user_id=booking.user_id,
+        service_id=booking.service_id,
+        date=booking_date,
+        time=booking_time,
+        start_at=booking.start_at,
+        end_at=booking.end_at,
+        resource_id=booking.resource_id,
+        status=booking.status,
+        notes=booking.notes if booking.notes is not None else "",
+        created_at=booking.created_at,
+        updated_at=booking.updated_at,
+        clientName=client_name,
+        serviceName=service_name,
+    )
+
+def _sparse_booking(booking, client_name: Optional[str], service_name: Optional[str], fields: List[str]) -> dict:
+    values = {}
+    for field in fields:
+        if field == "clientName":
+            values[field] = client_name
+        elif field == "serviceName":
+            values[field] = service_name
+        elif field == "date":
+            values[field] = booking.start_at.date() if booking.start_at is not None else (booking.date.date() if booking.date else None)
+        elif field == "time":
+            values[field] = booking.start_at.strftime("%H:%M") if booking.start_at is not None else booking.time
+        else:
+            values[field] = getattr(booking, field)
+    return values
+
+def _booking_load_only(model, fields: List[str]):
+    # 主鍵一定要載入 (serviceName 等欄位不需要任何預約欄位，load_only 不能沒有欄位；客戶名稱也以 id 對應)
+    columns = {"id"} | {column for field in fields for column in BOOKING_FIELD_COLUMNS[field]}
+    return load_only(*[getattr(model, column) for column in sorted(columns)])
+
+def _filter_booking_range(query, start: Optional[datetime], end: Optional[datetime], model=models.Booking):
+    if start is not None:
+        query = query.filter(model.end_at > start)
+    if end is not None:
+        query = query.filter(model.start_at < end)
+    return query
+
+def _client_names(db: Session, bookings) -> dict:
+    # 一次查出所有會員預約的客戶名稱，匿名預約使用 customer_name
+    user_ids = {booking.user_id for booking in bookings if booking.user_id}
+    names = {}
+    if user_ids:
+        names = dict(db.query(models.User.id, models.User.name).filter(models.User.id.in_(user_ids)).all())
+    return {booking.id: names.get(booking.user_id) if booking.user_id else booking.customer_name for booking in bookings}
+
+def _archived_bookings_query(db: Session, *criteria):
+    # 封存表沒有外鍵與 relationship，服務名稱以明確的條件 join
+    return db.query(
+        models.BookingArchive,
+        models.Service.name.label("service_name")
+    ).outerjoin(models.Service, models.Service.id == models.BookingArchive.service_id).filter(*criteria)
+
+def _resolve_booking_owner(booking, db: Session, current_user: Optional[models.User]) -> int:
+    # booking 可以是 BookingCreate 或 BookingSeriesCreate，兩者的 owner 與客戶欄位規則相同
     owner_id = None
     if booking.public_slug:
         owner_user = db.query(models.User).filter(models.User.public_slug == booking.public_slug, models.User.role == "admin").first()
@@ -289,20 +684,33 @@ async def create_booking(
         owner_id = current_user.id
     else:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Authentication required or public slug missing")
+    sharding.use_tenant(db, owner_id)
 
     # 如果提供了 user_id，則檢查是否與當前登入用戶匹配
     # 管理員可以為任何用戶創建預約，所以如果當前用戶是管理員，則跳過此檢查
     if booking.user_id is not None:
         if current_user is None or (current_user.role != "admin" and booking.user_id != current_user.id):
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Cannot create booking for another user or without proper authentication")
+        # 店家不在主資料庫時，預約參照的會員先複製到店家所在的分片 (外鍵)
+        sharding.mirror_user(db, booking.user_id)
     else:
         # 如果沒有提供 user_id，則必須提供客戶姓名、Email和電話
         if not booking.customer_name or not booking.customer_email or not booking.customer_phone:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Customer name, email, and phone are required for anonymous bookings")
+    return owner_id
+
+def _owned_service(db: Session, service_id: int, owner_id: int) -> models.Service:
+    # 預約的店家可能來自公開頁面的 slug，不一定是目前登入的使用者
+    return tenancy.Tenant(db, owner_id).get_or_404(models.Service, service_id, "Service not found or not owned by the specified owner")
+
+def _create_booking(booking: schemas.BookingCreate, db: Session, current_user: Optional[models.User]) -> schemas.BookingResponse:
+    owner_id = _resolve_booking_owner(booking, db, current_user)
+    _check_initial_status(booking.status)
+    service = _owned_service(db, booking.service_id, owner_id)
 
-    service = db.query(models.Service).filter(models.Service.id == booking.service_id, models.Service.owner_id == owner_id).first()
-    if service is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Service not found or not owned by the specified owner")
+    start_at, end_at = _booking_window(booking.date, booking.time, service.max_duration)
+    resource_id = _reserve_booking_slot(db, service, owner_id, start_at, end_at, booking.resource_id)
+    client_id = clients.resolve_booking_client(db, owner_id, booking)
 
     db_booking = models.Booking(
         owner_id=owner_id,
@@ -310,22 +718,33 @@ async def create_booking(
         service_id=booking.service_id,
         date=booking.date,
         time=booking.time,
+        start_at=start_at,
+        end_at=end_at,
+        resource_id=resource_id,
         status=booking.status,
         notes=booking.notes if booking.notes is not None else "",
         customer_name=booking.customer_name,
         customer_email=booking.customer_email,
-        customer_phone=booking.customer_phone
+        customer_phone=booking.customer_phone,
+        client_id=client_id,
+        price=service.price
     )
     
     db.add(db_booking)
     db.flush() # 確保 db_booking.id 被賦值
+    clients.apply_changes(db, {}, clients.snapshot(db, [db_booking]))
+    if db_booking.status not in occupancy.RELEASED_STATUSES:
+        occupancy.occupy(db, owner_id, [(start_at, end_at)])
 
     # 生成預約編號
     random_string = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
     db_booking.booking_reference_id = f"NA{random_string}{db_booking.id}"
+    booking_versions.bump(db, [owner_id])
 
     db.commit()
     db.refresh(db_booking)
+    audit_log.record([audit.booking_event(db_booking, "created", None, db_booking.status, **audit.actor(current_user))])
+    booking_broker.publish(owner_id, _booking_event("booking.created", db_booking))
 
     # 查詢完整的預約資訊以回傳
     # 對於匿名預約，不需要 joinedload user
@@ -341,98 +760,364 @@ async def create_booking(
         ).filter(models.Booking.id == db_booking.id).first()
         client_name = booking_response.customer_name
 
-    return schemas.BookingResponse(
-        id=booking_response.id,
-        booking_reference_id=booking_response.booking_reference_id,
-        user_id=booking_response.user_id,
-        service_id=booking_response.service_id,
-        date=booking_response.date,
-        time=booking_response.time,
-        status=booking_response.status,
-        notes=booking_response.notes,
-        created_at=booking_response.created_at,
-        updated_at=booking_response.updated_at,
-        clientName=client_name,
-        serviceName=booking_response.service.name
-    )
+    return _booking_response(booking_response, client_name, booking_response.service.name)
 
-@booking_router.get("/my", response_model=List[schemas.BookingResponse])
-async def get_my_bookings(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    bookings_with_details = db.query(
-        models.Booking,
-        models.User.name.label("client_name"),
-        models.Service.name.label("service_name")
-    ).join(models.Booking.user).join(models.Booking.service).filter(models.Booking.user_id == current_user.id).all()
+@booking_router.post("/", response_model=schemas.BookingResponse, status_code=status.HTTP_201_CREATED)
+async def create_booking(
+    booking: schemas.BookingCreate,
+    db: Session = Depends(get_db),
+    current_user: Optional[models.User] = Depends(get_optional_current_user),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    # 重試時回傳第一次的結果，不會重複建立預約 (以登入使用者或公開頁面的 slug 區分)
+    principal = ("user", current_user.id) if current_user else ("slug", booking.public_slug)
+    return await idempotency_store.run(("create_booking", principal), idempotency_key, booking, lambda: _create_booking(booking, db, current_user), db)
 
-    # 將查詢結果轉換為 BookingResponse 列表
+@booking_router.get("/my", response_model=List[schemas.BookingResponse])
+def get_my_bookings(include_archive: bool = False, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    # 客戶在不同店家的預約可能位於不同的分片，逐一查詢後合併
     response_bookings = []
-    for booking, client_name, service_name in bookings_with_details:
-        response_data = {
-            "id": booking.id,
-            "user_id": booking.user_id,
-            "service_id": booking.service_id,
-            "date": booking.date,
-            "time": booking.time,
-            "status": booking.status,
-            "notes": booking.notes if booking.notes is not None else "", # 處理 notes 為 None 的情況
-            "created_at": booking.created_at,
-            "updated_at": booking.updated_at,
-            "clientName": client_name,
-            "serviceName": service_name,
-        }
-        response_bookings.append(schemas.BookingResponse(**response_data))
+    for _ in sharding.each_shard(db):
+        bookings_with_details = db.query(
+            models.Booking,
+            models.Service.name.label("service_name")
+        ).join(models.Booking.service).filter(models.Booking.user_id == current_user.id).order_by(models.Booking.start_at).all()
+
+        # 將查詢結果轉換為 BookingResponse 列表
+        shard_bookings = [_booking_response(booking, current_user.name, service_name) for booking, service_name in bookings_with_details]
+        if include_archive:
+            archived = _archived_bookings_query(db, models.BookingArchive.user_id == current_user.id).order_by(models.BookingArchive.start_at).all()
+            shard_bookings = [_booking_response(booking, current_user.name, service_name) for booking, service_name in archived] + shard_bookings
+        response_bookings.extend(shard_bookings)
+    if len(sharding.shards) > 1:
+        response_bookings.sort(key=lambda booking: (booking.start_at is None, booking.start_at or datetime.min))
     return response_bookings
 
 @booking_router.get("/", response_model=List[schemas.BookingResponse])
-async def get_all_bookings(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    bookings_with_details = db.query(
-        models.Booking,
-        models.Service.name.label("service_name")
-    ).join(models.Service).filter(models.Booking.owner_id == current_user.id).all()
+def get_all_bookings(start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False, ids: Optional[List[int]] = Query(None), fields: Optional[str] = FIELDS_QUERY, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    selected_fields = _parse_fields(fields, BOOKING_FIELD_COLUMNS)
+    query = tenant.query(models.Booking, models.Service.name.label("service_name")).join(models.Service)
+    if ids:
+        query = query.filter(models.Booking.id.in_(ids))
+    if selected_fields:
+        query = query.options(_booking_load_only(models.Booking, selected_fields))
+    bookings_with_details = _filter_booking_range(query, start, end).order_by(models.Booking.start_at).all()
+    if include_archive:
+        # 預設只查詢 bookings (近期資料)，明確要求時才合併封存的舊預約
+        archived = _archived_bookings_query(db, models.BookingArchive.owner_id == tenant.owner_id)
+        if ids:
+            archived = archived.filter(models.BookingArchive.id.in_(ids))
+        if selected_fields:
+            archived = archived.options(_booking_load_only(models.BookingArchive, selected_fields))
+        bookings_with_details = _filter_booking_range(archived, start, end, models.BookingArchive).order_by(models.BookingArchive.start_at).all() + bookings_with_details
+
+    if selected_fields:
+        client_names = _client_names(db, [booking for booking, _ in bookings_with_details]) if "clientName" in selected_fields else {}
+        return _sparse_response([
+            _sparse_booking(booking, client_names.get(booking.id), service_name, selected_fields)
+            for booking, service_name in bookings_with_details
+        ])
+    client_names = _client_names(db, [booking for booking, _ in bookings_with_details])
+    return [_booking_response(booking, client_names[booking.id], service_name) for booking, service_name in bookings_with_details]
+
+@booking_router.get("/events")
+async def stream_booking_events(request: Request, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
+    owner_id = current_user.id
+    # 串流可能持續數小時，先歸還認證時取得的資料庫連線
+    db.close()
+
+    async def event_stream():
+        async with booking_broker.subscription(owner_id) as queue:
+            yield ": connected\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    response_bookings = []
-    for booking, service_name in bookings_with_details:
-        client_name = None
-        if booking.user_id:
-            user = db.query(models.User).filter(models.User.id == booking.user_id).first()
-            if user: # 確保用戶存在
-                client_name = user.name
-        else:
-            client_name = booking.customer_name # 匿名預約使用 customer_name
-
-        response_data = {
-            "id": booking.id,
-            "booking_reference_id": booking.booking_reference_id,
-            "user_id": booking.user_id,
-            "service_id": booking.service_id,
-            "date": booking.date,
-            "time": booking.time,
-            "status": booking.status,
-            "notes": booking.notes if booking.notes is not None else "",
-            "created_at": booking.created_at,
-            "updated_at": booking.updated_at,
-            "clientName": client_name,
-            "serviceName": service_name,
+# 週期性預約
+MAX_SERIES_OCCURRENCES = 104
+
+def _expand_series_dates(start_date: date, interval_weeks: int, occurrences: Optional[int], end_date: Optional[date]) -> List[date]:
+    if occurrences is None and end_date is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Either occurrences or end_date is required")
+    if end_date is not None and end_date < start_date:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="end_date must not be before start_date")
+    dates = []
+    current = start_date
+    while (occurrences is None or len(dates) < occurrences) and (end_date is None or current <= end_date):
+        if len(dates) >= MAX_SERIES_OCCURRENCES:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A booking series can have at most {MAX_SERIES_OCCURRENCES} occurrences")
+        dates.append(current)
+        current += timedelta(weeks=interval_weeks)
+    return dates
+
+def _closed_dates(db: Session, owner_id: int, first: date, last: date) -> set:
+    # 公休日與不可預約日以一次 UNION ALL 查詢取出
+    low, high = datetime.combine(first, time.min), datetime.combine(last + timedelta(days=1), time.min)
+    holidays = select(models.Holiday.date).where(models.Holiday.owner_id == owner_id, models.Holiday.date >= low, models.Holiday.date < high)
+    unavailable = select(models.UnavailableDate.date).where(models.UnavailableDate.owner_id == owner_id, models.UnavailableDate.date >= low, models.UnavailableDate.date < high)
+    return {value.date() if isinstance(value, datetime) else value for value in db.execute(union_all(holidays, unavailable)).scalars()}
+
+def _conflicting_windows(db: Session, owner_id: int, windows, exclude_series_id: Optional[int] = None) -> List[date]:
+    # 系列改期時需要排除系列本身的預約，位元圖無法區分，因此以一個查詢比對實際時間 (每個時段是一個 OR 條件)，回傳有衝突的日期
+    if not windows:
+        return []
+    query = db.query(models.Booking.start_at, models.Booking.end_at).filter(
+        models.Booking.owner_id == owner_id,
+        models.Booking.status != "cancelled",
+        or_(*[and_(models.Booking.start_at < end_at, models.Booking.end_at > start_at) for start_at, end_at in windows]),
+    )
+    if exclude_series_id is not None:
+        query = query.filter(or_(models.Booking.series_id.is_(None), models.Booking.series_id != exclude_series_id))
+    existing = query.all()
+    return sorted({start_at.date() for start_at, end_at in windows for other_start, other_end in existing if other_start < end_at and other_end > start_at})
+
+def _series_bookings(db: Session, series_id: int) -> List[models.Booking]:
+    return db.query(models.Booking).filter(models.Booking.series_id == series_id).order_by(models.Booking.start_at).all()
+
+def _series_response(db: Session, series: models.BookingSeries, bookings: List[models.Booking], skipped_dates: List[date] = ()) -> schemas.BookingSeriesResponse:
+    client_names = _client_names(db, bookings)
+    service_name = db.query(models.Service.name).filter(models.Service.id == series.service_id).scalar()
+    return schemas.BookingSeriesResponse(
+        id=series.id,
+        user_id=series.user_id,
+        service_id=series.service_id,
+        start_date=series.start_date.date(),
+        time=series.time,
+        interval_weeks=series.interval_weeks,
+        occurrences=series.occurrences,
+        end_date=series.end_date.date() if series.end_date else None,
+        status=series.status,
+        notes=series.notes,
+        bookings=[_booking_response(booking, client_names[booking.id], service_name) for booking in bookings],
+        skipped_dates=list(skipped_dates),
+    )
+
+def _create_booking_series(series_in: schemas.BookingSeriesCreate, db: Session, current_user: Optional[models.User]) -> schemas.BookingSeriesResponse:
+    owner_id = _resolve_booking_owner(series_in, db, current_user)
+    _check_initial_status(series_in.status)
+    service = _owned_service(db, series_in.service_id, owner_id)
+
+    dates = _expand_series_dates(series_in.start_date, series_in.interval_weeks, series_in.occurrences, series_in.end_date)
+    closed = _closed_dates(db, owner_id, dates[0], dates[-1])
+    skipped_dates = [day for day in dates if day in closed]
+    windows = [_booking_window(day, series_in.time, service.max_duration) for day in dates if day not in closed]
+    if not windows:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="All dates in the series fall on holidays or unavailable dates")
+    if capacity.service_uses_resources(db, service.id):
+        # 有資源的服務逐次以每格計數預留，每次只是數個以主鍵更新的語句
+        resource_ids = [capacity.reserve_any(db, service.id, start_at, end_at, series_in.resource_id) for start_at, end_at in windows]
+        conflicts = [start_at.date() for (start_at, _), resource_id in zip(windows, resource_ids) if resource_id is None]
+    else:
+        if series_in.resource_id is not None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="This service has no resources to choose from")
+        resource_ids = [None] * len(windows)
+        conflicts = [windows[index][0].date() for index in occupancy.conflicting(db, owner_id, windows)]
+    if conflicts:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={"message": "Some dates in the series are already booked", "conflicting_dates": [day.isoformat() for day in conflicts]})
+
+    notes = series_in.notes if series_in.notes is not None else ""
+    db_series = models.BookingSeries(
+        owner_id=owner_id,
+        user_id=series_in.user_id,
+        service_id=series_in.service_id,
+        start_date=datetime.combine(series_in.start_date, time.min),
+        time=series_in.time,
+        interval_weeks=series_in.interval_weeks,
+        occurrences=series_in.occurrences,
+        end_date=datetime.combine(series_in.end_date, time.min) if series_in.end_date else None,
+        notes=notes,
+        customer_name=series_in.customer_name,
+        customer_email=series_in.customer_email,
+        customer_phone=series_in.customer_phone,
+    )
+    db.add(db_series)
+    db.flush()
+    client_id = clients.resolve_booking_client(db, owner_id, series_in)
+
+    # 預約編號不依賴自動編號的 id，所有預約可以用一次 bulk insert 寫入
+    random_string = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    rows = [
+        {
+            "owner_id": owner_id,
+            "booking_reference_id": f"NA{random_string}S{db_series.id}-{index}",
+            "user_id": series_in.user_id,
+            "service_id": series_in.service_id,
+            "date": datetime.combine(start_at.date(), time.min),
+            "time": series_in.time,
+            "start_at": start_at,
+            "end_at": end_at,
+            "status": series_in.status,
+            "notes": notes,
+            "customer_name": series_in.customer_name,
+            "customer_email": series_in.customer_email,
+            "customer_phone": series_in.customer_phone,
+            "series_id": db_series.id,
+            "resource_id": resource_id,
+            "client_id": client_id,
+            "price": service.price,
         }
-        response_bookings.append(schemas.BookingResponse(**response_data))
-    return response_bookings
+        for index, ((start_at, end_at), resource_id) in enumerate(zip(windows, resource_ids), start=1)
+    ]
+    db.execute(insert(models.Booking), rows)
+    created = db.execute(
+        select(models.Booking.id, models.Booking.client_id, models.Booking.status, models.Booking.start_at, models.Booking.service_id, models.Booking.price).where(models.Booking.series_id == db_series.id)
+    ).all()
+    clients.apply_changes(db, {}, clients.snapshot(db, created))
+    if series_in.status not in occupancy.RELEASED_STATUSES:
+        occupancy.occupy(db, owner_id, windows)
+    booking_versions.bump(db, [owner_id])
+    db.commit()
+
+    bookings = _series_bookings(db, db_series.id)
+    creator = audit.actor(current_user)
+    audit_log.record([audit.booking_event(booking, "created", None, booking.status, **creator) for booking in bookings])
+    for booking in bookings:
+        booking_broker.publish(owner_id, _booking_event("booking.created", booking))
+    return _series_response(db, db_series, bookings, skipped_dates)
+
+@booking_router.post("/series", response_model=schemas.BookingSeriesResponse, status_code=status.HTTP_201_CREATED)
+async def create_booking_series(
+    series: schemas.BookingSeriesCreate,
+    db: Session = Depends(get_db),
+    current_user: Optional[models.User] = Depends(get_optional_current_user),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    principal = ("user", current_user.id) if current_user else ("slug", series.public_slug)
+    return await idempotency_store.run(("create_booking_series", principal), idempotency_key, series, lambda: _create_booking_series(series, db, current_user), db)
+
+@booking_router.get("/series/{series_id}", response_model=schemas.BookingSeriesResponse)
+def get_booking_series(series_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    return _series_response(db, tenant.get_or_404(models.BookingSeries, series_id, "Booking series not found"), _series_bookings(db, series_id))
+
+@booking_router.put("/series/{series_id}", response_model=schemas.BookingSeriesResponse)
+def update_booking_series(series_id: int, series_update: schemas.BookingSeriesUpdate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_series = tenant.get_or_404(models.BookingSeries, series_id, "Booking series not found")
+    # 只修改尚未開始且未取消的預約
+    upcoming = db.query(models.Booking).filter(
+        models.Booking.series_id == series_id,
+        models.Booking.start_at >= datetime.now(),
+        models.Booking.status != "cancelled",
+    ).order_by(models.Booking.start_at).all()
+
+    values = series_update.model_dump(exclude_unset=True)
+    if "notes" in values and values["notes"] is None:
+        values["notes"] = ""
+    shared = {key: values[key] for key in ("notes", "status") if values.get(key) is not None}
+    old_statuses = {booking.id: booking.status for booking in upcoming}
+    if "status" in shared:
+        for booking in upcoming:
+            _check_status_transition(booking.status, shared["status"])
+    changes = [{"id": booking.id, **shared} for booking in upcoming]
+    cancelling = values.get("status") in capacity.RELEASED_STATUSES
+    if values.get("time") and not cancelling:
+        service = db.query(models.Service).filter(models.Service.id == db_series.service_id).first()
+        windows = [_booking_window(booking.start_at.date(), values["time"], service.max_duration) for booking in upcoming]
+        plain = [window for booking, window in zip(upcoming, windows) if booking.resource_id is None]
+        conflicts = _conflicting_windows(db, tenant.owner_id, plain, exclude_series_id=series_id)
+        for booking, change, (start_at, end_at) in zip(upcoming, changes, windows):
+            change.update(time=values["time"], start_at=start_at, end_at=end_at)
+            if booking.resource_id is not None:
+                change["resource_id"] = _reserve_moved_booking(db, booking, start_at, end_at)
+                if change["resource_id"] is None:
+                    conflicts.append(start_at.date())
+        if conflicts:
+            db.rollback()
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail={"message": "Some dates in the series are already booked", "conflicting_dates": [day.isoformat() for day in sorted(set(conflicts))]})
+    elif cancelling:
+        for booking in upcoming:
+            capacity.release(db, booking.resource_id, booking.start_at, booking.end_at)
+
+    # 依主鍵的 bulk UPDATE，整個系列一次送出
+    if changes and (shared or values.get("time")):
+        before = clients.snapshot(db, upcoming)
+        after = clients.snapshot(db, upcoming, {change["id"]: {key: change[key] for key in ("status", "start_at") if key in change} for change in changes})
+        touched_days = occupancy.affected_days([(booking.start_at, booking.end_at) for booking in upcoming] + [(change["start_at"], change["end_at"]) for change in changes if "start_at" in change])
+        db.execute(update(models.Booking), changes)
+        clients.apply_changes(db, before, after)
+        if values.get("time") or cancelling:
+            occupancy.refresh(db, tenant.owner_id, touched_days)
+    for key in ("time", "notes"):
+        if values.get(key) is not None:
+            setattr(db_series, key, values[key])
+    if values.get("status") == "cancelled":
+        db_series.status = "cancelled"
+    if changes:
+        booking_versions.bump(db, [tenant.owner_id])
+    db.commit()
+
+    bookings = _series_bookings(db, series_id)
+    changed_ids = {booking.id for booking in upcoming}
+    editor = audit.actor(tenant.user)
+    audit_log.record([
+        audit.booking_event(booking, "status_changed", old_statuses[booking.id], booking.status, **editor)
+        for booking in bookings if booking.id in changed_ids and booking.status != old_statuses[booking.id]
+    ])
+    for booking in bookings:
+        if booking.id in changed_ids:
+            booking_broker.publish(tenant.owner_id, _booking_event("booking.updated", booking))
+    return _series_response(db, db_series, bookings)
+
+@booking_router.delete("/series/{series_id}", status_code=status.HTTP_204_NO_CONTENT)
+def cancel_booking_series(series_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    # 取消系列中尚未開始的預約，已過去的預約保留作為紀錄
+    db_series = tenant.get_or_404(models.BookingSeries, series_id, "Booking series not found")
+    cancelled = db.execute(
+        select(models.Booking.id, models.Booking.owner_id, models.Booking.resource_id, models.Booking.start_at, models.Booking.end_at, models.Booking.client_id, models.Booking.status, models.Booking.service_id, models.Booking.price).where(
+            models.Booking.series_id == series_id,
+            models.Booking.start_at >= datetime.now(),
+            models.Booking.status != "cancelled",
+        )
+    ).all()
+    cancelled_ids = [row.id for row in cancelled]
+    for row in cancelled:
+        capacity.release(db, row.resource_id, row.start_at, row.end_at)
+    if cancelled_ids:
+        db.execute(update(models.Booking).where(models.Booking.id.in_(cancelled_ids)).values(status="cancelled", updated_at=datetime.utcnow()))
+        clients.apply_changes(db, clients.snapshot(db, cancelled), clients.snapshot(db, cancelled, {booking_id: {"status": "cancelled"} for booking_id in cancelled_ids}))
+        occupancy.refresh(db, tenant.owner_id, occupancy.affected_days([(row.start_at, row.end_at) for row in cancelled]))
+        booking_versions.bump(db, [tenant.owner_id])
+    db_series.status = "cancelled"
+    db.commit()
+    editor = audit.actor(tenant.user)
+    audit_log.record([audit.booking_event(row, "status_changed", row.status, "cancelled", **editor) for row in cancelled])
+    if cancelled_ids:
+        for booking in db.query(models.Booking).filter(models.Booking.id.in_(cancelled_ids)).all():
+            booking_broker.publish(tenant.owner_id, _booking_event("booking.updated", booking))
+    return
 
 @booking_router.put("/{booking_id}/status", response_model=schemas.BookingResponse)
-async def update_booking_status(booking_id: int, status: str, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_booking = db.query(models.Booking).filter(models.Booking.id == booking_id, models.Booking.owner_id == current_user.id).first()
-    if db_booking is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Booking not found")
+def update_booking_status(booking_id: int, status: str, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_booking = tenant.get_or_404(models.Booking, booking_id, "Booking not found")
     
+    old_status = db_booking.status
+    _check_status_transition(old_status, status)
+    before = clients.snapshot(db, [db_booking])
     db_booking.status = status
+    _sync_booking_capacity(db, db_booking, old_status)
+    _sync_booking_occupancy(db, db_booking, old_status)
+    clients.apply_changes(db, before, clients.snapshot(db, [db_booking]))
+    booking_versions.bump(db, [db_booking.owner_id])
     db.commit()
     db.refresh(db_booking)
+    if db_booking.status != old_status:
+        audit_log.record([audit.booking_event(db_booking, "status_changed", old_status, db_booking.status, **audit.actor(tenant.user))])
+    booking_broker.publish(db_booking.owner_id, _booking_event("booking.updated", db_booking))
     return db_booking
 
 @booking_router.put("/{booking_id}", response_model=schemas.BookingResponse)
-async def update_booking(booking_id: int, booking_update: schemas.BookingUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    db_booking = db.query(models.Booking).filter(models.Booking.id == booking_id, models.Booking.owner_id == current_user.id).first()
-    if db_booking is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Booking not found")
+def update_booking(booking_id: int, booking_update: schemas.BookingUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    db_booking = tenancy.Tenant(db, current_user.id, current_user).get_or_404(models.Booking, booking_id, "Booking not found")
     
     # 只有管理員可以修改狀態，普通用戶只能修改備註
     if current_user.role == "customer" and booking_update.status is not None:
@@ -443,21 +1128,56 @@ async def update_booking(booking_id: int, booking_update: schemas.BookingUpdate,
         update_data["notes"] = ""
     if "notes" in update_data and update_data["notes"] is None:
         update_data["notes"] = ""
+    old_status = db_booking.status
+    if update_data.get("status") is None:
+        # status 為 null 表示不變更
+        update_data.pop("status", None)
+    else:
+        _check_status_transition(old_status, update_data["status"])
+    before = clients.snapshot(db, [db_booking])
     for key, value in update_data.items():
         setattr(db_booking, key, value)
+    _sync_booking_capacity(db, db_booking, old_status)
+    _sync_booking_occupancy(db, db_booking, old_status)
+    clients.apply_changes(db, before, clients.snapshot(db, [db_booking]))
+    booking_versions.bump(db, [db_booking.owner_id])
     
     db.commit()
     db.refresh(db_booking)
+    if db_booking.status != old_status:
+        audit_log.record([audit.booking_event(db_booking, "status_changed", old_status, db_booking.status, **audit.actor(current_user))])
+    booking_broker.publish(db_booking.owner_id, _booking_event("booking.updated", db_booking))
     return db_booking
 
+@booking_router.get("/{booking_id}/history", response_model=List[schemas.BookingEventResponse])
+def get_booking_history(booking_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    # 先寫入這個 worker 緩衝區中的紀錄，剛發生的變更也能查到 (驗證身分的交易已經結束，這裡的查詢是新的快照)；預約刪除後紀錄仍然保留
+    try:
+        audit_log.flush()
+    except Exception:
+        # 寫入失敗的紀錄留在緩衝區或 spool 中由背景執行緒重送，這裡只回傳已經寫入的紀錄，不讓讀取失敗
+        logger.exception("Audit flush failed before reading the history of booking %s", booking_id)
+    return tenant.query(models.BookingEvent).filter(models.BookingEvent.booking_id == booking_id).order_by(
+        models.BookingEvent.occurred_at, models.BookingEvent.id
+    ).all()
+
 @booking_router.delete("/{booking_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_booking(booking_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_booking = db.query(models.Booking).filter(models.Booking.id == booking_id, models.Booking.owner_id == current_user.id).first()
-    if db_booking is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Booking not found")
+def delete_booking(booking_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_booking = tenant.get_or_404(models.Booking, booking_id, "Booking not found")
     
+    event = _booking_event("booking.deleted", db_booking)
+    deleted = audit.booking_event(db_booking, "deleted", db_booking.status, None, **audit.actor(tenant.user))
+    if db_booking.status not in capacity.RELEASED_STATUSES:
+        capacity.release(db, db_booking.resource_id, db_booking.start_at, db_booking.end_at)
+    before = clients.snapshot(db, [db_booking])
+    released_days = occupancy.affected_days([(db_booking.start_at, db_booking.end_at)]) if db_booking.status not in occupancy.RELEASED_STATUSES else set()
     db.delete(db_booking)
+    clients.apply_changes(db, before, {})
+    occupancy.refresh(db, tenant.owner_id, released_days)
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
+    audit_log.record([deleted])
+    booking_broker.publish(tenant.owner_id, event)
     return
 
 app.include_router(booking_router)
@@ -465,33 +1185,65 @@ app.include_router(booking_router)
 # 客戶管理路由 (管理員專用)
 client_router = APIRouter(prefix="/admin/clients", tags=["Admin - Clients"])
 
-@client_router.get("/", response_model=List[schemas.UserResponse])
-async def get_all_clients(db: Session = Depends(get_db), current_user: schemas.UserResponse = Depends(get_current_admin_user)):
-    clients = db.query(models.User).filter(models.User.role == "customer").all()
-    return clients
-
-@client_router.get("/{client_id}", response_model=schemas.UserResponse)
-async def get_client(client_id: int, db: Session = Depends(get_db), current_user: schemas.UserResponse = Depends(get_current_admin_user)):
-    client = db.query(models.User).filter(models.User.id == client_id, models.User.role == "customer").first()
-    if client is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
-    return client
-
-@client_router.put("/{client_id}", response_model=schemas.UserResponse)
-async def update_client(client_id: int, client_update: schemas.UserBase, db: Session = Depends(get_db), current_user: schemas.UserResponse = Depends(get_current_admin_user)):
-    db_client = db.query(models.User).filter(models.User.id == client_id, models.User.role == "customer").first()
-    if db_client is None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Client not found")
-    
-    # 不允許直接更新密碼和角色，這些應該有單獨的端點或更嚴格的控制
+# 可排序的欄位，每個都有對應的 (owner_id, 欄位, id) 索引；加上 "-" 前綴表示遞減
+CLIENT_SORT_COLUMNS = {
+    "name": models.Client.name,
+    "visit_count": models.Client.visit_count,
+    "lifetime_spend": models.Client.lifetime_spend,
+    "last_visit_at": models.Client.last_visit_at,
+    "next_visit_at": models.Client.next_visit_at,
+}
+CLIENT_NULLABLE_SORTS = ("last_visit_at", "next_visit_at")
+
+def _client_order_by(sort: str):
+    descending = sort.startswith("-")
+    key = sort.lstrip("-")
+    column = CLIENT_SORT_COLUMNS.get(key)
+    if column is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"sort must be one of {', '.join(CLIENT_SORT_COLUMNS)} (prefix with - for descending)")
+    order = column.desc() if descending else column.asc()
+    if key in CLIENT_NULLABLE_SORTS:
+        # 與索引的 NULL 順序一致 (NULL 視為最小)，資料庫才能直接依索引順序讀取
+        order = order.nulls_last() if descending else order.nulls_first()
+    return [order, models.Client.id.desc() if descending else models.Client.id.asc()]
+
+@client_router.get("/", response_model=schemas.ClientPage)
+def get_all_clients(
+    sort: str = "name",
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    fields: Optional[str] = FIELDS_QUERY,
+    db: Session = Depends(get_db),
+    tenant: tenancy.Tenant = Depends(get_tenant)
+):
+    # 店家的客戶名錄，包含會員與以 email / 電話辨識的匿名客戶
+    selected_fields = _parse_fields(fields, CLIENT_FIELDS)
+    query = tenant.query(models.Client)
+    total = query.order_by(None).count()
+    page = query.order_by(*_client_order_by(sort)).limit(limit).offset(offset)
+    if selected_fields:
+        return _sparse_response({"items": _column_projection(page, models.Client, selected_fields), "total": total, "limit": limit, "offset": offset})
+    return schemas.ClientPage(items=page.all(), total=total, limit=limit, offset=offset)
+
+@client_router.get("/{client_id}", response_model=schemas.ClientResponse)
+def get_client(client_id: int, tenant: tenancy.Tenant = Depends(get_tenant)):
+    return tenant.get_or_404(models.Client, client_id, "Client not found")
+
+@client_router.put("/{client_id}", response_model=schemas.ClientResponse)
+def update_client(client_id: int, client_update: schemas.ClientUpdate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_client = tenant.get_or_404(models.Client, client_id, "Client not found")
     update_data = client_update.model_dump(exclude_unset=True)
-    update_data.pop("password", None) # 確保不更新密碼
-    update_data.pop("role", None) # 確保不更新角色
-
-    for key, value in update_data.items():
-        setattr(db_client, key, value)
-    
-    db.commit()
+    if update_data.get("name") is not None:
+        db_client.name = update_data["name"]
+    if "email" in update_data:
+        db_client.email, db_client.email_normalized = update_data["email"], clients.normalize_email(update_data["email"])
+    if "phone" in update_data:
+        db_client.phone, db_client.phone_normalized = update_data["phone"], clients.normalize_phone(update_data["phone"])
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another client already uses this email")
     db.refresh(db_client)
     return db_client
 
@@ -500,26 +1252,48 @@ app.include_router(client_router)
 # 營業設定路由 (管理員專用)
 business_settings_router = APIRouter(prefix="/admin/settings", tags=["Admin - Business Settings"])
 
-@business_settings_router.get("/", response_model=schemas.BusinessSettingsResponse)
-async def get_business_settings(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    business_hours_from_db = db.query(models.BusinessHour).filter(models.BusinessHour.owner_id == current_user.id).order_by(models.BusinessHour.id).all()
-    holidays = db.query(models.Holiday).filter(models.Holiday.owner_id == current_user.id).all()
-    unavailable_dates = db.query(models.UnavailableDate).filter(models.UnavailableDate.owner_id == current_user.id).all()
-    bookable_time_slots = db.query(models.BookableTimeSlot).filter(models.BookableTimeSlot.owner_id == current_user.id).all()
-
-    # 如果營業時間是空的，就創建預設值 (週一到週日)
+def _default_business_hours(owner_id: int) -> List[models.BusinessHour]:
+    default_hours = [
+        # 週一到週六 10:00 - 19:00
+        models.BusinessHour(owner_id=owner_id, day_of_week=i, open_time=time(10, 0), close_time=time(19, 0), is_closed=False) for i in range(1, 7)
+    ]
+    # 週日公休
+    default_hours.append(models.BusinessHour(owner_id=owner_id, day_of_week=7, open_time=time(10, 0), close_time=time(19, 0), is_closed=True))
+    return default_hours
+
+def _create_default_business_hours(owner_id: int) -> List[models.BusinessHour]:
+    # 註冊前就存在、還沒有營業時間的店家：GET 的 session 使用 read_engine (DEFERRED)，在讀取交易中寫入會升級成寫入鎖，
+    # 並行寫入時可能出現 database is locked；改以寫入 engine 上獨立的短交易建立
+    db = SessionLocal(info={"read_only": False}, expire_on_commit=False)
+    try:
+        shard_name, state = sharding.directory.placement(db, owner_id)
+        if state == sharding.MOVING:
+            # 搬移中的店家只能讀取，先回傳預設值，之後的請求再建立
+            return _default_business_hours(owner_id)
+        sharding.use_shard(db, shard_name)
+
+        def create():
+            hours = db.query(models.BusinessHour).filter(models.BusinessHour.owner_id == owner_id, models.BusinessHour.resource_id.is_(None)).order_by(models.BusinessHour.id).all()
+            if not hours:
+                hours = _default_business_hours(owner_id)
+                db.add_all(hours)
+                booking_versions.bump(db, [owner_id])
+                db.commit()
+            return hours
+
+        return database.run_in_transaction(db, create)
+    finally:
+        db.close()
+
+def _load_business_settings(tenant: tenancy.Tenant) -> dict:
+    business_hours_from_db = tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id.is_(None)).order_by(models.BusinessHour.id).all()
+    holidays = tenant.all(models.Holiday)
+    unavailable_dates = tenant.all(models.UnavailableDate)
+    bookable_time_slots = tenant.all(models.BookableTimeSlot)
+
+    # 如果營業時間是空的，就創建預設值 (週一到週日)；新店家在註冊時已經建立
     if not business_hours_from_db:
-        default_hours = [
-            # 週一到週六 10:00 - 19:00
-            models.BusinessHour(owner_id=current_user.id, day_of_week=i, open_time=time(10, 0), close_time=time(19, 0), is_closed=False) for i in range(1, 7)
-        ]
-        # 週日公休
-        default_hours.append(models.BusinessHour(owner_id=current_user.id, day_of_week=7, open_time=time(10, 0), close_time=time(19, 0), is_closed=True))
-        
-        db.add_all(default_hours)
-        db.commit()
-        # 重新查詢以獲取新創建的數據
-        business_hours_from_db = db.query(models.BusinessHour).order_by(models.BusinessHour.day_of_week).all()
+        business_hours_from_db = _create_default_business_hours(tenant.owner_id)
 
     # 標準化輸出，確保 day_of_week 永遠是 1-7
     standardized_hours = []
@@ -542,37 +1316,43 @@ async def get_business_settings(db: Session = Depends(get_db), current_user: mod
         "bookable_time_slots": bookable_time_slots,
     }
 
+@business_settings_router.get("/", response_model=schemas.BusinessSettingsResponse)
+def get_business_settings(tenant: tenancy.Tenant = Depends(get_tenant)):
+    return _load_business_settings(tenant)
+
 @business_settings_router.put("/", response_model=schemas.BusinessSettingsResponse)
-async def update_business_settings(settings: schemas.BusinessSettingsUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
+def update_business_settings(settings: schemas.BusinessSettingsUpdate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
     # 更新營業時間
     if settings.business_hours is not None:
-        db.query(models.BusinessHour).filter(models.BusinessHour.owner_id == current_user.id).delete()
+        tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id.is_(None)).delete()
         for hour in settings.business_hours:
-            db_hour = models.BusinessHour(owner_id=current_user.id, **hour.model_dump())
+            db_hour = models.BusinessHour(owner_id=tenant.owner_id, **hour.model_dump())
             db.add(db_hour)
 
     # 更新假日
     if settings.holidays is not None:
-        db.query(models.Holiday).filter(models.Holiday.owner_id == current_user.id).delete()
+        tenant.query(models.Holiday).delete()
         for holiday in settings.holidays:
-            db_holiday = models.Holiday(owner_id=current_user.id, **holiday.model_dump())
+            db_holiday = models.Holiday(owner_id=tenant.owner_id, **holiday.model_dump())
             db.add(db_holiday)
 
     # 更新不可預約日期
     if settings.unavailable_dates is not None:
-        db.query(models.UnavailableDate).filter(models.UnavailableDate.owner_id == current_user.id).delete()
+        tenant.query(models.UnavailableDate).delete()
         for unavailable_date in settings.unavailable_dates:
-            db_unavailable_date = models.UnavailableDate(owner_id=current_user.id, **unavailable_date.model_dump())
+            db_unavailable_date = models.UnavailableDate(owner_id=tenant.owner_id, **unavailable_date.model_dump())
             db.add(db_unavailable_date)
 
+    # 營業設定也會影響公開頁面的可預約時段，遞增版本號讓快取過期
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
-    db.refresh(current_user) # 刷新 current_user 以確保其是最新的
+    db.refresh(tenant.user) # 刷新店家資料以確保其是最新的
 
     # 返回更新後的完整設定
-    business_hours = db.query(models.BusinessHour).filter(models.BusinessHour.owner_id == current_user.id).all()
-    holidays = db.query(models.Holiday).filter(models.Holiday.owner_id == current_user.id).all()
-    unavailable_dates = db.query(models.UnavailableDate).filter(models.UnavailableDate.owner_id == current_user.id).all()
-    bookable_time_slots = db.query(models.BookableTimeSlot).filter(models.BookableTimeSlot.owner_id == current_user.id).all()
+    business_hours = tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id.is_(None)).all()
+    holidays = tenant.all(models.Holiday)
+    unavailable_dates = tenant.all(models.UnavailableDate)
+    bookable_time_slots = tenant.all(models.BookableTimeSlot)
     
     return schemas.BusinessSettingsResponse(
         business_hours=business_hours,
@@ -582,74 +1362,79 @@ async def update_business_settings(settings: schemas.BusinessSettingsUpdate, db:
     )
 
 @business_settings_router.put("/business-hours", response_model=List[schemas.BusinessHourResponse])
-async def update_business_hours(hours: List[schemas.BusinessHourCreate], db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
+def update_business_hours(hours: List[schemas.BusinessHourCreate], db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
     # 簡單的更新邏輯：先刪除所有舊的，再新增新的
-    db.query(models.BusinessHour).filter(models.BusinessHour.owner_id == current_user.id).delete()
+    tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id.is_(None)).delete()
     db.commit()
     
     new_hours = []
     for hour in hours:
-        db_hour = models.BusinessHour(owner_id=current_user.id, **hour.model_dump())
+        db_hour = models.BusinessHour(owner_id=tenant.owner_id, **hour.model_dump())
         db.add(db_hour)
         new_hours.append(db_hour)
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
     return new_hours
 
 @business_settings_router.post("/holidays", response_model=schemas.HolidayResponse, status_code=status.HTTP_201_CREATED)
-async def add_holiday(holiday: schemas.HolidayCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_holiday = db.query(models.Holiday).filter(models.Holiday.date == holiday.date, models.Holiday.owner_id == current_user.id).first()
+def add_holiday(holiday: schemas.HolidayCreate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_holiday = tenant.query(models.Holiday).filter(models.Holiday.date == holiday.date).first()
     if db_holiday:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Holiday already exists for this date")
     
-    db_holiday = models.Holiday(owner_id=current_user.id, **holiday.model_dump())
+    db_holiday = models.Holiday(owner_id=tenant.owner_id, **holiday.model_dump())
     db.add(db_holiday)
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
     db.refresh(db_holiday)
     return db_holiday
 
 @business_settings_router.delete("/holidays/{holiday_date}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_holiday(holiday_date: date, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_holiday = db.query(models.Holiday).filter(models.Holiday.date == holiday_date, models.Holiday.owner_id == current_user.id).first()
+def delete_holiday(holiday_date: date, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_holiday = tenant.query(models.Holiday).filter(models.Holiday.date == holiday_date).first()
     if db_holiday is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Holiday not found")
     
     db.delete(db_holiday)
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
     return
 
 @business_settings_router.post("/unavailable-dates", response_model=schemas.UnavailableDateResponse, status_code=status.HTTP_201_CREATED)
-async def add_unavailable_date(unavailable_date: schemas.UnavailableDateCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_unavailable_date = db.query(models.UnavailableDate).filter(models.UnavailableDate.date == unavailable_date.date, models.UnavailableDate.owner_id == current_user.id).first()
+def add_unavailable_date(unavailable_date: schemas.UnavailableDateCreate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_unavailable_date = tenant.query(models.UnavailableDate).filter(models.UnavailableDate.date == unavailable_date.date).first()
     if db_unavailable_date:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unavailable date already exists")
     
-    db_unavailable_date = models.UnavailableDate(owner_id=current_user.id, **unavailable_date.model_dump())
+    db_unavailable_date = models.UnavailableDate(owner_id=tenant.owner_id, **unavailable_date.model_dump())
     db.add(db_unavailable_date)
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
     db.refresh(db_unavailable_date)
     return db_unavailable_date
 
 @business_settings_router.delete("/unavailable-dates/{unavailable_date}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_unavailable_date(unavailable_date: date, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_unavailable_date = db.query(models.UnavailableDate).filter(models.UnavailableDate.date == unavailable_date, models.UnavailableDate.owner_id == current_user.id).first()
+def delete_unavailable_date(unavailable_date: date, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_unavailable_date = tenant.query(models.UnavailableDate).filter(models.UnavailableDate.date == unavailable_date).first()
     if db_unavailable_date is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unavailable date not found")
     
     db.delete(db_unavailable_date)
+    booking_versions.bump(db, [tenant.owner_id])
     db.commit()
     return
 
 @business_settings_router.post("/time-slots", response_model=schemas.BookableTimeSlotResponse, status_code=status.HTTP_201_CREATED)
-async def add_time_slot(time_slot: schemas.BookableTimeSlotCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_time_slot = models.BookableTimeSlot(owner_id=current_user.id, **time_slot.model_dump())
+def add_time_slot(time_slot: schemas.BookableTimeSlotCreate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_time_slot = models.BookableTimeSlot(owner_id=tenant.owner_id, **time_slot.model_dump())
     db.add(db_time_slot)
     db.commit()
     db.refresh(db_time_slot)
     return db_time_slot
 
 @business_settings_router.delete("/time-slots/{time_slot_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_time_slot(time_slot_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
-    db_time_slot = db.query(models.BookableTimeSlot).filter(models.BookableTimeSlot.id == time_slot_id, models.BookableTimeSlot.owner_id == current_user.id).first()
+def delete_time_slot(time_slot_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_time_slot = tenant.query(models.BookableTimeSlot).filter(models.BookableTimeSlot.id == time_slot_id).first()
     if db_time_slot is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Time slot not found")
     
@@ -657,8 +1442,102 @@ async def delete_time_slot(time_slot_id: int, db: Session = Depends(get_db), cur
     db.commit()
     return
 
+@business_settings_router.post("/rebuild-occupancy")
+def rebuild_occupancy(db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    return {"days": occupancy.rebuild(db, tenant.owner_id)}
+
 app.include_router(business_settings_router)
 
+# 資源 (技師、座位) 管理路由
+resource_router = APIRouter(prefix="/admin/resources", tags=["Admin - Resources"])
+
+def _resource_response(resource: models.Resource) -> schemas.ResourceResponse:
+    return schemas.ResourceResponse(
+        id=resource.id,
+        name=resource.name,
+        kind=resource.kind,
+        capacity=resource.capacity,
+        is_active=resource.is_active,
+        service_ids=sorted(service.id for service in resource.services),
+    )
+
+def _owned_services(tenant: tenancy.Tenant, service_ids: List[int]) -> List[models.Service]:
+    services = tenant.all(models.Service, service_ids) if service_ids else []
+    if len(services) != len(set(service_ids)):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Service not found or not owned by the current user")
+    return services
+
+@resource_router.get("/", response_model=List[schemas.ResourceResponse])
+def get_resources(tenant: tenancy.Tenant = Depends(get_tenant)):
+    resources = tenant.query(models.Resource).options(selectinload(models.Resource.services)).order_by(models.Resource.id).all()
+    return [_resource_response(resource) for resource in resources]
+
+@resource_router.post("/", response_model=schemas.ResourceResponse, status_code=status.HTTP_201_CREATED)
+def create_resource(resource: schemas.ResourceCreate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_resource = models.Resource(owner_id=tenant.owner_id, **resource.model_dump(exclude={"service_ids"}))
+    db_resource.services = _owned_services(tenant, resource.service_ids)
+    db.add(db_resource)
+    db.commit()
+    db.refresh(db_resource)
+    return _resource_response(db_resource)
+
+@resource_router.put("/{resource_id}", response_model=schemas.ResourceResponse)
+def update_resource(resource_id: int, resource: schemas.ResourceCreate, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    db_resource = tenant.get_or_404(models.Resource, resource_id, "Resource not found")
+    for key, value in resource.model_dump(exclude={"service_ids"}).items():
+        setattr(db_resource, key, value)
+    db_resource.services = _owned_services(tenant, resource.service_ids)
+    capacity.set_capacity(db, db_resource)
+    db.commit()
+    db.refresh(db_resource)
+    return _resource_response(db_resource)
+
+@resource_router.delete("/{resource_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_resource(resource_id: int, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    # 已有預約指向這個資源，因此只停用，不再分配新的預約
+    db_resource = tenant.get_or_404(models.Resource, resource_id, "Resource not found")
+    db_resource.is_active = False
+    db.commit()
+    return
+
+@resource_router.get("/{resource_id}/business-hours", response_model=List[schemas.BusinessHourResponse])
+def get_resource_business_hours(resource_id: int, tenant: tenancy.Tenant = Depends(get_tenant)):
+    tenant.get_or_404(models.Resource, resource_id, "Resource not found")
+    return tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id == resource_id).order_by(models.BusinessHour.day_of_week).all()
+
+@resource_router.put("/{resource_id}/business-hours", response_model=List[schemas.BusinessHourResponse])
+def update_resource_business_hours(resource_id: int, hours: List[schemas.BusinessHourCreate], db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    # 資源的營業時間 (day_of_week 1=週一 ... 7=週日)；沒有設定的星期沿用店家的營業時間
+    tenant.get_or_404(models.Resource, resource_id, "Resource not found")
+    tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id == resource_id).delete()
+    new_hours = [models.BusinessHour(owner_id=tenant.owner_id, resource_id=resource_id, **hour.model_dump()) for hour in hours]
+    db.add_all(new_hours)
+    db.commit()
+    return new_hours
+
+@resource_router.post("/rebuild-capacity")
+def rebuild_resource_capacity(db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    return {"slots": capacity.rebuild(db, tenant.owner_id)}
+
+app.include_router(resource_router)
+
+analytics_router = APIRouter(prefix="/admin/analytics", tags=["Admin - Analytics"])
+
+# 大型店家第一次計算可能超過 singleflight 預設的等待上限，同時到達的請求一律等待並共用結果
+@analytics_router.get("/", response_model=schemas.AnalyticsResponse)
+@coalesce(wait=None)
+def get_booking_analytics(start: Optional[date] = None, end: Optional[date] = None, db: Session = Depends(get_db), tenant: tenancy.Tenant = Depends(get_tenant)):
+    # 營運分析 (analytics.py)：預設為最近一年，end 不含；結果依預約版本號快取，預約或營業設定變更後才重新計算
+    start, end = analytics.default_range(start, end)
+    if end <= start:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="end must be after start")
+    if (end - start).days > analytics.MAX_DAYS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"The range cannot exceed {analytics.MAX_DAYS} days")
+    version = tenant.query(models.BookingVersion).with_entities(models.BookingVersion.version).scalar() or 0
+    return analytics_cache.get(db, tenant.owner_id, version, start, end)
+
+app.include_router(analytics_router)
+
 # 使用者個人資料路由
 user_router = APIRouter(prefix="/users", tags=["Users"])
 
@@ -667,7 +1546,7 @@ async def read_users_me(current_user: models.User = Depends(get_current_user)):
     return current_user
 
 @user_router.put("/me", response_model=schemas.UserResponse)
-async def update_user_me(user_update: schemas.UserUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def update_user_me(user_update: schemas.UserUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     update_data = user_update.model_dump(exclude_unset=True)
     for key, value in update_data.items():
         setattr(current_user, key, value)
@@ -676,8 +1555,20 @@ async def update_user_me(user_update: schemas.UserUpdate, db: Session = Depends(
     db.refresh(current_user)
     return current_user
 
+def _set_avatar(db: Session, current_user: models.User, avatar_url: str) -> schemas.UserResponse:
+    current_user.avatar_url = avatar_url
+    db.add(current_user)
+    db.commit()
+    db.refresh(current_user)
+    return schemas.UserResponse.model_validate(current_user)
+
+@user_router.put("/me/avatar", response_model=schemas.UserResponse, openapi_extra=MEDIA_UPLOAD_OPENAPI)
+async def upload_avatar(request: Request, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    avatar_url = media.media_url(await _upload_media(request))
+    return await run_in_threadpool(database.run_in_transaction, db, lambda: _set_avatar(db, current_user, avatar_url))
+
 @user_router.post("/me/change-password")
-async def change_password_me(password_update: schemas.PasswordUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def change_password_me(password_update: schemas.PasswordUpdate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     if not verify_password(password_update.current_password, current_user.password):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect current password")
     
@@ -690,19 +1581,87 @@ async def change_password_me(password_update: schemas.PasswordUpdate, db: Sessio
 
 app.include_router(user_router)
 
+# 上傳的圖片：檔名即內容雜湊，回應可被瀏覽器與 CDN 永久快取
+media_router = APIRouter(prefix="/media", tags=["Media"])
+
+# HEAD 與 GET 相同 (CDN 與瀏覽器的快取檢查)；只在文件中列出 GET，避免兩個方法使用同一個 operation id
+@media_router.get("/{name}")
+@media_router.head("/{name}", include_in_schema=False)
+async def get_media(name: str, if_none_match: Optional[str] = Header(None)):
+    return media.media_response(name, if_none_match)
+
+app.include_router(media_router)
+
+# 管理後台初始化路由：一次認證、一個 session 取得首頁需要的所有資料
+admin_router = APIRouter(prefix="/admin", tags=["Admin"])
+
+@admin_router.get("/bootstrap", response_model=schemas.AdminBootstrapResponse)
+def get_admin_bootstrap(
+    days: int = Query(14, ge=1, le=90),
+    limit: int = Query(100, ge=1, le=500),
+    db: Session = Depends(get_db),
+    tenant: tenancy.Tenant = Depends(get_tenant)
+):
+    # 同步的資料庫驅動無法在同一條連線上並行查詢，這裡依序在同一個 session 中完成
+    services = tenant.all(models.Service)
+    settings = _load_business_settings(tenant)
+
+    now = datetime.now()
+    upcoming = tenant.query(
+        models.Booking,
+        models.Service.name.label("service_name")
+    ).join(models.Service).filter(
+        models.Booking.start_at >= now,
+        models.Booking.start_at < now + timedelta(days=days),
+    ).order_by(models.Booking.start_at).limit(limit).all()
+    client_names = _client_names(db, [booking for booking, _ in upcoming])
+
+    return schemas.AdminBootstrapResponse(
+        profile=tenant.user,
+        services=services,
+        settings=settings,
+        upcoming_bookings=[_booking_response(booking, client_names[booking.id], service_name) for booking, service_name in upcoming],
+    )
+
+def _calendar_feed_response(request: Request, user: models.User) -> schemas.CalendarFeedResponse:
+    url = request.url_for("get_public_calendar", slug=user.public_slug).include_query_params(token=user.calendar_token)
+    return schemas.CalendarFeedResponse(url=str(url))
+
+@admin_router.post("/calendar-feed", response_model=schemas.CalendarFeedResponse)
+def rotate_calendar_feed(request: Request, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
+    # 建立或更換行事曆訂閱網址，舊的網址立即失效
+    if not current_user.public_slug:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A public slug is required for the calendar feed")
+    current_user.calendar_token = secrets.token_urlsafe(32)
+    db.commit()
+    db.refresh(current_user)
+    return _calendar_feed_response(request, current_user)
+
+@admin_router.delete("/calendar-feed", status_code=status.HTTP_204_NO_CONTENT)
+def disable_calendar_feed(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_admin_user)):
+    current_user.calendar_token = None
+    db.commit()
+    return
+
+app.include_router(admin_router)
+
 public_router = APIRouter(prefix="/public", tags=["Public"])
 
+# 公開頁面的讀取：同時到達的相同請求只查詢一次 (singleflight.coalesce)，查詢在 threadpool 中執行
 @public_router.get("/profile/{slug}", response_model=schemas.UserPublicProfileResponse)
-async def get_public_profile(slug: str, db: Session = Depends(get_db)):
+@coalesce()
+def get_public_profile(slug: str, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.public_slug == slug, models.User.role == "admin").first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Public profile not found")
+    sharding.use_tenant(db, user.id)
+    tenant = tenancy.Tenant(db, user.id)
     
-    services = db.query(models.Service).filter(models.Service.owner_id == user.id, models.Service.is_active == True).all()
-    business_hours = db.query(models.BusinessHour).filter(models.BusinessHour.owner_id == user.id).order_by(models.BusinessHour.day_of_week).all()
-    holidays = db.query(models.Holiday).filter(models.Holiday.owner_id == user.id).all()
-    unavailable_dates = db.query(models.UnavailableDate).filter(models.UnavailableDate.owner_id == user.id).all()
-    bookable_time_slots = db.query(models.BookableTimeSlot).filter(models.BookableTimeSlot.owner_id == user.id).all()
+    services = tenant.query(models.Service).filter(models.Service.is_active == True).all()
+    business_hours = tenant.query(models.BusinessHour).filter(models.BusinessHour.resource_id.is_(None)).order_by(models.BusinessHour.day_of_week).all()
+    holidays = tenant.all(models.Holiday)
+    unavailable_dates = tenant.all(models.UnavailableDate)
+    bookable_time_slots = tenant.all(models.BookableTimeSlot)
 
     # 標準化營業時間輸出
     standardized_hours = []
@@ -730,42 +1689,71 @@ async def get_public_profile(slug: str, db: Session = Depends(get_db)):
     )
 
 @public_router.get("/bookings_by_slug/{slug}", response_model=List[schemas.BookingResponse])
-async def get_public_bookings_by_slug(slug: str, db: Session = Depends(get_db)):
+@coalesce()
+def get_public_bookings_by_slug(slug: str, start: Optional[datetime] = None, end: Optional[datetime] = None, include_archive: bool = False, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.public_slug == slug, models.User.role == "admin").first()
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Public profile not found for the given slug")
+    sharding.use_tenant(db, user.id)
     
-    bookings_with_details = db.query(
+    tenant = tenancy.Tenant(db, user.id)
+    query = tenant.query(
         models.Booking,
         models.Service.name.label("service_name")
-    ).join(models.Service).filter(models.Booking.owner_id == user.id).all()
-
-    response_bookings = []
-    for booking, service_name in bookings_with_details:
-        client_name = None
-        if booking.user_id:
-            user = db.query(models.User).filter(models.User.id == booking.user_id).first()
-            if user: # 確保用戶存在
-                client_name = user.name
-        else:
-            client_name = booking.customer_name # 匿名預約使用 customer_name
-
-        response_data = {
-            "id": booking.id,
-            "booking_reference_id": booking.booking_reference_id,
-            "user_id": booking.user_id,
-            "service_id": booking.service_id,
-            "date": booking.date,
-            "time": booking.time,
-            "status": booking.status,
-            "notes": booking.notes if booking.notes is not None else "",
-            "created_at": booking.created_at,
-            "updated_at": booking.updated_at,
-            "clientName": client_name,
-            "serviceName": service_name,
-        }
-        response_bookings.append(schemas.BookingResponse(**response_data))
-    return response_bookings
+    ).join(models.Service)
+    bookings_with_details = _filter_booking_range(query, start, end).order_by(models.Booking.start_at).all()
+    if include_archive:
+        archived = _archived_bookings_query(db, models.BookingArchive.owner_id == tenant.owner_id)
+        bookings_with_details = _filter_booking_range(archived, start, end, models.BookingArchive).order_by(models.BookingArchive.start_at).all() + bookings_with_details
+
+    client_names = _client_names(db, [booking for booking, _ in bookings_with_details])
+    return [_booking_response(booking, client_names[booking.id], service_name) for booking, service_name in bookings_with_details]
+
+@public_router.get("/availability/{slug}", response_model=schemas.AvailabilityResponse)
+@coalesce()
+def get_public_availability(slug: str, service_id: int, start_at: datetime, db: Session = Depends(get_db)):
+    # 店家與預約版本號一起查詢；營業時間與已預約的格子由記憶體中的位元圖判斷 (occupancy.py)
+    row = db.query(models.User.id, models.BookingVersion.version).outerjoin(
+        models.BookingVersion, models.BookingVersion.owner_id == models.User.id
+    ).filter(models.User.public_slug == slug, models.User.role == "admin").first()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Public profile not found for the given slug")
+    owner_id, version = row.id, row.version or 0
+    if sharding.use_tenant(db, owner_id):
+        # 店家在其他分片時，版本號以分片中的為準
+        version = db.query(models.BookingVersion.version).filter(models.BookingVersion.owner_id == owner_id).scalar() or 0
+    service = _owned_service(db, service_id, owner_id)
+    end_at = start_at + timedelta(minutes=service.max_duration)
+    if not occupancy_cache.is_open(db, owner_id, version, start_at, end_at):
+        return schemas.AvailabilityResponse(service_id=service.id, slot_start=start_at, available=False)
+    if capacity.service_uses_resources(db, service.id):
+        # 以每格計數判斷該時段是否還有可提供此服務的資源
+        free = capacity.free_resource_ids(db, service.id, start_at, end_at)
+        return schemas.AvailabilityResponse(service_id=service.id, slot_start=start_at, available=bool(free), free_resource_ids=free)
+    # 未設定資源的服務，整個時段只要有預約就不可預約
+    available = occupancy_cache.is_free(db, owner_id, version, start_at, end_at)
+    return schemas.AvailabilityResponse(service_id=service.id, slot_start=start_at, available=available)
+
+@public_router.get("/{slug}/calendar.ics", response_class=Response, responses={200: {"content": {"text/calendar": {}}}, 304: {"description": "Not modified"}})
+def get_public_calendar(slug: str, token: str, request: Request, db: Session = Depends(get_db)):
+    # 輪詢時只以一個查詢取得店家與版本號；版本號沒變時回傳 304 或記憶體中的內容
+    row = db.query(models.User, models.BookingVersion.version, models.BookingVersion.changed_at).outerjoin(
+        models.BookingVersion, models.BookingVersion.owner_id == models.User.id
+    ).filter(models.User.public_slug == slug, models.User.role == "admin").first()
+    if row is None or not row.User.calendar_token or not hmac.compare_digest(row.User.calendar_token, token):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Calendar feed not found")
+    owner, version, changed_at = row
+    if sharding.use_tenant(db, owner.id):
+        version, changed_at = db.query(models.BookingVersion.version, models.BookingVersion.changed_at).filter(models.BookingVersion.owner_id == owner.id).first() or (None, None)
+    version = version or 0
+    etag = calendar_feed.feed_etag(owner.id, version)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if changed_at is not None:
+        headers["Last-Modified"] = calendar_feed.http_date(changed_at)
+    if calendar_feed.not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since"), etag, changed_at):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    body = calendar_feed_cache.get(db, owner, version)
+    return Response(content=body, media_type="text/calendar; charset=utf-8", headers=headers)
 
 app.include_router(public_router)
 
@@ -0,0 +1,127 @@
+import logging
+from datetime import date, datetime, timedelta
+from typing import Callable, Optional
+
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.orm import Session
+
+import audit
+import booking_versions
+import clients
+import models
+
+logger = logging.getLogger(__name__)
+
+# 每次排程執行最多處理 MAINTENANCE_BATCH_SIZE * MAINTENANCE_MAX_BATCHES 筆，剩下的留給下一輪
+MAINTENANCE_BATCH_SIZE = 500
+MAINTENANCE_MAX_BATCHES = 20
+
+
+def purge_expired_blacklisted_tokens(db: Session, token_lifetime: timedelta, batch_size: int = MAINTENANCE_BATCH_SIZE, max_batches: int = MAINTENANCE_MAX_BATCHES) -> int:
+    # JWT 本身過期後就不需要留在黑名單中
+    cutoff = datetime.utcnow() - token_lifetime
+    purged = 0
+    for _ in range(max_batches):
+        ids = db.execute(
+            select(models.BlacklistedToken.id)
+            .where(models.BlacklistedToken.blacklisted_on < cutoff)
+            .order_by(models.BlacklistedToken.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        db.execute(delete(models.BlacklistedToken).where(models.BlacklistedToken.id.in_(ids)))
+        db.commit()
+        purged += len(ids)
+        if len(ids) < batch_size:
+            break
+    return purged
+
+
+def purge_expired_idempotency_keys(db: Session, batch_size: int = MAINTENANCE_BATCH_SIZE, max_batches: int = MAINTENANCE_MAX_BATCHES) -> int:
+    # 過期的 Idempotency-Key 結果 (請求時只會刪除同一個 key 的過期紀錄)
+    now = datetime.utcnow()
+    purged = 0
+    for _ in range(max_batches):
+        keys = db.execute(
+            select(models.IdempotencyKey.key_hash)
+            .where(models.IdempotencyKey.expires_at <= now)
+            .limit(batch_size)
+        ).scalars().all()
+        if not keys:
+            break
+        db.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.key_hash.in_(keys)))
+        db.commit()
+        purged += len(keys)
+        if len(keys) < batch_size:
+            break
+    return purged
+
+
+def complete_past_bookings(db: Session, on_completed: Optional[Callable[[models.Booking], None]] = None, batch_size: int = MAINTENANCE_BATCH_SIZE, max_batches: int = MAINTENANCE_MAX_BATCHES) -> int:
+    # 結束時間已過、仍為 pending/confirmed 的預約標記為 completed
+    now = datetime.now()
+    completed = 0
+    for _ in range(max_batches):
+        bookings = db.query(models.Booking).filter(
+            models.Booking.status.in_(("pending", "confirmed")),
+            models.Booking.end_at < now,
+        ).order_by(models.Booking.id).limit(batch_size).all()
+        if not bookings:
+            break
+        before = clients.snapshot(db, bookings)
+        previous = {booking.id: booking.status for booking in bookings}
+        for booking in bookings:
+            booking.status = "completed"
+        # 完成的預約計入客戶的到訪次數與消費金額
+        clients.apply_changes(db, before, clients.snapshot(db, bookings), now)
+        booking_versions.bump(db, (booking.owner_id for booking in bookings))
+        db.commit()
+        audit.audit_log.record([audit.booking_event(booking, "status_changed", previous[booking.id], "completed", **audit.SYSTEM_ACTOR) for booking in bookings])
+        completed += len(bookings)
+        if on_completed is not None:
+            for booking in bookings:
+                on_completed(booking)
+        if len(bookings) < batch_size:
+            break
+    return completed
+
+
+def purge_past_resource_slots(db: Session, keep: timedelta = timedelta(days=1), batch_size: int = MAINTENANCE_BATCH_SIZE, max_batches: int = MAINTENANCE_MAX_BATCHES) -> int:
+    # 已過去的時段不會再被預約，對應的每格計數可以刪除
+    cutoff = datetime.now() - keep
+    purged = 0
+    for _ in range(max_batches):
+        keys = db.execute(
+            select(models.ResourceSlot.resource_id, models.ResourceSlot.slot_start)
+            .where(models.ResourceSlot.slot_start < cutoff)
+            .limit(batch_size)
+        ).all()
+        if not keys:
+            break
+        db.execute(delete(models.ResourceSlot).where(tuple_(models.ResourceSlot.resource_id, models.ResourceSlot.slot_start).in_(keys)))
+        db.commit()
+        purged += len(keys)
+        if len(keys) < batch_size:
+            break
+    return purged
+
+
+def purge_past_occupancy_days(db: Session, keep: timedelta = timedelta(days=1), batch_size: int = MAINTENANCE_BATCH_SIZE, max_batches: int = MAINTENANCE_MAX_BATCHES) -> int:
+    # 已過去的日期不會再被檢查衝突，位元圖可以刪除 (需要時會再從 bookings 計算)
+    cutoff = date.today() - keep
+    purged = 0
+    for _ in range(max_batches):
+        keys = db.execute(
+            select(models.OccupancyDay.owner_id, models.OccupancyDay.day)
+            .where(models.OccupancyDay.day < cutoff)
+            .limit(batch_size)
+        ).all()
+        if not keys:
+            break
+        db.execute(delete(models.OccupancyDay).where(tuple_(models.OccupancyDay.owner_id, models.OccupancyDay.day).in_(keys)))
+        db.commit()
+        purged += len(keys)
+        if len(keys) < batch_size:
+            break
+    return purged
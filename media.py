@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from datetime import timedelta
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# 上傳的圖片以內容的 SHA-256 命名 (media/ab/ab12...ef.png)，相同內容只保存一份，檔案內容永遠不會改變
+# 多台主機部署時 SIDEP_MEDIA_DIR 需指向共用的儲存空間
+MEDIA_DIR = os.environ.get("SIDEP_MEDIA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "media"))
+MEDIA_URL_PREFIX = "/media/"
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 設定後 /media 只回傳 X-Accel-Redirect 標頭，由 nginx 以 sendfile 直接傳送檔案 (例如 /protected-media/)
+ACCEL_REDIRECT_PREFIX = os.environ.get("SIDEP_MEDIA_ACCEL_REDIRECT")
+# 沒有任何使用者或服務引用的檔案保留這段時間後才刪除
+UNREFERENCED_GRACE = timedelta(days=1)
+
+IMAGE_TYPES = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/webp": "webp"}
+MEDIA_TYPES = {extension: content_type for content_type, extension in IMAGE_TYPES.items()}
+MEDIA_NAME = re.compile(r"^([0-9a-f]{64})\.(png|jpg|gif|webp)$")
+SNIFF_BYTES = 12
+
+
+def _sniff(head: bytes) -> Optional[str]:
+    # 以檔頭判斷實際格式，避免把 HTML 等內容當成圖片提供
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def media_path(name: str) -> str:
+    return os.path.join(MEDIA_DIR, name[:2], name)
+
+
+def media_url(name: str) -> str:
+    return MEDIA_URL_PREFIX + name
+
+
+def media_name(url: Optional[str]) -> Optional[str]:
+    if not url or not url.startswith(MEDIA_URL_PREFIX):
+        return None
+    name = url[len(MEDIA_URL_PREFIX):]
+    return name if MEDIA_NAME.match(name) else None
+
+
+def _write_chunk(output, digest, chunk: bytes):
+    digest.update(chunk)
+    output.write(chunk)
+
+
+async def store_upload(chunks: AsyncIterator[bytes], content_type: str, max_bytes: int = MAX_UPLOAD_BYTES) -> str:
+    # 邊接收邊寫入暫存檔並計算雜湊，不會把整個檔案放在記憶體中；完成後以雜湊命名搬到正式位置
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type not in IMAGE_TYPES:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail=f"Content-Type must be one of {', '.join(IMAGE_TYPES)}")
+
+    tmp_dir = os.path.join(MEDIA_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    try:
+        with os.fdopen(fd, "wb") as output:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f"File exceeds {max_bytes} bytes")
+                if len(head) < SNIFF_BYTES:
+                    head += chunk[:SNIFF_BYTES - len(head)]
+                await run_in_threadpool(_write_chunk, output, digest, chunk)
+        if size == 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty upload")
+        if _sniff(head) != content_type:
+            raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="File content does not match Content-Type")
+
+        name = f"{digest.hexdigest()}.{IMAGE_TYPES[content_type]}"
+        path = media_path(name)
+        if os.path.exists(path):
+            # 已有相同內容的檔案：更新修改時間，避免剛被引用就被清理工作刪除
+            os.remove(tmp_path)
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        return name
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match 使用弱比較
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def media_response(name: str, if_none_match: Optional[str] = None) -> Response:
+    match = MEDIA_NAME.match(name)
+    path = media_path(name) if match else None
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Media not found")
+    # 檔名就是內容的雜湊，可以直接作為強 ETag
+    headers = {"ETag": f'"{match.group(1)}"', "Cache-Control": CACHE_CONTROL, "X-Content-Type-Options": "nosniff"}
+    media_type = MEDIA_TYPES[match.group(2)]
+    if _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if ACCEL_REDIRECT_PREFIX:
+        return Response(headers={**headers, "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{name[:2]}/{name}"}, media_type=media_type)
+    # FileResponse 處理 Range / If-Range 與 HEAD
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def purge_unreferenced_media(db: Session, grace: timedelta = UNREFERENCED_GRACE) -> int:
+    # 頭像與服務圖片換新後舊檔案不再被引用；同一個檔案可能被多筆資料共用，只刪除完全沒有引用的檔案
+    import sharding
+    urls = db.query(models.User.avatar_url).filter(models.User.avatar_url.like(MEDIA_URL_PREFIX + "%")).distinct().all()
+    # 服務圖片分散在各店家的分片
+    for _ in sharding.each_shard(db):
+        urls += db.query(models.Service.image_url).filter(models.Service.image_url.like(MEDIA_URL_PREFIX + "%")).distinct().all()
+    referenced = set()
+    for (url,) in urls:
+        name = media_name(url)
+        if name:
+            referenced.add(name)
+
+    cutoff = time.time() - grace.total_seconds()
+    purged = 0
+    if not os.path.isdir(MEDIA_DIR):
+        return 0
+    for directory in os.listdir(MEDIA_DIR):
+        directory_path = os.path.join(MEDIA_DIR, directory)
+        if not os.path.isdir(directory_path):
+            continue
+        for name in os.listdir(directory_path):
+            path = os.path.join(directory_path, name)
+            # tmp 中是中斷的上傳留下的暫存檔
+            if directory != "tmp" and (not MEDIA_NAME.match(name) or name in referenced):
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    purged += 1
+            except FileNotFoundError:
+                pass
+    logger.info("Purged %d unreferenced media files", purged)
+    return purged
@@ -0,0 +1,335 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Prometheus 文字格式 (text exposition format 0.0.4) 的最小實作：計數器、量測值與直方圖
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# 沒有對應到任何路由的請求 (404、CORS preflight) 統一使用這個標籤，避免以原始路徑作為標籤
+UNMATCHED_ROUTE = "unmatched"
+
+LabelValues = Tuple[str, ...]
+
+logger = logging.getLogger("metrics")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, LabelValues, float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, key, value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+    # 多 worker 合併 (參見 Registry.start_snapshots)：snapshot() 的結果寫入 JSON 檔，merge() 加總到一個空的副本上
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def empty(self) -> "Metric":
+        return type(self)(self.name, self.documentation, self.labelnames)
+
+    def merge(self, snapshot: list):
+        for key, value in snapshot:
+            key = tuple(key)
+            self._values[key] = self._values.get(key, 0.0) + value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def set_total(self, value: float, **labels):
+        # 由其他物件自行累計的計數 (例如快取命中次數) 在抓取時直接帶入
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), merge: str = "sum"):
+        super().__init__(name, documentation, labelnames)
+        # 合併多個 worker 的值："sum" (例如處理中的請求數) 或 "max" (例如最近一次排程工作的耗時)
+        self.merge_mode = merge
+
+    def empty(self) -> "Gauge":
+        return Gauge(self.name, self.documentation, self.labelnames, self.merge_mode)
+
+    def merge(self, snapshot: list):
+        if self.merge_mode == "sum":
+            super().merge(snapshot)
+            return
+        for key, value in snapshot:
+            key = tuple(key)
+            self._values[key] = max(self._values.get(key, value), value)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每組標籤：各 bucket 的 (非累積) 次數、總和、總次數
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> Iterable[Tuple[str, LabelValues, float]]:
+        with self._lock:
+            items = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key + (_format_value(bound),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            names = self.labelnames + ("le",) if name.endswith("_bucket") else self.labelnames
+            lines.append(f"{name}{_format_labels(names, key)} {_format_value(value)}")
+        return lines
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [[list(key), list(counts), total, count] for key, (counts, total, count) in self._series.items()]
+
+    def empty(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.labelnames, self.buckets)
+
+    def merge(self, snapshot: list):
+        for key, counts, total, count in snapshot:
+            series = self._series.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0, 0])
+            series[0] = [merged + added for merged, added in zip(series[0], counts)]
+            series[1] += total
+            series[2] += count
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    # metrics 在請求處理時更新；collectors 在每次抓取 /metrics 時執行，讀取連線池、快取等其他物件目前的狀態
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+        # 多 worker 部署 (serve.py) 時每個 worker 定期把自己的值寫到這個目錄，抓取時合併所有 worker 的檔案
+        self._directory: Optional[str] = None
+        self._snapshot_path: Optional[str] = None
+        self._snapshot_lock = threading.Lock()
+        self._stop_snapshots = threading.Event()
+        self._snapshot_thread: Optional[threading.Thread] = None
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), merge: str = "sum") -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, merge))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, func: Callable[[], None]) -> Callable[[], None]:
+        self._collectors.append(func)
+        return func
+
+    def collect(self):
+        for collect in self._collectors:
+            collect()
+
+    def render(self) -> str:
+        self.collect()
+        metrics = self._metrics
+        if self._directory is not None:
+            self.write_snapshot()
+            metrics = self._merged()
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def start_snapshots(self, directory: str, interval: float = 1.0):
+        # 多個 worker 共用一個監聽 socket，每次抓取只會由其中一個 worker 回應；
+        # 各 worker 每 interval 秒把自己的值寫入 directory/<pid>-<啟動時間>.json，回應 /metrics 的 worker 合併所有檔案
+        # 檔名帶啟動時間，pid 被重複使用時不會覆蓋已結束 worker 的檔案
+        self._directory = directory
+        self._snapshot_path = os.path.join(directory, f"{os.getpid()}-{time.time_ns()}.json")
+        self._stop_snapshots.clear()
+        self._snapshot_thread = threading.Thread(target=self._snapshot_loop, args=(interval,), name="metrics-snapshot", daemon=True)
+        self._snapshot_thread.start()
+
+    def stop_snapshots(self):
+        # 結束前寫入最後的值：已結束 worker 的計數器仍計入合計，重新啟動 worker 時計數器不會倒退
+        if self._snapshot_thread is None:
+            return
+        self._stop_snapshots.set()
+        self._snapshot_thread.join()
+        self._snapshot_thread = None
+        self.collect()
+        self.write_snapshot()
+
+    def _snapshot_loop(self, interval: float):
+        while not self._stop_snapshots.wait(interval):
+            try:
+                self.collect()
+                self.write_snapshot()
+            except Exception:
+                logger.exception("Failed to write the metrics snapshot")
+
+    def write_snapshot(self):
+        data = {"pid": os.getpid(), "metrics": {metric.name: metric.snapshot() for metric in self._metrics}}
+        with self._snapshot_lock:
+            # 先寫入暫存檔再 rename，其他 worker 不會讀到寫到一半的檔案
+            temporary = self._snapshot_path + ".tmp"
+            with open(temporary, "w") as snapshot_file:
+                json.dump(data, snapshot_file)
+            os.replace(temporary, self._snapshot_path)
+
+    def _merged(self) -> List[Metric]:
+        snapshots = []
+        for path in glob.glob(os.path.join(self._directory, "*.json")):
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                # 檔案在讀取前被 master 清除
+                continue
+        alive = {data["pid"]: _process_alive(data["pid"]) for data in snapshots}
+        merged = []
+        for metric in self._metrics:
+            combined = metric.empty()
+            for data in snapshots:
+                # 計數器與直方圖包含已結束的 worker；量測值只反映仍在執行的 worker
+                if metric.kind == "gauge" and not alive[data["pid"]]:
+                    continue
+                combined.merge(data["metrics"].get(metric.name, []))
+            merged.append(combined)
+        return merged
+
+
+registry = Registry()
+
+http_requests_total = registry.counter("sidep_http_requests_total", "HTTP requests by route template and status code", ("method", "route", "status"))
+http_request_duration = registry.histogram("sidep_http_request_duration_seconds", "HTTP request latency by route template", ("method", "route"))
+http_requests_in_progress = registry.gauge("sidep_http_requests_in_progress", "HTTP requests currently being handled", ("method",))
+# 各個快取共用：cache 為快取名稱，result 為 hit / miss
+cache_requests_total = registry.counter("sidep_cache_requests_total", "Cache lookups by cache name and result", ("cache", "result"))
+cache_entries = registry.gauge("sidep_cache_entries", "Entries currently held by each cache", ("cache",))
+
+
+def route_template(scope) -> str:
+    # 路由比對後 Starlette 會把 route 放回 scope，使用 /bookings/{booking_id} 這類樣板而不是實際路徑
+    route = scope.get("route")
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    # 純 ASGI middleware：記錄每個 HTTP 請求的延遲、狀態碼與處理中的請求數
+    # 延遲量到回應送完為止；SSE 等串流回應會記錄整段連線時間
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        http_requests_in_progress.inc(method=method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = route_template(scope)
+            http_request_duration.observe(time.perf_counter() - started, method=method, route=route)
+            http_requests_total.inc(method=method, route=route, status=status_code)
+            http_requests_in_progress.dec(method=method)
@@ -0,0 +1,176 @@
+import argparse
+import os
+import sys
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+import sqlalchemy as sa
+
+# 分批回填的遷移在回填中途中斷後必須能重新執行：在暫存的 SQLite 上建立遷移前的 schema 與資料，
+# 第一批回填提交後中斷 upgrade，再執行一次 upgrade，確認遷移從檢查點繼續、資料全部回填且版本前進；
+# 有錯誤時以非 0 結束，可放進 CI
+#   python migration_check.py --rows 2500
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Interrupted(Exception):
+    pass
+
+
+@dataclass
+class BackfillCase:
+    revision: str
+    # 這個 revision 新增的欄位 (建立遷移前的 schema 時移除)：表格 -> 欄位
+    added_columns: Dict[str, List[str]]
+    seed: Callable[[sa.engine.Connection, int], None]
+    # 尚未回填的列數
+    remaining: Callable[[sa.engine.Connection], int]
+
+
+def _seed_owner(conn) -> int:
+    conn.execute(sa.text("INSERT INTO users (id, email, name, password, role) VALUES (1, 'owner@example.com', 'Owner', 'x', 'admin')"))
+    conn.execute(sa.text("INSERT INTO services (id, owner_id, name, price, min_duration, max_duration) VALUES (1, 1, 'Cut', 100, 30, 60)"))
+    return 1
+
+
+def _seed_start_end_at(conn, rows: int):
+    owner_id = _seed_owner(conn)
+    first_day = datetime(2026, 1, 1)
+    conn.execute(sa.text("INSERT INTO bookings (owner_id, service_id, date, time, status) VALUES (:owner_id, 1, :date, :time, 'confirmed')"), [
+        {"owner_id": owner_id, "date": first_day + timedelta(days=index // 8), "time": f"{9 + index % 8:02d}:00"}
+        for index in range(rows)
+    ])
+
+
+def _seed_price(conn, rows: int):
+    # 一半是進行中的預約，一半已封存；兩張表都要從服務價格回填
+    owner_id = _seed_owner(conn)
+    first_start = datetime(2026, 1, 1, 9)
+    values = [
+        {"id": index + 1, "owner_id": owner_id, "start_at": first_start + timedelta(hours=index), "status": "completed"}
+        for index in range(rows)
+    ]
+    statement = "INSERT INTO {} (id, owner_id, service_id, start_at, status) VALUES (:id, :owner_id, 1, :start_at, :status)"
+    conn.execute(sa.text(statement.format("bookings")), values[: rows // 2])
+    conn.execute(sa.text(statement.format("bookings_archive")), values[rows // 2 :])
+
+
+CASES = [
+    BackfillCase(
+        revision="c3f1a9e0b2d4",
+        added_columns={"bookings": ["start_at", "end_at"]},
+        seed=_seed_start_end_at,
+        remaining=lambda conn: conn.execute(sa.text("SELECT count(*) FROM bookings WHERE start_at IS NULL OR end_at IS NULL")).scalar(),
+    ),
+    BackfillCase(
+        revision="b5d7f9a1c3e4",
+        added_columns={"bookings": ["price"], "bookings_archive": ["price"]},
+        seed=_seed_price,
+        remaining=lambda conn: conn.execute(sa.text(
+            "SELECT (SELECT count(*) FROM bookings WHERE price IS NULL) + (SELECT count(*) FROM bookings_archive WHERE price IS NULL)"
+        )).scalar(),
+    ),
+]
+
+
+def _drop_columns(conn, added_columns: Dict[str, List[str]]):
+    # 以目前的 models 建表後移除這個 revision 新增的欄位 (先移除包含這些欄位的索引)，即為遷移前的 schema
+    inspector = sa.inspect(conn)
+    for table_name, columns in added_columns.items():
+        for index in inspector.get_indexes(table_name):
+            if set(index["column_names"]) & set(columns):
+                conn.execute(sa.text(f'DROP INDEX "{index["name"]}"'))
+        for column in columns:
+            conn.execute(sa.text(f'ALTER TABLE "{table_name}" DROP COLUMN "{column}"'))
+
+
+def _upgrade_interrupted(config, case: BackfillCase) -> bool:
+    # 每個新增欄位的表的第二個 UPDATE 之前中斷：第一批已回填並記錄檢查點，之後的批次沒有執行
+    from alembic import command
+
+    updates = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if any(statement.startswith(f"UPDATE {table_name} ") for table_name in case.added_columns):
+            updates.append(statement)
+            if len(updates) > 1:
+                raise Interrupted()
+
+    sa.event.listen(sa.engine.Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        command.upgrade(config, case.revision)
+    except Interrupted:
+        return True
+    finally:
+        sa.event.remove(sa.engine.Engine, "before_cursor_execute", before_cursor_execute)
+    return False
+
+
+def run_case(case: BackfillCase, rows: int, workdir: str) -> List[str]:
+    from alembic import command
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    import models  # noqa: F401 (註冊所有的表)
+    from database import Base
+    from online_migrations import checkpoints
+
+    database_url = "sqlite:///" + os.path.join(workdir, f"{case.revision}.db")
+    # alembic/env.py 依 SIDEP_DATABASE_URL 連線
+    os.environ["SIDEP_DATABASE_URL"] = database_url
+    config = Config(os.path.join(HERE, "alembic.ini"))
+    down_revision = ScriptDirectory.from_config(config).get_revision(case.revision).down_revision
+
+    engine = sa.create_engine(database_url)
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        _drop_columns(conn, case.added_columns)
+        case.seed(conn, rows)
+    command.stamp(config, down_revision)
+
+    errors = []
+    if not _upgrade_interrupted(config, case):
+        errors.append("the backfill finished before it could be interrupted (use more --rows)")
+    with engine.connect() as conn:
+        version = conn.execute(sa.text("SELECT version_num FROM alembic_version")).scalar()
+        saved = conn.execute(sa.select(checkpoints.c.name, checkpoints.c.rows_done)).all() if sa.inspect(conn).has_table(checkpoints.name) else []
+    if version != down_revision:
+        errors.append(f"alembic_version is {version} after the interrupted upgrade, expected {down_revision}")
+    if not saved:
+        errors.append("no checkpoint was saved before the interruption")
+
+    try:
+        command.upgrade(config, case.revision)
+    except Exception as error:
+        errors.append(f"rerunning the upgrade failed: {error!r}")
+        return errors
+    with engine.connect() as conn:
+        version = conn.execute(sa.text("SELECT version_num FROM alembic_version")).scalar()
+        remaining = case.remaining(conn)
+    engine.dispose()
+    if version != case.revision:
+        errors.append(f"alembic_version is {version} after the rerun, expected {case.revision}")
+    if remaining:
+        errors.append(f"{remaining} rows were not backfilled")
+    print(f"{case.revision}: interrupted with checkpoints {[(name, done) for name, done in saved]}, resumed to {version}, {remaining} rows left")
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interrupt each batched backfill migration and check that rerunning it resumes")
+    parser.add_argument("--rows", type=int, default=2500, help="rows to seed; must exceed one backfill batch")
+    parser.add_argument("--revision", action="append", default=None, help="limit the check to these revisions")
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if not args.revision or case.revision in args.revision]
+    failed = 0
+    with tempfile.TemporaryDirectory() as workdir:
+        for case in cases:
+            errors = run_case(case, args.rows, workdir)
+            for error in errors:
+                print(f"FAIL {case.revision}: {error}")
+            failed += bool(errors)
+    print(f"{len(cases) - failed} passed, {failed} failed")
+    sys.exit(1 if failed else 0)
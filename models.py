@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, ForeignKey, Time
+from sqlalchemy import Column, Integer, String, Float, Boolean, Date, DateTime, ForeignKey, LargeBinary, Time, Index, Table, UniqueConstraint
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from sqlalchemy.sql import func
 from database import Base # 從 database.py 導入 Base
@@ -17,6 +17,7 @@ class User(Base):
     email_notifications_enabled = Column(Boolean, default=True)
     sms_notifications_enabled = Column(Boolean, default=False)
     public_slug: Mapped[str] = mapped_column(String, unique=True, index=True, nullable=True)
+    calendar_token = Column(String, nullable=True) # 行事曆訂閱網址的存取權杖，NULL 表示未啟用
     registration_date = Column(DateTime(timezone=True), server_default=func.now())
 
     bookings = relationship("Booking", foreign_keys="[Booking.user_id]", back_populates="user")
@@ -39,10 +40,99 @@ class Service(Base):
     image_url = Column(String, nullable=True)
 
     bookings = relationship("Booking", back_populates="service")
+    resources = relationship("Resource", secondary="service_resources", back_populates="services")
 
     def __repr__ (self):
         return f"<Service(id={self.id}, name={self.name}, price={self.price})>"
 
+# 服務與可提供該服務的資源 (技師、座位等) 之間的多對多關聯
+service_resources = Table(
+    "service_resources",
+    Base.metadata,
+    Column("service_id", Integer, ForeignKey("services.id", ondelete="CASCADE"), primary_key=True),
+    Column("resource_id", Integer, ForeignKey("resources.id", ondelete="CASCADE"), primary_key=True, index=True),
+)
+
+class Resource(Base):
+    __tablename__ = "resources"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    name = Column(String, nullable=False)
+    kind = Column(String, default="staff") # staff 或 chair 等
+    capacity = Column(Integer, nullable=False, default=1) # 同一時段可同時服務的預約數
+    is_active = Column(Boolean, default=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    services = relationship("Service", secondary="service_resources", back_populates="resources")
+
+    def __repr__(self):
+        return f"<Resource(id={self.id}, owner_id={self.owner_id}, name={self.name}, capacity={self.capacity})>"
+
+class ResourceSlot(Base):
+    # 每個資源每 15 分鐘一筆的預約計數，由 capacity.py 在建立/取消預約時維護
+    __tablename__ = "resource_slots"
+
+    resource_id = Column(Integer, ForeignKey("resources.id", ondelete="CASCADE"), primary_key=True)
+    slot_start = Column(DateTime, primary_key=True)
+    owner_id = Column(Integer, nullable=False, index=True)
+    booked = Column(Integer, nullable=False, default=0)
+    capacity = Column(Integer, nullable=False, default=1)
+
+    def __repr__(self):
+        return f"<ResourceSlot(resource_id={self.resource_id}, slot_start={self.slot_start}, booked={self.booked}/{self.capacity})>"
+
+class OccupancyDay(Base):
+    # 每個店家每天的時段位元圖 (每 5 分鐘一個位元)，由 occupancy.py 在預約寫入時維護；沒有列的日期會從 bookings 計算
+    __tablename__ = "occupancy_days"
+
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    booked = Column(LargeBinary, nullable=False) # little-endian，第 n 個位元是當天第 n 個 5 分鐘
+
+    def __repr__(self):
+        return f"<OccupancyDay(owner_id={self.owner_id}, day={self.day})>"
+
+class Client(Base):
+    # 店家的客戶名錄：會員以 user_id、匿名客戶以正規化後的 email / 電話辨識
+    # 統計欄位由 clients.py 在預約寫入時遞增維護，不需要每次從 bookings 重新計算
+    __tablename__ = "clients"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True, index=True) # 匿名客戶為 NULL
+    name = Column(String, nullable=False)
+    email = Column(String, nullable=True)
+    phone = Column(String, nullable=True)
+    email_normalized = Column(String, nullable=True)
+    phone_normalized = Column(String, nullable=True)
+    booking_count = Column(Integer, nullable=False, default=0) # 未取消的預約數
+    visit_count = Column(Integer, nullable=False, default=0) # 已完成的預約數
+    lifetime_spend = Column(Float, nullable=False, default=0) # 已完成預約的服務金額總和
+    last_visit_at = Column(DateTime, nullable=True)
+    next_visit_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("owner_id", "user_id", name="uq_clients_owner_id_user_id"),
+        UniqueConstraint("owner_id", "email_normalized", name="uq_clients_owner_id_email_normalized"),
+        Index("ix_clients_owner_id_phone_normalized", "owner_id", "phone_normalized"),
+        # 客戶列表的每種排序各有一個 (owner_id, 排序欄位, id) 索引，分頁不需要排序整個名錄
+        Index("ix_clients_owner_id_name", "owner_id", "name", "id"),
+        Index("ix_clients_owner_id_visit_count", "owner_id", "visit_count", "id"),
+        Index("ix_clients_owner_id_lifetime_spend", "owner_id", "lifetime_spend", "id"),
+    )
+
+    def __repr__(self):
+        return f"<Client(id={self.id}, owner_id={self.owner_id}, name={self.name}, visits={self.visit_count})>"
+
+# 可為 NULL 的排序欄位一律把 NULL 視為最小值 (ASC NULLS FIRST / DESC NULLS LAST)
+# SQLite 本來就是這個順序但索引不能指定 NULLS；PostgreSQL 預設相反，需要在索引上指定
+for _column in ("last_visit_at", "next_visit_at"):
+    Index(f"ix_clients_owner_id_{_column}", Client.owner_id, Client.__table__.c[_column].asc().nulls_first(), Client.id).ddl_if(dialect="postgresql")
+    Index(f"ix_clients_owner_id_{_column}", Client.owner_id, Client.__table__.c[_column], Client.id).ddl_if(callable_=lambda ddl, target, bind, dialect, **kw: dialect.name != "postgresql")
+
 class Booking(Base):
     __tablename__ = 'bookings'
 
@@ -53,30 +143,151 @@ class Booking(Base):
     service_id = Column(Integer, ForeignKey('services.id'))
     date = Column(DateTime)
     time = Column(String)
+    start_at = Column(DateTime, nullable=True) # 由 date + time 組合而成的開始時間
+    end_at = Column(DateTime, nullable=True) # 開始時間加上服務時長
     status = Column(String, default='pending')
     notes = Column(String, nullable=True, default='')
     customer_name = Column(String, nullable=True)
     customer_email = Column(String, nullable=True)
     customer_phone = Column(String, nullable=True)
+    series_id = Column(Integer, ForeignKey('booking_series.id'), nullable=True, index=True) # 週期性預約所屬的系列
+    resource_id = Column(Integer, ForeignKey('resources.id'), nullable=True) # 負責此預約的資源，服務未設定資源時為 NULL
+    client_id = Column(Integer, ForeignKey('clients.id'), nullable=True) # 客戶名錄中的客戶
+    price = Column(Float, nullable=True) # 預約時的服務價格，之後服務調價不影響這筆預約的消費金額
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     user = relationship("User", foreign_keys="[Booking.user_id]", back_populates="bookings")
     service = relationship("Service", foreign_keys="[Booking.service_id]", back_populates="bookings")
+    series = relationship("BookingSeries", back_populates="bookings")
+    resource = relationship("Resource")
+    client = relationship("Client")
+
+    __table_args__ = (
+        # 時段重疊檢查與時間範圍查詢都走這個索引
+        Index("ix_bookings_owner_id_start_at", "owner_id", "start_at", "end_at"),
+        Index("ix_bookings_resource_id_start_at", "resource_id", "start_at"),
+        # 「我的預約」依 user_id 篩選並依 start_at 排序；刪除服務時的外鍵檢查需要 service_id 索引
+        Index("ix_bookings_user_id_start_at", "user_id", "start_at"),
+        Index("ix_bookings_service_id", "service_id"),
+        # 客戶的下一次預約與統計重算
+        Index("ix_bookings_client_id_start_at", "client_id", "start_at"),
+    )
 
     def __repr__(self):
         return f"<Booking(id={self.id}, user_id={self.user_id}, service_id={self.service_id}, date={self.date}, status={self.status})>"
 
+class BookingSeries(Base):
+    # 週期性預約 (例如每週同一時段)，建立時一次展開成多筆 Booking
+    __tablename__ = 'booking_series'
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    service_id = Column(Integer, ForeignKey('services.id'))
+    start_date = Column(DateTime, nullable=False)
+    time = Column(String, nullable=False)
+    interval_weeks = Column(Integer, nullable=False, default=1)
+    occurrences = Column(Integer, nullable=True) # 與 end_date 至少需提供一個
+    end_date = Column(DateTime, nullable=True)
+    status = Column(String, default='active') # active 或 cancelled
+    notes = Column(String, nullable=True, default='')
+    customer_name = Column(String, nullable=True)
+    customer_email = Column(String, nullable=True)
+    customer_phone = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    bookings = relationship("Booking", back_populates="series")
+
+    def __repr__(self):
+        return f"<BookingSeries(id={self.id}, owner_id={self.owner_id}, start_date={self.start_date}, interval_weeks={self.interval_weeks}, status={self.status})>"
+
+class BookingArchive(Base):
+    # 已完成或已取消的舊預約，由 archive.py 從 bookings 搬移過來
+    # PostgreSQL 上依 start_at 每月分區，主鍵必須包含分區鍵
+    __tablename__ = 'bookings_archive'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    start_at = Column(DateTime, primary_key=True)
+    owner_id = Column(Integer, nullable=False)
+    booking_reference_id = Column(String, nullable=True)
+    user_id = Column(Integer, nullable=True, index=True)
+    service_id = Column(Integer, nullable=True)
+    date = Column(DateTime)
+    time = Column(String)
+    end_at = Column(DateTime, nullable=True)
+    status = Column(String)
+    notes = Column(String, nullable=True)
+    customer_name = Column(String, nullable=True)
+    customer_email = Column(String, nullable=True)
+    customer_phone = Column(String, nullable=True)
+    series_id = Column(Integer, nullable=True)
+    resource_id = Column(Integer, nullable=True)
+    client_id = Column(Integer, nullable=True, index=True)
+    price = Column(Float, nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_bookings_archive_owner_id_start_at", "owner_id", "start_at"),
+        {"postgresql_partition_by": "RANGE (start_at)"},
+    )
+
+    def __repr__(self):
+        return f"<BookingArchive(id={self.id}, owner_id={self.owner_id}, start_at={self.start_at}, status={self.status})>"
+
+class BookingVersion(Base):
+    # 每個店家一列的版本號：任何影響預約內容的寫入都會遞增，快取以版本號判斷是否過期
+    __tablename__ = "booking_versions"
+
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<BookingVersion(owner_id={self.owner_id}, version={self.version})>"
+
+class BookingEvent(Base):
+    # 預約的狀態變更紀錄，只新增不修改；由 audit.py 的背景執行緒批次寫入
+    # 不設外鍵：預約刪除或封存後紀錄仍然保留
+    __tablename__ = "booking_events"
+
+    id = Column(Integer, primary_key=True)
+    event_id = Column(String(32), unique=True, nullable=False) # 重送時以此忽略重複的紀錄
+    booking_id = Column(Integer, nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    event_type = Column(String, nullable=False) # created / status_changed / deleted
+    from_status = Column(String, nullable=True)
+    to_status = Column(String, nullable=True)
+    actor_id = Column(Integer, nullable=True) # 操作的使用者，公開頁面與排程為 NULL
+    source = Column(String, nullable=False) # admin / customer / public / system
+    occurred_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_booking_events_booking_id_occurred_at", "booking_id", "occurred_at"),
+        Index("ix_booking_events_owner_id_occurred_at", "owner_id", "occurred_at"),
+    )
+
+    def __repr__(self):
+        return f"<BookingEvent(booking_id={self.booking_id}, {self.from_status} -> {self.to_status}, source={self.source})>"
+
 class BusinessHour(Base):
     __tablename__ = "business_hours"
 
     id = Column(Integer, primary_key=True, index=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    resource_id = Column(Integer, ForeignKey("resources.id", ondelete="CASCADE"), nullable=True, index=True) # NULL 表示店家的營業時間
     day_of_week = Column(Integer, nullable=False) # 0=Monday, 6=Sunday
     open_time = Column(Time, nullable=False)
     close_time = Column(Time, nullable=False)
     is_closed = Column(Boolean, default=False) # 新增欄位，表示當天是否休息
 
+    __table_args__ = (
+        Index("ix_business_hours_owner_id_day_of_week", "owner_id", "day_of_week"),
+    )
+
     def __repr__(self):
         return f"<BusinessHour(id={self.id}, day_of_week={self.day_of_week}, open_time={self.open_time}, close_time={self.close_time})>"
 
@@ -84,10 +295,15 @@ class Holiday(Base):
     __tablename__ = "holidays"
 
     id = Column(Integer, primary_key=True, index=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
-    date = Column(DateTime, unique=True, nullable=False)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    date = Column(DateTime, nullable=False)
     description = Column(String, nullable=True)
 
+    __table_args__ = (
+        # 每個店家各自的公休日，唯一索引同時服務依 owner 與日期範圍的查詢
+        UniqueConstraint("owner_id", "date", name="uq_holidays_owner_id_date"),
+    )
+
     def __repr__(self):
         return f"<Holiday(id={self.id}, date={self.date}, description={self.description})>"
 
@@ -95,10 +311,14 @@ class UnavailableDate(Base):
     __tablename__ = "unavailable_dates"
 
     id = Column(Integer, primary_key=True, index=True)
-    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
-    date = Column(DateTime, unique=True, nullable=False)
+    owner_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    date = Column(DateTime, nullable=False)
     reason = Column(String, nullable=True)
 
+    __table_args__ = (
+        UniqueConstraint("owner_id", "date", name="uq_unavailable_dates_owner_id_date"),
+    )
+
     def __repr__(self):
         return f"<UnavailableDate(id={self.id}, date={self.date}, reason={self.reason})>"
 
@@ -121,4 +341,31 @@ class BlacklistedToken(Base):
     blacklisted_on = Column(DateTime(timezone=True), server_default=func.now())
 
     def __repr__(self):
-        return f"<BlacklistedToken(id={self.id}, token={self.token[:10]}..., blacklisted_on={self.blacklisted_on})>"
\ No newline at end of file
+        return f"<BlacklistedToken(id={self.id}, token={self.token[:10]}..., blacklisted_on={self.blacklisted_on})>"
+
+
+class IdempotencyKey(Base):
+    # 以 Idempotency-Key 建立資源的第一次結果 (idempotency.py)，所有 worker 共用；response 為 NULL 表示仍在執行中
+    __tablename__ = "idempotency_keys"
+
+    key_hash = Column(String(64), primary_key=True) # sha256(端點, 使用者/owner, Idempotency-Key)
+    fingerprint = Column(String(64), nullable=False) # 請求內容的 sha256
+    response = Column(String, nullable=True) # 第一次的回應 (JSON)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey(key_hash={self.key_hash[:10]}..., expires_at={self.expires_at})>"
+
+
+class TenantShard(Base):
+    # 分片目錄 (只在主資料庫)：不在主資料庫的店家所在的分片；沒有列的店家在主資料庫 (sharding.DEFAULT_SHARD)
+    __tablename__ = "tenant_shards"
+
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    shard = Column(String, nullable=False)
+    state = Column(String, nullable=False, default="active") # active，或 moving (搬移中，暫停寫入)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<TenantShard(owner_id={self.owner_id}, shard={self.shard}, state={self.state})>"
@@ -0,0 +1,332 @@
+import argparse
+import logging
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import and_, delete, or_, select, union_all
+from sqlalchemy.orm import Session
+
+import booking_versions
+import models
+
+logger = logging.getLogger(__name__)
+
+# 每個店家每天一個位元圖，每 5 分鐘一個位元：位元為 1 表示該格已有未取消的預約 (不分資源)
+# 「這個時段有沒有被預約」從查詢當天的預約並比對時間，變成對位元圖做 AND
+SLOT_MINUTES = 5
+SLOT_SECONDS = SLOT_MINUTES * 60
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+FULL_DAY = (1 << SLOTS_PER_DAY) - 1
+BITMAP_BYTES = SLOTS_PER_DAY // 8
+# 不佔用時段的預約狀態 (與 capacity.RELEASED_STATUSES 相同)
+RELEASED_STATUSES = ("cancelled",)
+OCCUPANCY_MAX_ENTRIES = 1000
+DAY_BATCH_SIZE = 100
+
+days_table = models.OccupancyDay.__table__
+
+
+def to_bytes(bits: int) -> bytes:
+    return bits.to_bytes(BITMAP_BYTES, "little")
+
+
+def from_bytes(data: Optional[bytes]) -> int:
+    return int.from_bytes(data, "little") if data else 0
+
+
+def _range_mask(first: int, last: int) -> int:
+    return ((1 << (last - first)) - 1) << first if last > first else 0
+
+
+def day_masks(start_at: datetime, end_at: datetime) -> Dict[date, Tuple[int, int]]:
+    # 時段在每一天的 (有碰到的格子, 整格都在時段內的格子)；跨過午夜的預約分成兩天
+    masks = {}
+    day = start_at.date()
+    while True:
+        day_start = datetime.combine(day, time.min)
+        day_end = day_start + timedelta(days=1)
+        if day_start >= end_at and masks:
+            break
+        low = int((max(start_at, day_start) - day_start).total_seconds())
+        high = int((min(end_at, day_end) - day_start).total_seconds())
+        masks[day] = (_range_mask(low // SLOT_SECONDS, -(-high // SLOT_SECONDS)), _range_mask(-(-low // SLOT_SECONDS), high // SLOT_SECONDS))
+        day += timedelta(days=1)
+    return masks
+
+
+def affected_days(windows: Iterable[Tuple[datetime, datetime]]) -> set:
+    return {day for start_at, end_at in windows if start_at is not None and end_at is not None for day in day_masks(start_at, end_at)}
+
+
+def _state(bits_by_day: Dict[date, int], masks: Dict[date, Tuple[int, int]]) -> Optional[bool]:
+    # True：沒有任何預約；False：確定有預約；None：只有頭尾不完整的格子有預約，需要比對實際時間
+    ambiguous = False
+    for day, (cover, inner) in masks.items():
+        bits = bits_by_day.get(day, 0)
+        if bits & inner:
+            return False
+        if bits & cover:
+            ambiguous = True
+    return None if ambiguous else True
+
+
+def overlapping_booking(db: Session, owner_id: int, start_at: datetime, end_at: datetime, exclude_series_id: Optional[int] = None):
+    # 以實際的開始與結束時間比對，只在位元圖無法判斷時使用
+    query = db.query(models.Booking.id).filter(
+        models.Booking.owner_id == owner_id,
+        models.Booking.start_at < end_at,
+        models.Booking.end_at > start_at,
+        models.Booking.status.notin_(RELEASED_STATUSES),
+    )
+    if exclude_series_id is not None:
+        query = query.filter(or_(models.Booking.series_id.is_(None), models.Booking.series_id != exclude_series_id))
+    return query.first()
+
+
+def _compute_days(db: Session, owner_id: int, days: Sequence[date]) -> Dict[date, int]:
+    # 從 bookings 計算這幾天的位元圖，每批以 OR 的日期範圍走 (owner_id, start_at, end_at) 索引
+    bits = {day: 0 for day in days}
+    days = sorted(days)
+    for offset in range(0, len(days), DAY_BATCH_SIZE):
+        batch = days[offset:offset + DAY_BATCH_SIZE]
+        ranges = [
+            and_(models.Booking.start_at < datetime.combine(day + timedelta(days=1), time.min), models.Booking.end_at > datetime.combine(day, time.min))
+            for day in batch
+        ]
+        rows = db.query(models.Booking.start_at, models.Booking.end_at).filter(
+            models.Booking.owner_id == owner_id,
+            models.Booking.status.notin_(RELEASED_STATUSES),
+            or_(*ranges),
+        ).all()
+        for start_at, end_at in rows:
+            for day, (cover, _) in day_masks(start_at, end_at).items():
+                if day in bits:
+                    bits[day] |= cover
+    return bits
+
+
+def _upsert(db: Session):
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Occupancy upsert is not supported on {dialect}")
+    return insert(days_table)
+
+
+def _select_days(db: Session, owner_id: int, days, lock: bool) -> Dict[date, int]:
+    statement = select(models.OccupancyDay.day, models.OccupancyDay.booked).where(
+        models.OccupancyDay.owner_id == owner_id,
+        models.OccupancyDay.day.in_(list(days)),
+    )
+    if lock:
+        statement = statement.with_for_update()
+    return {day: from_bytes(booked) for day, booked in db.execute(statement)}
+
+
+def _lock_days(db: Session, owner_id: int, days) -> Dict[date, int]:
+    # 鎖住這幾天的位元圖列直到交易結束 (PostgreSQL)，同一天的並行寫入依序檢查與更新
+    # 還沒有列的日期 (新店家、升級前的預約或已清除的過去日期) 先從 bookings 計算後建立
+    days = set(days)
+    if not days:
+        return {}
+    bits = _select_days(db, owner_id, days, lock=True)
+    missing = sorted(days - bits.keys())
+    if missing:
+        computed = _compute_days(db, owner_id, missing)
+        db.execute(_upsert(db).on_conflict_do_nothing(index_elements=["owner_id", "day"]), [
+            {"owner_id": owner_id, "day": day, "booked": to_bytes(value)} for day, value in computed.items()
+        ])
+        bits.update(_select_days(db, owner_id, missing, lock=True))
+    return bits
+
+
+def _write_days(db: Session, owner_id: int, bits: Dict[date, int]):
+    if not bits:
+        return
+    statement = _upsert(db)
+    db.execute(statement.on_conflict_do_update(index_elements=["owner_id", "day"], set_={"booked": statement.excluded.booked}), [
+        {"owner_id": owner_id, "day": day, "booked": to_bytes(value)} for day, value in bits.items()
+    ])
+
+
+def conflicting(db: Session, owner_id: int, windows: Sequence[Tuple[datetime, datetime]]) -> List[int]:
+    # 寫入前的衝突檢查，回傳有衝突的時段索引；鎖住的位元圖列由之後的 occupy 在同一個交易中更新
+    if not windows:
+        return []
+    masks = [day_masks(start_at, end_at) for start_at, end_at in windows]
+    bits = _lock_days(db, owner_id, {day for window in masks for day in window})
+    conflicts = []
+    for index, ((start_at, end_at), window) in enumerate(zip(windows, masks)):
+        free = _state(bits, window)
+        if free is None:
+            free = overlapping_booking(db, owner_id, start_at, end_at) is None
+        if not free:
+            conflicts.append(index)
+    return conflicts
+
+
+def occupy(db: Session, owner_id: int, windows: Iterable[Tuple[datetime, datetime]]):
+    # 新增 (或恢復) 預約：只需要把覆蓋到的格子 OR 進位元圖
+    added = defaultdict(int)
+    for start_at, end_at in windows:
+        if start_at is None or end_at is None:
+            continue
+        for day, (cover, _) in day_masks(start_at, end_at).items():
+            added[day] |= cover
+    if not added:
+        return
+    bits = _lock_days(db, owner_id, added)
+    _write_days(db, owner_id, {day: bits.get(day, 0) | mask for day, mask in added.items()})
+
+
+def refresh(db: Session, owner_id: int, days: Iterable[date]):
+    # 取消、刪除或改期後，同一格可能還有其他預約 (不同資源)，因此從 bookings 重新計算受影響的日期
+    days = set(days)
+    if not days:
+        return
+    db.flush()
+    _lock_days(db, owner_id, days)
+    _write_days(db, owner_id, _compute_days(db, owner_id, sorted(days)))
+
+
+def _open_bits(start: time, end: time) -> int:
+    # 營業時間內完整的格子
+    low = start.hour * 3600 + start.minute * 60 + start.second
+    high = end.hour * 3600 + end.minute * 60 + end.second if end != time.min else 24 * 3600
+    return _range_mask(-(-low // SLOT_SECONDS), high // SLOT_SECONDS)
+
+
+class _OwnerDays:
+    __slots__ = ("version", "closed_weekdays", "closed_dates", "days")
+
+    def __init__(self, version: int, closed_weekdays: Dict[int, int], closed_dates: set):
+        self.version = version
+        self.closed_weekdays = closed_weekdays
+        self.closed_dates = closed_dates
+        self.days: Dict[date, int] = {}
+
+
+class OccupancyCache:
+    # 公開頁面讀取用的記憶體快取：每個店家保存營業設定換算出的休息格子與已讀取日期的位元圖
+    # 以預約版本號判斷是否過期 (預約與營業設定的寫入都會遞增版本號)，版本號相同時不需要任何查詢
+    def __init__(self, max_entries: int = OCCUPANCY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._owners: "OrderedDict[int, _OwnerDays]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._owners)
+
+    def _entry(self, db: Session, owner_id: int, version: int) -> _OwnerDays:
+        entry = self._owners.get(owner_id)
+        if entry is not None and entry.version == version:
+            self._owners.move_to_end(owner_id)
+            return entry
+        entry = self._owners[owner_id] = _OwnerDays(version, *self._load_settings(db, owner_id))
+        self._owners.move_to_end(owner_id)
+        while len(self._owners) > self.max_entries:
+            self._owners.popitem(last=False)
+        return entry
+
+    def _load_settings(self, db: Session, owner_id: int):
+        # 沒有設定營業時間的星期整天開放；同一天有多筆營業時間時取聯集
+        open_weekdays: Dict[int, int] = {}
+        for day_of_week, open_time, close_time, is_closed in db.query(
+            models.BusinessHour.day_of_week, models.BusinessHour.open_time, models.BusinessHour.close_time, models.BusinessHour.is_closed
+        ).filter(models.BusinessHour.owner_id == owner_id, models.BusinessHour.resource_id.is_(None)):
+            open_weekdays[day_of_week] = open_weekdays.get(day_of_week, 0) | (0 if is_closed else _open_bits(open_time, close_time))
+        closed_weekdays = {day_of_week: FULL_DAY & ~bits for day_of_week, bits in open_weekdays.items()}
+        holidays = select(models.Holiday.date).where(models.Holiday.owner_id == owner_id)
+        unavailable = select(models.UnavailableDate.date).where(models.UnavailableDate.owner_id == owner_id)
+        closed_dates = {value.date() if isinstance(value, datetime) else value for value in db.execute(union_all(holidays, unavailable)).scalars()}
+        return closed_weekdays, closed_dates
+
+    def _booked(self, db: Session, owner_id: int, entry: _OwnerDays, days) -> Dict[date, int]:
+        missing = [day for day in days if day not in entry.days]
+        if missing:
+            self.misses += 1
+            loaded = _select_days(db, owner_id, missing, lock=False)
+            absent = [day for day in missing if day not in loaded]
+            if absent:
+                # 讀取請求不建立列，直接從 bookings 計算
+                loaded.update(_compute_days(db, owner_id, absent))
+            entry.days.update(loaded)
+        else:
+            self.hits += 1
+        return {day: entry.days[day] for day in days}
+
+    def closed(self, entry: _OwnerDays, day: date) -> int:
+        if day in entry.closed_dates:
+            return FULL_DAY
+        return entry.closed_weekdays.get(day.isoweekday(), 0)
+
+    def is_open(self, db: Session, owner_id: int, version: int, start_at: datetime, end_at: datetime) -> bool:
+        # 時段碰到的每一格都在店家的營業時間內，且不是公休日或不可預約日
+        entry = self._entry(db, owner_id, version)
+        return all(not cover & self.closed(entry, day) for day, (cover, _) in day_masks(start_at, end_at).items())
+
+    def is_free(self, db: Session, owner_id: int, version: int, start_at: datetime, end_at: datetime) -> bool:
+        # 時段內沒有任何未取消的預約
+        entry = self._entry(db, owner_id, version)
+        masks = day_masks(start_at, end_at)
+        free = _state(self._booked(db, owner_id, entry, masks), masks)
+        if free is None:
+            free = overlapping_booking(db, owner_id, start_at, end_at) is None
+        return free
+
+
+occupancy_cache = OccupancyCache()
+
+
+def rebuild(db: Session, owner_id: Optional[int] = None, today: Optional[date] = None) -> int:
+    # 從今天起的預約重新計算位元圖；過去的日期不再需要，由排程清除
+    today = datetime.combine(today or date.today(), time.min)
+    query = db.query(models.Booking.owner_id, models.Booking.start_at, models.Booking.end_at).filter(
+        models.Booking.start_at.isnot(None),
+        models.Booking.end_at > today,
+        models.Booking.status.notin_(RELEASED_STATUSES),
+    )
+    owners = select(models.OccupancyDay.owner_id).distinct()
+    statement = delete(models.OccupancyDay)
+    if owner_id is not None:
+        query = query.filter(models.Booking.owner_id == owner_id)
+        owners = owners.where(models.OccupancyDay.owner_id == owner_id)
+        statement = statement.where(models.OccupancyDay.owner_id == owner_id)
+
+    bits = defaultdict(int)
+    for booking_owner_id, start_at, end_at in query.yield_per(1000):
+        for day, (cover, _) in day_masks(start_at, end_at).items():
+            if day >= today.date():
+                bits[(booking_owner_id, day)] |= cover
+    changed_owners = set(db.execute(owners).scalars()) | {key[0] for key in bits}
+
+    db.execute(statement)
+    rows = [{"owner_id": key[0], "day": key[1], "booked": to_bytes(value)} for key, value in bits.items()]
+    if rows:
+        db.execute(days_table.insert(), rows)
+    # 各 worker 的記憶體快取以版本號判斷過期
+    booking_versions.bump(db, changed_owners)
+    db.commit()
+    logger.info("Rebuilt %d occupancy days", len(rows))
+    return len(rows)
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Rebuild per-day occupancy bitmaps from bookings")
+    parser.add_argument("--owner-id", type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = SessionLocal()
+    try:
+        total = rebuild(db, args.owner_id)
+        print(f"Rebuilt {total} occupancy days")
+    finally:
+        db.close()
@@ -0,0 +1,201 @@
+import argparse
+import logging
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Optional, Sequence
+
+import sqlalchemy as sa
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+# 進度檢查點獨立於應用程式的 metadata，由 alembic/env.py 的 include_object 排除在 autogenerate 的比對之外
+checkpoint_metadata = sa.MetaData()
+checkpoints = sa.Table(
+    "online_migration_checkpoints",
+    checkpoint_metadata,
+    sa.Column("name", sa.String, primary_key=True),
+    sa.Column("last_key", sa.BigInteger, nullable=False),
+    sa.Column("rows_done", sa.BigInteger, nullable=False, default=0),
+    sa.Column("updated_at", sa.DateTime, nullable=False),
+)
+
+FetchBatch = Callable[[sa.engine.Connection, int, int], Sequence]
+ApplyBatch = Callable[[sa.engine.Connection, Sequence], int]
+
+
+@dataclass
+class BackfillStats:
+    name: str
+    rows: int = 0
+    batches: int = 0
+    last_key: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+@contextmanager
+def online_block():
+    # 在 Alembic revision 中使用：提交目前的遷移交易並切換為 autocommit
+    # 區塊中的每個批次各自提交，不會把整張表鎖到遷移結束
+    from alembic import op
+
+    with op.get_context().autocommit_block():
+        yield op.get_bind()
+
+
+def _load_checkpoint(conn, name: str):
+    checkpoint_metadata.create_all(conn, checkfirst=True)
+    return conn.execute(sa.select(checkpoints).where(checkpoints.c.name == name)).first()
+
+
+def _save_checkpoint(conn, name: str, last_key: int, rows_done: int):
+    values = {"last_key": last_key, "rows_done": rows_done, "updated_at": sa.func.now()}
+    result = conn.execute(sa.update(checkpoints).where(checkpoints.c.name == name).values(**values))
+    if result.rowcount == 0:
+        conn.execute(sa.insert(checkpoints).values(name=name, **values))
+
+
+def reset_checkpoint(conn, name: str):
+    checkpoint_metadata.create_all(conn, checkfirst=True)
+    conn.execute(sa.delete(checkpoints).where(checkpoints.c.name == name))
+
+
+def run_batched(
+    conn,
+    name: str,
+    fetch_batch: FetchBatch,
+    apply_batch: ApplyBatch,
+    *,
+    key: str = "id",
+    batch_size: int = 1000,
+    pause: float = 0.05,
+    max_rows_per_second: Optional[float] = None,
+) -> BackfillStats:
+    # 分批回填的通用流程：
+    #   fetch_batch(conn, last_key, batch_size) 依 key 遞增順序取出下一批資料
+    #   apply_batch(conn, rows) 寫入這一批，回傳實際處理的筆數
+    # conn 應處於 autocommit 模式 (參見 online_block)，每批在一個陳述式內完成
+    # 每批完成後記錄檢查點，中斷後重新執行會從上次的 key 之後繼續；全部完成後清除檢查點
+    checkpoint = _load_checkpoint(conn, name)
+    stats = BackfillStats(name=name)
+    if checkpoint is not None:
+        stats.last_key = checkpoint.last_key
+        stats.rows = checkpoint.rows_done
+        logger.info("Resuming %s after key %d (%d rows already done)", name, stats.last_key, stats.rows)
+
+    started = time.monotonic()
+    resumed_rows = stats.rows
+    while True:
+        batch_started = time.monotonic()
+        rows = fetch_batch(conn, stats.last_key, batch_size)
+        if not rows:
+            break
+        stats.rows += apply_batch(conn, rows)
+        stats.batches += 1
+        stats.last_key = getattr(rows[-1], key)
+        _save_checkpoint(conn, name, stats.last_key, stats.rows)
+
+        stats.elapsed = time.monotonic() - started
+        run_rate = (stats.rows - resumed_rows) / stats.elapsed if stats.elapsed else 0.0
+        logger.info("%s: %d rows, last key %d, %.0f rows/s", name, stats.rows, stats.last_key, run_rate)
+
+        delay = pause
+        if max_rows_per_second:
+            # 節流：讓這一批至少花 len(rows) / max_rows_per_second 秒
+            delay = max(delay, len(rows) / max_rows_per_second - (time.monotonic() - batch_started))
+        if delay > 0:
+            time.sleep(delay)
+
+    reset_checkpoint(conn, name)
+    stats.elapsed = time.monotonic() - started
+    logger.info("%s finished: %d rows in %d batches (%.1fs)", name, stats.rows, stats.batches, stats.elapsed)
+    return stats
+
+
+def add_column_if_missing(table_name: str, column: sa.Column):
+    # online_block() 之前新增的欄位已經提交，回填中斷時 alembic_version 卻還停在上一版；
+    # 重新執行遷移時略過已存在的欄位，回填才能從檢查點繼續
+    from alembic import op
+
+    if column.name not in {existing["name"] for existing in sa.inspect(op.get_bind()).get_columns(table_name)}:
+        op.add_column(table_name, column)
+
+
+def create_index_concurrently(index_name: str, table_name: str, columns: Sequence[str], **kw):
+    # PostgreSQL 上以 CREATE INDEX CONCURRENTLY 建立索引，其他資料庫使用一般的 CREATE INDEX
+    # 必須在 online_block() 內呼叫，CONCURRENTLY 不能在交易中執行
+    from alembic import op
+
+    op.create_index(index_name, table_name, list(columns), postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def drop_index_concurrently(index_name: str, table_name: str):
+    from alembic import op
+
+    op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+
+
+def _demo(args):
+    # 以合成資料在本機資料庫上試跑分批回填，用來估算正式環境的 rows/s
+    engine = sa.create_engine(args.url)
+    metadata = sa.MetaData()
+    demo = sa.Table(
+        "online_migration_demo",
+        metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("minutes", sa.Integer, nullable=False),
+        sa.Column("hours", sa.Float, nullable=True),
+    )
+    with engine.begin() as conn:
+        if args.fresh:
+            demo.drop(conn, checkfirst=True)
+            reset_checkpoint(conn, "online_migration_demo")
+        if not sa.inspect(conn).has_table(demo.name):
+            demo.create(conn)
+            rng = random.Random(args.seed)
+            for offset in range(0, args.rows, 10000):
+                chunk = min(10000, args.rows - offset)
+                conn.execute(sa.insert(demo), [{"minutes": rng.randint(15, 240)} for _ in range(chunk)])
+
+    def fetch_batch(conn, last_key, limit):
+        return conn.execute(
+            sa.select(demo.c.id).where(demo.c.hours.is_(None), demo.c.id > last_key).order_by(demo.c.id).limit(limit)
+        ).all()
+
+    def apply_batch(conn, rows):
+        result = conn.execute(
+            sa.update(demo)
+            .where(demo.c.id.between(rows[0].id, rows[-1].id), demo.c.hours.is_(None))
+            .values(hours=demo.c.minutes / 60.0)
+        )
+        return result.rowcount
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        stats = run_batched(
+            conn,
+            "online_migration_demo",
+            fetch_batch,
+            apply_batch,
+            batch_size=args.batch_size,
+            pause=args.pause,
+            max_rows_per_second=args.max_rows_per_second,
+        )
+    print(f"{stats.rows} rows in {stats.batches} batches, {stats.elapsed:.2f}s, {stats.rows_per_second:.0f} rows/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a synthetic batched backfill against a local database")
+    parser.add_argument("--url", default="sqlite:///online_migration_demo.db")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--pause", type=float, default=0.0)
+    parser.add_argument("--max-rows-per-second", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fresh", action="store_true", help="drop the demo table and checkpoint first")
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-5.5s [%(name)s] %(message)s")
+    _demo(parser.parse_args())
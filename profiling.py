@@ -0,0 +1,137 @@
+import cProfile
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Profile" # 值為 1 (預設模式)、sample 或 cprofile
+PROFILE_ID_HEADER = "X-Profile-Id"
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), "sidep_profiles")
+PROFILE_MODES = ("sample", "cprofile")
+SAMPLE_INTERVAL_SECONDS = 0.001
+# 最內層是這些函式的執行緒正在閒置等待 (threadpool 等工作、event loop 等 I/O)，不計入取樣
+IDLE_FRAMES = {("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select")}
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> Optional[str]:
+    if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+        return None
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class StackSampler:
+    # 取樣式 profiler：背景執行緒每隔 interval 秒記錄所有執行緒的呼叫堆疊，輸出 flamegraph.pl / speedscope 可讀的 collapsed 格式
+    # 會涵蓋 threadpool 中執行的同步程式碼 (資料庫查詢、bcrypt)，但同時間其他請求的工作也會被取樣
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sidep-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, "thread")
+                if name.startswith("sidep-profiler"):
+                    continue
+                stack = _collapse(frame)
+                if stack is not None:
+                    self.samples[f"{name};{stack}"] += 1
+
+    def write(self, path: str):
+        with open(path, "w") as output:
+            for stack, count in self.samples.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+class ProfilingMiddleware:
+    # 純 ASGI middleware：帶有 X-Profile 標頭且通過 authorize 的請求，或依 sample_rate 抽中的請求才會被 profile
+    # 結果寫到 directory/<profile id>.collapsed (取樣) 或 .prof (cProfile)，id 放在 X-Profile-Id 回應標頭
+    # 停用時不應加入這個 middleware，請求完全不經過這裡
+    def __init__(self, app, directory: str = PROFILE_DIR, sample_rate: float = 0.0, default_mode: str = "sample", authorize: Optional[Callable[[dict], bool]] = None, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.app = app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.default_mode = default_mode
+        self.authorize = authorize
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+
+    async def _requested_mode(self, scope) -> Optional[str]:
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        requested = headers.get(PROFILE_HEADER.lower())
+        if requested:
+            mode = requested if requested in PROFILE_MODES else self.default_mode
+            # authorize 可能需要查詢資料庫，在 threadpool 中執行
+            if self.authorize is not None and await run_in_threadpool(self.authorize, headers):
+                return mode
+            return None
+        if self.sample_rate and random.random() < self.sample_rate:
+            return self.default_mode
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = await self._requested_mode(scope)
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:12]}"
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(PROFILE_ID_HEADER.lower().encode(), profile_id.encode())]
+            await send(message)
+
+        started = time.perf_counter()
+        if mode == "cprofile":
+            # 決定式 profiler 只記錄 event loop 執行緒；async 處理函式內的同步程式碼都在這個執行緒上
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                profiler.disable()
+                path = os.path.join(self.directory, f"{profile_id}.prof")
+                await run_in_threadpool(profiler.dump_stats, path)
+        else:
+            sampler = StackSampler(self.interval)
+            sampler.start()
+            try:
+                await self.app(scope, receive, send_with_profile_id)
+            finally:
+                sampler.stop()
+                path = os.path.join(self.directory, f"{profile_id}.collapsed")
+                await run_in_threadpool(sampler.write, path)
+        logger.info("Profiled %s %s in %.1f ms -> %s", scope["method"], scope["path"], (time.perf_counter() - started) * 1000, path)
@@ -0,0 +1,257 @@
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_TICK_SECONDS = 1.0
+LEADER_CHECK_SECONDS = 15.0
+# pg_try_advisory_lock 使用的固定 key，所有 worker 競爭同一把鎖
+SCHEDULER_ADVISORY_LOCK_KEY = 720_260_033
+SCHEDULER_LOCK_FILE = os.path.join(tempfile.gettempdir(), "sidep_scheduler.lock")
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> set:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_text, end_text = part.split("-", 1)
+            start, end = int(start_text), int(end_text)
+        else:
+            start = end = int(part)
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Invalid cron field: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    # 標準五欄位 cron 表示式：分 時 日 月 星期 (0=星期日)，支援 *、範圍、列表與 /間隔
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _parse_cron_field(fields[4], 0, 7)}
+
+    def next_after(self, moment: datetime) -> datetime:
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif candidate.day not in self.days or (candidate.isoweekday() % 7) not in self.weekdays:
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+
+class IntervalSchedule:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def next_after(self, moment: datetime) -> datetime:
+        return moment + timedelta(seconds=self.seconds)
+
+
+class Job:
+    def __init__(self, name: str, func: Callable[[], Optional[int]], schedule=None, run_at: Optional[datetime] = None, leader_only: bool = True):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.leader_only = leader_only
+        self.next_run = run_at or schedule.next_after(datetime.now())
+        self.running = False
+        # 觀測指標
+        self.runs = 0
+        self.failures = 0
+        self.last_started_at: Optional[datetime] = None
+        self.last_duration: Optional[float] = None
+        self.last_lag: Optional[float] = None
+        self.last_processed: Optional[int] = None
+        self.processed = 0
+        self.last_error: Optional[str] = None
+
+
+class PostgresAdvisoryLock:
+    # 以一條專用的 autocommit 連線持有 session 層級的 advisory lock；連線中斷時鎖會自動釋放
+    def __init__(self, engine, key: int = SCHEDULER_ADVISORY_LOCK_KEY):
+        self.engine = engine
+        self.key = key
+        self._conn = None
+
+    def try_acquire(self) -> bool:
+        if self._conn is not None:
+            try:
+                self._conn.execute(text("SELECT 1"))
+                return True
+            except Exception:
+                logger.warning("Lost scheduler leader connection")
+                self.release()
+        conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar()
+        except Exception:
+            conn.close()
+            raise
+        if acquired:
+            self._conn = conn
+        else:
+            conn.close()
+        return bool(acquired)
+
+    def release(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": self.key})
+        except Exception:
+            pass
+        finally:
+            self._conn.close()
+            self._conn = None
+
+
+class FileLock:
+    # 單機部署 (或非 PostgreSQL) 時以檔案鎖選出 leader
+    def __init__(self, path: str = SCHEDULER_LOCK_FILE):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class Scheduler:
+    # 在應用程式內執行的排程器：週期性 (cron/interval) 工作只在 leader 上執行，
+    # 延遲工作 (once) 在排入它的 worker 上執行；工作本身在 threadpool 中執行
+    def __init__(self, election=None, tick: float = SCHEDULER_TICK_SECONDS, leader_check: float = LEADER_CHECK_SECONDS):
+        self.election = election or FileLock()
+        self.tick = tick
+        self.leader_check = leader_check
+        self.is_leader = False
+        self.jobs: Dict[str, Job] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._next_leader_check = 0.0
+
+    def cron(self, name: str, expression: str, func: Callable[[], Optional[int]]) -> Job:
+        return self._add(Job(name, func, schedule=CronSchedule(expression)))
+
+    def every(self, name: str, seconds: float, func: Callable[[], Optional[int]]) -> Job:
+        return self._add(Job(name, func, schedule=IntervalSchedule(seconds)))
+
+    def once(self, name: str, delay: float, func: Callable[[], Optional[int]]) -> Job:
+        return self._add(Job(name, func, run_at=datetime.now() + timedelta(seconds=delay), leader_only=False))
+
+    def cancel(self, name: str):
+        self.jobs.pop(name, None)
+
+    def _add(self, job: Job) -> Job:
+        self.jobs[job.name] = job
+        return job
+
+    def start(self):
+        self._stopping = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self.election.release)
+        self.is_leader = False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            if time.monotonic() >= self._next_leader_check:
+                self._next_leader_check = time.monotonic() + self.leader_check
+                try:
+                    is_leader = await loop.run_in_executor(None, self.election.try_acquire)
+                except Exception:
+                    logger.exception("Scheduler leader election failed")
+                    is_leader = False
+                if is_leader != self.is_leader:
+                    logger.info("Scheduler leadership %s", "acquired" if is_leader else "lost")
+                self.is_leader = is_leader
+
+            now = datetime.now()
+            for job in list(self.jobs.values()):
+                if job.running or job.next_run > now:
+                    continue
+                if job.leader_only and not self.is_leader:
+                    # 非 leader 直接跳過這一輪，不累積待執行的工作
+                    job.next_run = job.schedule.next_after(now)
+                    continue
+                job.running = True
+                loop.create_task(self._execute(job, now))
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.tick)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job: Job, now: datetime):
+        loop = asyncio.get_running_loop()
+        job.last_started_at = now
+        job.last_lag = (now - job.next_run).total_seconds()
+        started = time.monotonic()
+        try:
+            job.last_processed = await loop.run_in_executor(None, job.func)
+            job.processed += job.last_processed or 0
+            job.last_error = None
+        except Exception as exc:
+            job.failures += 1
+            job.last_error = repr(exc)
+            logger.exception("Scheduled job %s failed", job.name)
+        finally:
+            job.runs += 1
+            job.last_duration = time.monotonic() - started
+            job.running = False
+            logger.info("Scheduled job %s finished in %.3fs (lag %.3fs, processed %s)", job.name, job.last_duration, job.last_lag, job.last_processed)
+            if job.schedule is None:
+                if self.jobs.get(job.name) is job:
+                    del self.jobs[job.name]
+            else:
+                job.next_run = job.schedule.next_after(datetime.now())
@@ -83,6 +83,7 @@ class BookingBase(BaseModel):
     customer_email: Optional[EmailStr] = None
     customer_phone: Optional[str] = None
     public_slug: Optional[str] = None # 新增 public_slug 欄位
+    resource_id: Optional[int] = None # 指定技師/座位，未指定時自動分配
 
 class BookingCreate(BookingBase):
     pass
@@ -94,6 +95,9 @@ class BookingResponse(BaseModel):
     service_id: int
     date: date
     time: str
+    start_at: Optional[datetime] = None
+    end_at: Optional[datetime] = None
+    resource_id: Optional[int] = None
     status: str
     notes: Optional[str] = None
     created_at: datetime
@@ -109,6 +113,108 @@ class BookingUpdate(BaseModel):
     notes: Optional[str] = None
     status: Optional[str] = None # 允許更新狀態
 
+class BookingEventResponse(BaseModel):
+    event_type: str
+    from_status: Optional[str] = None
+    to_status: Optional[str] = None
+    actor_id: Optional[int] = None
+    source: str
+    occurred_at: datetime
+
+    class Config:
+        from_attributes = True
+
+# Booking Series Schemas
+class BookingSeriesCreate(BaseModel):
+    user_id: Optional[int] = None
+    service_id: int
+    start_date: date # 第一次預約的日期
+    time: str
+    interval_weeks: int = Field(1, ge=1, le=52) # 每隔幾週一次
+    occurrences: Optional[int] = Field(None, ge=1) # 展開的次數，與 end_date 至少需提供一個
+    end_date: Optional[date] = None # 最後可預約的日期 (含)
+    status: Optional[str] = "pending"
+    notes: Optional[str] = None
+    customer_name: Optional[str] = None
+    customer_email: Optional[EmailStr] = None
+    customer_phone: Optional[str] = None
+    public_slug: Optional[str] = None
+    resource_id: Optional[int] = None
+
+class BookingSeriesUpdate(BaseModel):
+    # 只套用到尚未開始的預約，已過去的預約保持不變
+    time: Optional[str] = None
+    notes: Optional[str] = None
+    status: Optional[str] = None
+
+class BookingSeriesResponse(BaseModel):
+    id: int
+    user_id: Optional[int] = None
+    service_id: int
+    start_date: date
+    time: str
+    interval_weeks: int
+    occurrences: Optional[int] = None
+    end_date: Optional[date] = None
+    status: str
+    notes: Optional[str] = None
+    bookings: List[BookingResponse] = []
+    skipped_dates: List[date] = [] # 因公休日或不可預約日而跳過的日期
+
+    class Config:
+        from_attributes = True
+
+# Resource Schemas
+class ResourceBase(BaseModel):
+    name: str
+    kind: Optional[str] = "staff" # staff 或 chair 等
+    capacity: int = Field(1, ge=1) # 同一時段可同時服務的預約數
+    is_active: Optional[bool] = True
+
+class ResourceCreate(ResourceBase):
+    service_ids: List[int] = [] # 可提供的服務
+
+class ResourceResponse(ResourceBase):
+    id: int
+    service_ids: List[int] = []
+
+    class Config:
+        from_attributes = True
+
+class AvailabilityResponse(BaseModel):
+    service_id: int
+    slot_start: datetime
+    available: bool
+    free_resource_ids: List[int] = []
+
+# Client Schemas
+class ClientUpdate(BaseModel):
+    name: Optional[str] = None
+    email: Optional[EmailStr] = None
+    phone: Optional[str] = None
+
+class ClientResponse(BaseModel):
+    id: int
+    user_id: Optional[int] = None # 匿名客戶為 None
+    name: str
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    booking_count: int = 0
+    visit_count: int = 0
+    lifetime_spend: float = 0
+    last_visit_at: Optional[datetime] = None
+    next_visit_at: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class ClientPage(BaseModel):
+    items: List[ClientResponse]
+    total: int
+    limit: int
+    offset: int
+
 # Business Settings Schemas
 class BusinessHourBase(BaseModel):
     day_of_week: int # 0=Monday, 6=Sunday
@@ -206,6 +312,38 @@ class UserPublicProfileResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class CalendarFeedResponse(BaseModel):
+    url: str # 含存取權杖的訂閱網址 (webcal 可將 https 換成 webcal)
+
+class AdminBootstrapResponse(BaseModel):
+    profile: UserResponse
+    services: List[ServiceResponse]
+    settings: BusinessSettingsResponse
+    upcoming_bookings: List[BookingResponse]
+
+# Analytics Schemas
+class ServiceAnalytics(BaseModel):
+    service_id: int # 0 表示沒有指定服務的預約
+    name: Optional[str] = None
+    bookings: int
+    completed: int
+    cancelled: int
+    no_show: int
+    cancellation_rate: Optional[float] = None
+    no_show_rate: Optional[float] = None # 未到 / (完成 + 未到)
+
+class AnalyticsResponse(BaseModel):
+    start: date
+    end: date # 不含
+    total_bookings: int
+    # 以下皆為 7 × 24 (星期一到星期日 × 0-23 時)，不含已取消的預約
+    booking_heatmap: List[List[int]] # 各時段開始的預約數
+    booked_minutes: List[List[float]]
+    capacity_minutes: List[List[float]] # 營業分鐘數 × 可同時服務的數量
+    utilization: List[List[Optional[float]]] # 沒有營業的時段為 null
+    overall_utilization: Optional[float] = None
+    services: List[ServiceAnalytics]
+
 class BlacklistedTokenBase(BaseModel):
     token: str
 
@@ -0,0 +1,261 @@
+import argparse
+import glob
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Dict, List, Set, Tuple
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+# 多 worker 啟動器：master 綁定監聽 socket 後 fork 出 N 個 uvicorn worker 共用同一個 socket
+#   python serve.py --workers 4 --port 8000
+#   kill -TERM <master pid>  停止接受新連線，等處理中的請求完成後結束
+#   kill -HUP <master pid>   rolling restart：逐一啟動新 worker，就緒後才停止對應的舊 worker
+#
+# Prometheus 指標：每次抓取 /metrics 只會由其中一個 worker 回應，各 worker 的計數器各自累計，
+# 直接回傳單一 worker 的值會讓 Prometheus 把數值跳動當成計數器重設。因此 master 建立 --metrics-dir
+# (以 SIDEP_METRICS_DIR 傳給 worker)，每個 worker 每秒與結束前把自己的值寫到其中一個檔案，
+# 回應 /metrics 的 worker 合併所有檔案 (參見 metrics.Registry.start_snapshots)：
+#   計數器與直方圖加總所有 worker，包含已結束的 worker (rolling restart 後不會倒退)
+#   量測值只加總仍在執行的 worker (排程工作的耗時與延遲取最大值)
+# 已結束 worker 的檔案保留到 master 重新啟動為止，master 啟動時清除目錄中的舊檔案
+
+logger = logging.getLogger("serve")
+
+DEFAULT_GRACEFUL_TIMEOUT = 30
+# 新 worker 完成 startup 的期限；超過視為啟動失敗，rolling restart 會中止並保留舊 worker
+READY_TIMEOUT = 60
+# worker 在啟動後這段時間內結束視為啟動失敗，重新啟動前先等待，避免匯入錯誤時不斷 fork
+MIN_WORKER_LIFETIME = 5
+RESPAWN_DELAY = 1
+POLL_INTERVAL = 0.2
+
+
+def default_workers() -> int:
+    # 容器中以可使用的 CPU 為準，而不是主機的總核心數
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def bind_socket(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerServer(uvicorn.Server):
+    # 完成 lifespan startup 後寫入 ready pipe 通知 master
+    def __init__(self, config: uvicorn.Config, ready_fd: int):
+        super().__init__(config)
+        self.ready_fd = ready_fd
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets)
+        try:
+            os.write(self.ready_fd, b"1")
+        except OSError:
+            # master 沒有等待這個 worker (例如異常結束後補上的 worker)
+            pass
+        finally:
+            os.close(self.ready_fd)
+
+
+def _exit_after_shutdown(signum, frame):
+    # uvicorn 完成關閉 (含 lifespan shutdown、釋放連線) 後會以原本的處理函式重新送出收到的訊號
+    raise SystemExit(0)
+
+
+def run_worker(app, sock: socket.socket, ready_fd: int, options: dict):
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _exit_after_shutdown)
+    signal.signal(signal.SIGINT, _exit_after_shutdown)
+    config = uvicorn.Config(app, **options)
+    WorkerServer(config, ready_fd).run(sockets=[sock])
+
+
+class Master:
+    def __init__(self, app, sock: socket.socket, workers: int, graceful_timeout: float, options: dict):
+        self.app = app
+        self.sock = sock
+        self.worker_count = workers
+        self.graceful_timeout = graceful_timeout
+        self.options = {**options, "timeout_graceful_shutdown": graceful_timeout}
+        # 服務中的 worker -> 啟動時間；retiring 是已送出 SIGTERM、正在處理剩餘請求的 worker
+        self.workers: Dict[int, float] = {}
+        self.retiring: Set[int] = set()
+        self._signals: List[int] = []
+        self._stopping = False
+
+    def spawn(self) -> Tuple[int, int]:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 1
+            try:
+                run_worker(self.app, self.sock, write_fd, self.options)
+                code = 0
+            except SystemExit as exc:
+                code = exc.code if isinstance(exc.code, int) else 0
+            except BaseException:
+                logger.exception("Worker %s crashed", os.getpid())
+            finally:
+                # 不執行 master 的 atexit 與 finally
+                os._exit(code)
+        os.close(write_fd)
+        self.workers[pid] = time.monotonic()
+        logger.info("Started worker %s", pid)
+        return pid, read_fd
+
+    def wait_ready(self, pid: int, read_fd: int, timeout: float = READY_TIMEOUT) -> bool:
+        try:
+            readable, _, _ = select.select([read_fd], [], [], timeout)
+            if not readable:
+                logger.error("Worker %s did not become ready within %ss", pid, timeout)
+                return False
+            if os.read(read_fd, 1) != b"1":
+                logger.error("Worker %s exited before becoming ready", pid)
+                return False
+            return True
+        finally:
+            os.close(read_fd)
+
+    def terminate(self, pid: int, sig: int = signal.SIGTERM):
+        self.workers.pop(pid, None)
+        self.retiring.add(pid)
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self.retiring.discard(pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info("Worker %s stopped", pid)
+                continue
+            started = self.workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            logger.error("Worker %s exited unexpectedly (status %s), restarting", pid, status)
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(RESPAWN_DELAY)
+            _, read_fd = self.spawn()
+            os.close(read_fd)
+
+    def rolling_restart(self):
+        # 一次只替換一個 worker，任何時候至少有 worker_count 個 worker 在接受連線
+        logger.info("Rolling restart of %d workers", len(self.workers))
+        for old_pid in list(self.workers):
+            if self._stopping or any(sig in (signal.SIGTERM, signal.SIGINT) for sig in self._signals):
+                return
+            new_pid, read_fd = self.spawn()
+            if not self.wait_ready(new_pid, read_fd):
+                logger.error("Rolling restart aborted; keeping the remaining old workers")
+                self.terminate(new_pid, signal.SIGKILL)
+                return
+            if old_pid in self.workers:
+                self.terminate(old_pid)
+
+    def stop(self):
+        self._stopping = True
+        for pid in list(self.workers):
+            self.terminate(pid)
+        # worker 自己會在 graceful_timeout 後取消剩餘的請求，這裡多等一點時間讓它完成 lifespan shutdown
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.retiring and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(POLL_INTERVAL)
+        for pid in list(self.retiring):
+            logger.warning("Killing worker %s after graceful timeout", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.reap()
+        self.sock.close()
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self._on_signal)
+        logger.info("Master %s listening on %s with %d workers", os.getpid(), self.sock.getsockname(), self.worker_count)
+        # 第一個 worker 單獨啟動 (startup 會建立資料表)，避免多個 worker 同時建表互相衝突
+        self.wait_ready(*self.spawn())
+        pending = [self.spawn() for _ in range(self.worker_count - 1)]
+        for pid, read_fd in pending:
+            self.wait_ready(pid, read_fd)
+        while True:
+            self.reap()
+            while self._signals:
+                sig = self._signals.pop(0)
+                if sig in (signal.SIGTERM, signal.SIGINT):
+                    logger.info("Received %s, draining workers", signal.Signals(sig).name)
+                    self.stop()
+                    return
+                if sig == signal.SIGHUP:
+                    self.rolling_restart()
+            time.sleep(POLL_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with multiple worker processes sharing one listening socket")
+    parser.add_argument("app", nargs="?", default="main:app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--graceful-timeout", type=float, default=DEFAULT_GRACEFUL_TIMEOUT, help="seconds to wait for in-flight requests on shutdown")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--preload", action="store_true", help="import the app once in the master; workers share its memory, but SIGHUP does not load new code")
+    parser.add_argument("--pid-file", default=None)
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--proxy-headers", action="store_true")
+    parser.add_argument("--metrics-dir", default=os.environ.get("SIDEP_METRICS_DIR"), help="directory where workers share their metrics; defaults to a temporary directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)-5.5s [%(name)s] %(message)s")
+
+    # 必須在匯入應用程式 (--preload) 與 fork 之前設定，worker 啟動時才會寫入指標檔案
+    metrics_dir = args.metrics_dir or tempfile.mkdtemp(prefix="sidep-metrics-")
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.remove(path)
+    os.environ["SIDEP_METRICS_DIR"] = metrics_dir
+
+    # 未使用 --preload 時每個 worker 在 fork 之後才匯入應用程式 (以及建立資料庫 engine)
+    app = import_from_string(args.app) if args.preload else args.app
+    if args.pid_file:
+        with open(args.pid_file, "w") as pid_file:
+            pid_file.write(str(os.getpid()))
+    options = {"log_level": args.log_level, "proxy_headers": args.proxy_headers, "lifespan": "on"}
+    master = Master(app, bind_socket(args.host, args.port, args.backlog), max(args.workers, 1), args.graceful_timeout, options)
+    try:
+        master.run()
+    finally:
+        if args.pid_file and os.path.exists(args.pid_file):
+            os.remove(args.pid_file)
+        if not args.metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import asyncio
+import functools
+import inspect
+import logging
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from fastapi import BackgroundTasks, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+
+import metrics
+import tenancy
+
+logger = logging.getLogger(__name__)
+
+# 同時到達、路由與參數都相同的讀取請求只執行一次，其餘請求等待並共用同一個結果
+# 例如店家分享預約連結後，大量訪客同時開啟 /public/profile/{slug}
+DEFAULT_WAIT_SECONDS = 5.0
+
+coalesced_requests_total = metrics.registry.counter(
+    "sidep_singleflight_requests_total",
+    "Coalesced reads by handler; result is leader (ran the handler), shared (reused an in-flight result) or timeout (gave up waiting and ran it)",
+    ("key", "result"),
+)
+inflight_calls = metrics.registry.gauge("sidep_singleflight_inflight", "In-flight coalesced computations by handler", ("key",))
+
+# 每個請求各自的物件，不屬於「相同的請求」的判斷依據
+_IGNORED_TYPES = (Session, Request, Response, BackgroundTasks)
+
+
+def _key_part(value) -> Hashable:
+    if isinstance(value, BaseModel):
+        return value.model_dump_json()
+    # 店家的資料範圍 (get_tenant) 以店家區分，同一個店家的請求才共用結果
+    if isinstance(value, tenancy.Tenant):
+        return ("Tenant", value.owner_id)
+    # 目前使用者等 ORM 物件以類別與主鍵區分
+    identity = getattr(value, "id", None)
+    if identity is not None and hasattr(value, "__table__"):
+        return (type(value).__name__, identity)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_key_part(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _key_part(item)) for key, item in value.items()))
+    hash(value)
+    return value
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, name: str, key: Hashable, func: Callable[[], Any], wait: Optional[float] = DEFAULT_WAIT_SECONDS):
+        # func 是沒有參數的 coroutine function；計算在獨立的 task 中執行，
+        # 發起的請求斷線被取消時，其他等待中的請求仍會拿到結果
+        task = self._calls.get(key)
+        if task is None:
+            coalesced_requests_total.inc(key=name, result="leader")
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            inflight_calls.inc(key=name)
+            task.add_done_callback(functools.partial(self._done, name, key))
+            return await asyncio.shield(task)
+        done, _ = await asyncio.wait([task], timeout=wait)
+        if not done:
+            # 等待超過上限時自己執行一次，不再無限期等待緩慢的計算
+            coalesced_requests_total.inc(key=name, result="timeout")
+            logger.warning("Coalesced call %s exceeded %ss; running it separately", name, wait)
+            return await func()
+        # 共用結果，包含 404 等例外
+        coalesced_requests_total.inc(key=name, result="shared")
+        return task.result()
+
+    def _done(self, name: str, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        inflight_calls.dec(key=name)
+        if not task.cancelled():
+            # 避免沒有人等待時出現 "exception was never retrieved"
+            task.exception()
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(name: Optional[str] = None, wait: Optional[float] = DEFAULT_WAIT_SECONDS, flight: SingleFlight = single_flight):
+    # 用於 FastAPI handler，放在路由 decorator 之下：
+    #   @public_router.get("/profile/{slug}")
+    #   @coalesce()
+    #   def get_public_profile(slug: str, db: Session = Depends(get_db)): ...
+    # 同步的 handler 在 threadpool 中執行 (等待中的請求不會卡住 event loop)；
+    # 共用的結果不應再被修改，handler 也不可有寫入
+    def decorator(handler):
+        handler_name = name or handler.__name__
+        is_async = inspect.iscoroutinefunction(handler)
+
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            async def call():
+                if is_async:
+                    return await handler(*args, **kwargs)
+                return await run_in_threadpool(handler, *args, **kwargs)
+
+            try:
+                key = (handler_name, tuple(_key_part(arg) for arg in args if not isinstance(arg, _IGNORED_TYPES)), tuple(sorted(
+                    (param, _key_part(value)) for param, value in kwargs.items() if not isinstance(value, _IGNORED_TYPES)
+                )))
+            except TypeError:
+                # 參數無法作為 key (不可雜湊)，直接執行
+                return await call()
+            return await flight.run(handler_name, key, call, wait)
+
+        return wrapper
+
+    return decorator
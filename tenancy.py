@@ -0,0 +1,120 @@
+import argparse
+import time as timer
+from typing import Callable, Dict, Hashable, List, Optional, Sequence
+
+from fastapi import HTTPException, status
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.orm import Query, Session
+
+import models
+
+# 店家 (租戶) 範圍的查詢：每個查詢都自動加上 owner_id 條件，handler 不需要再自己寫 filter(Model.owner_id == ...)
+# 常用的查詢在每個程序中只建立一次，參數以 bindparam 代入：語句物件會記住自己的 cache key，
+# 之後的請求直接命中編譯快取，不再重新建立查詢物件、計算 cache key 與編譯 SQL
+_statements: Dict[Hashable, object] = {}
+
+
+def _statement(key: Hashable, build: Callable[[], object]):
+    statement = _statements.get(key)
+    if statement is None:
+        statement = _statements.setdefault(key, build())
+    return statement
+
+
+def token_blacklisted(db: Session, token: str) -> bool:
+    # 每個需要登入的請求都會查詢一次
+    statement = _statement("token_blacklisted", lambda: select(models.BlacklistedToken.id).where(models.BlacklistedToken.token == bindparam("token")).limit(1))
+    return db.execute(statement, {"token": token}).first() is not None
+
+
+def user_by_id(db: Session, user_id: int) -> Optional[models.User]:
+    statement = _statement("user_by_id", lambda: select(models.User).where(models.User.id == bindparam("user_id")))
+    return db.execute(statement, {"user_id": user_id}).scalars().first()
+
+
+class Tenant:
+    def __init__(self, db: Session, owner_id: int, user: Optional[models.User] = None):
+        self.db = db
+        self.owner_id = owner_id
+        # 目前登入的店家 (操作者)；以公開頁面的 slug 建立時為 None
+        self.user = user
+
+    def get(self, model, object_id: int):
+        statement = _statement(("get", model), lambda: select(model).where(model.id == bindparam("object_id"), model.owner_id == bindparam("owner_id")))
+        return self.db.execute(statement, {"object_id": object_id, "owner_id": self.owner_id}).scalars().first()
+
+    def get_or_404(self, model, object_id: int, detail: str):
+        instance = self.get(model, object_id)
+        if instance is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=detail)
+        return instance
+
+    def all(self, model, ids: Optional[Sequence[int]] = None) -> List:
+        if not ids:
+            statement = _statement(("all", model), lambda: select(model).where(model.owner_id == bindparam("owner_id")))
+            return self.db.execute(statement, {"owner_id": self.owner_id}).scalars().all()
+        # IN 的參數數量不同仍共用同一個語句 (expanding bind parameter)
+        statement = _statement(("all_in", model), lambda: select(model).where(model.owner_id == bindparam("owner_id"), model.id.in_(bindparam("ids", expanding=True))))
+        return self.db.execute(statement, {"owner_id": self.owner_id, "ids": list(ids)}).scalars().all()
+
+    def query(self, model, *entities) -> Query:
+        # 需要 join、load_only 等組合的查詢仍使用 Query，只有 owner_id 條件由這裡加上
+        return self.db.query(model, *entities).filter(model.owner_id == self.owner_id)
+
+
+def _cpu_per_call(func: Callable[[], object], repeat: int) -> float:
+    func()
+    began = timer.process_time()
+    for _ in range(repeat):
+        func()
+    return (timer.process_time() - began) / repeat * 1e6
+
+
+def _benchmark(db: Session, owner_id: Optional[int], repeat: int):
+    # 以相同的資料比較各 endpoint 原本手寫的 Query 與 Tenant 的查詢，只計算 CPU 時間 (兩者送出的 SQL 相同)
+    if owner_id is None:
+        owner_id = db.query(models.Booking.owner_id).group_by(models.Booking.owner_id).order_by(func.count().desc()).limit(1).scalar()
+    tenant = Tenant(db, owner_id)
+    owner = db.query(models.User).filter(models.User.id == owner_id).one()
+    service_ids = [service_id for service_id, in db.query(models.Service.id).filter(models.Service.owner_id == owner_id).limit(5)]
+    booking_ids = [booking_id for booking_id, in db.query(models.Booking.id).filter(models.Booking.owner_id == owner_id).limit(20)]
+    token = "benchmark-token"
+
+    cases = [
+        ("auth: blacklist + user", lambda: (
+            db.query(models.BlacklistedToken).filter(models.BlacklistedToken.token == token).first(),
+            db.query(models.User).filter(models.User.id == owner.id).first(),
+        ), lambda: (token_blacklisted(db, token), user_by_id(db, owner.id))),
+        ("GET /services/", lambda: db.query(models.Service).filter(models.Service.owner_id == owner_id).all(),
+         lambda: tenant.all(models.Service)),
+        ("GET /services/?ids=", lambda: db.query(models.Service).filter(models.Service.owner_id == owner_id, models.Service.id.in_(service_ids)).all(),
+         lambda: tenant.all(models.Service, service_ids)),
+        ("GET|PUT|DELETE /services/{id}", lambda: db.query(models.Service).filter(models.Service.id == service_ids[0], models.Service.owner_id == owner_id).first(),
+         lambda: tenant.get(models.Service, service_ids[0])),
+        ("PUT|DELETE /bookings/{id}", lambda: db.query(models.Booking).filter(models.Booking.id == booking_ids[0], models.Booking.owner_id == owner_id).first(),
+         lambda: tenant.get(models.Booking, booking_ids[0])),
+        ("POST /bookings/ (service)", lambda: db.query(models.Service).filter(models.Service.id == service_ids[-1], models.Service.owner_id == owner_id).first(),
+         lambda: tenant.get(models.Service, service_ids[-1])),
+    ]
+    print(f"owner {owner_id}, {repeat} calls each, CPU microseconds per call")
+    print(f"{'endpoint':32} {'Query':>9} {'Tenant':>9} {'saved':>7}")
+    for name, before, after in cases:
+        # 每次呼叫都清空 identity map，避免只測到已載入的物件
+        legacy = _cpu_per_call(lambda: (before(), db.expunge_all()), repeat)
+        scoped = _cpu_per_call(lambda: (after(), db.expunge_all()), repeat)
+        print(f"{name:32} {legacy:9.1f} {scoped:9.1f} {1 - scoped / legacy:7.0%}")
+
+
+if __name__ == "__main__":
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Compare per-request CPU of hand-written owner filters and the Tenant query layer")
+    parser.add_argument("--owner-id", type=int, default=None, help="defaults to the owner with the most bookings")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        _benchmark(db, args.owner_id, args.repeat)
+    finally:
+        db.close()